@@ -0,0 +1,59 @@
+"""
+########################################################################################################################
+
+COMPACT MOLES MAPPING
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Fold the MOLES journal into the MOLES mapping JSON file, recompile the snapshot and empty the journal.
+
+The scripts append new MOLES catalogue answers to the journal rather than rewriting the mapping. Run this
+periodically e.g. from cron to keep the journal short. Jobs appending to the journal wait while it runs.
+
+Usage:
+
+    compact_moles_mapping.py --config <config>
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import sys
+from ConfigParser import ConfigParser
+from utils.metrics import Metrics
+from utils.moles_journal import MolesJournal, journal_from_config
+
+parser = argparse.ArgumentParser(description="Fold the MOLES journal into the MOLES mapping")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+MOLES_MAPPING = conf.get("files", "moles-mapping")
+
+if not MOLES_MAPPING:
+    print("No moles-mapping in the config file")
+    sys.exit(1)
+
+metrics = Metrics.from_config("compact_moles_mapping", conf, profile=args.profile)
+
+journal = MolesJournal(journal_from_config(conf))
+
+with metrics.stage("compact"):
+    records = journal.compact(MOLES_MAPPING)
+
+print("Folded {} journal records into {}".format(records, MOLES_MAPPING))
+metrics.incr("journal_records", records)
+
+metrics.write()
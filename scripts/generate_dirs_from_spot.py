@@ -12,9 +12,19 @@ Date: 17 August 2018
 Generate files containing directories and associated metadata. Will follow links which point inside the archive to build
 complete directory tree of the archive.
 
+Each record also carries the number of sub-directories and files, the size of the files and the latest modification
+time. The totals for the whole tree below each directory are rolled up once the walk is complete.
+
+Links which point into another spot are not followed. They are written to <spot>_link_stubs.ndjson and index_dirs
+copies the target spot's records below the link.
+
+If a config file is given, the rules in its [pruning] sections limit which directories are walked and its [throttle]
+section limits the rate of directory listings and file stats. The MOLES journal from its [files] section is laid
+over the mapping.
+
 Usage:
 
-    generate_dirs_from_spot.py <dir> <output_dir>
+    generate_dirs_from_spot.py <dir> <output_dir> [--config <config>] [--metrics-dir <metrics_dir>] [--profile]
 
 """
 __author__ = "Richard Smith"
@@ -28,77 +38,24 @@ import os
 from ceda_elasticsearch_tools.core.log_reader import SpotMapping
 import json
 import argparse
+from ConfigParser import ConfigParser
+from utils.metrics import Metrics
+from utils.pruning import Pruner
+from utils.throttle import Throttle
+from utils.moles_journal import load_journalled_mapping, journal_from_config
+from utils.walker import DirectoryWalker
 
 parser = argparse.ArgumentParser(
     description="Walk spots and generate list of directories with MOLES metadata where possible")
 
 parser.add_argument('input_dir', help="Input directory to scan")
 parser.add_argument('output_dir', help="Directory to write results to")
+parser.add_argument('--config', dest='config',
+                    help="Path to configuration file. Used for the pruning rules, throttling and MOLES journal")
+parser.add_argument('--metrics-dir', dest='metrics_dir', help="Directory to write the run report to")
+parser.add_argument('--profile', dest='profile', action='store_true', help="Capture cProfile output for each stage")
 
 
-#################################################
-#                                               #
-#                Functions                      #
-#                                               #
-#################################################
-
-def process_path(dir):
-    """
-    Process the path and return metadata. Also returns whether the directory is linked to another location in the archive.
-
-    :param dir: direcory path to process
-
-    :return:    dir_meta - dictionary of directory metadata
-                link     - boolean describing if the directory links to a location inside the archive
-    """
-
-    archive_path = spots.get_archive_path(dir)
-
-    dir_meta = {
-        'depth': dir.count('/'),
-        'dir': os.path.basename(dir),
-        'path': dir,
-        'archive_path': archive_path,
-        'link': False,
-        'type': "dir"
-    }
-
-    if os.path.islink(dir) and dir != archive_path:
-        dir_meta['link'] = True
-
-    record = get_moles_record_meta(archive_path)
-    if record and record["title"]:
-        dir_meta["title"] = record["title"]
-        dir_meta["url"] = record["url"]
-        dir_meta["record_type"] = record["record_type"]
-
-    return dir_meta, dir_meta['link']
-
-
-def get_moles_record_meta(dir):
-    """
-    Use the archive path to check the mapping for a match.
-
-    :param dir: directory to test
-    :return: MOLES record info for the given dir
-    """
-
-    # recursively check for a match
-    while len(dir) > 1:
-        if dir in moles_mapping:
-            return moles_mapping[dir]
-        elif dir + "/" in moles_mapping:
-            return moles_mapping[dir + "/"]
-        else:
-            dir = os.path.dirname(dir)
-
-
-#################################################
-#                                               #
-#                End of Functions               #
-#                                               #
-#################################################
-
 # Parse command line arguments
 args = parser.parse_args()
 
@@ -110,62 +67,65 @@ if SCAN_DIR.endswith('/'):
 OUTPUT_DIR = args.output_dir
 
 # Setup
-output = []
+metrics = Metrics("generate_dirs_from_spot", report_dir=args.metrics_dir, profile=args.profile)
+
 print ("Loading spot mapping...")
-spots = SpotMapping(spot_file="spot_mapping.txt")
+with metrics.stage("load_spot_mapping"):
+    spots = SpotMapping(spot_file="spot_mapping.txt")
+
+conf = None
+if args.config:
+    conf = ConfigParser()
+    conf.read(args.config)
 
-# Load moles_mapping
+# Load moles_mapping. The journal from the config file holds the records found by the other jobs
 print ("Loading MOLES mapping...")
-with open('moles_catalogue_mapping.json') as reader:
-    moles_mapping = json.load(reader)
+with metrics.stage("load_moles_mapping"):
+    moles_mapping = load_journalled_mapping('moles_catalogue_mapping.json',
+                                            journal_from_config(conf) if conf is not None else None)
 
-# Add the root
-root_meta, islink = process_path(SCAN_DIR)
-output.append(root_meta)
+# Reports are named after the spot so parallel jobs do not overwrite each other
+metrics.job = "generate_dirs_{}".format(spots.get_spot(SCAN_DIR))
 
 # Process the tree
 print ("Processing tree...")
-readmes = {}
-for root, dirs, files in os.walk(SCAN_DIR):
-
-    # Check for 00README
-    if "00README" in files:
-        with open(os.path.join(root,"00README")) as reader:
-            content = reader.read()
-        readmes[root] = content.decode('utf-8','ignore').encode("utf-8")
-
-    for directory in dirs:
-        path = os.path.join(root, directory)
+throttle = Throttle.from_config(conf)
 
-        metadata, islink = process_path(path)
-        output.append(metadata)
+walker = DirectoryWalker(spots, moles_mapping, metrics=metrics, pruner=Pruner.from_config(conf, spots),
+                         throttle=throttle)
 
-        # Map directories below link points. Different to followlinks = True above as islink is more selective.
-        if islink:
-            for link_root, link_dirs, link_files in os.walk(path, followlinks=True):
+with metrics.stage("walk"):
+    output, readmes = walker.walk(SCAN_DIR)
 
-                # Check for 00README
-                if "00README" in link_files:
-                    with open(os.path.join(link_root, "00README")) as reader:
-                        content = reader.read()
-                    readmes[link_root] = content.decode('utf-8','ignore').encode("utf-8")
+metrics.incr("directories", len(output))
+metrics.incr("readmes", len(readmes))
 
-                for d in link_dirs:
-                    in_link_path = os.path.join(link_root, d)
+print ("Pruned directories: {}".format(walker.pruned))
+print ("Links into other spots: {}".format(len(walker.link_stubs)))
 
-                    metadata, islink = process_path(in_link_path)
-                    output.append(metadata)
+if throttle:
+    print ("Throttle backed off {} times. Final listing threads: {} Final rate: {}".format(
+        throttle.decreases, throttle.concurrency, "{:.1f}/s".format(throttle.rate.value) if throttle.rate else "none"))
+    metrics.incr("throttle_decreases", throttle.decreases)
 
 # Process readmes
 print ("Number of readmes: {}".format(len(readmes)))
 
 # Write output file
 print ("Writing output...")
-output_filename = os.path.join(OUTPUT_DIR, spots.get_spot(SCAN_DIR) + "_directories.txt")
-with open(output_filename, "w") as writer:
-    writer.writelines(map(lambda x: json.dumps(x)+"\n", output))
-
-# Write readme output
-output_filename = os.path.join(OUTPUT_DIR, spots.get_spot(SCAN_DIR) + "_readmes.json")
-with open(output_filename, "w") as writer:
-    writer.writelines(json.dumps(readmes))
+with metrics.stage("write_output"):
+    output_filename = os.path.join(OUTPUT_DIR, spots.get_spot(SCAN_DIR) + "_directories.txt")
+    with open(output_filename, "w") as writer:
+        writer.writelines(map(lambda x: json.dumps(x)+"\n", output))
+
+    # Write readme output
+    output_filename = os.path.join(OUTPUT_DIR, spots.get_spot(SCAN_DIR) + "_readmes.json")
+    with open(output_filename, "w") as writer:
+        writer.writelines(json.dumps(readmes))
+
+    # Write links into other spots. Expanded by index_dirs
+    output_filename = os.path.join(OUTPUT_DIR, spots.get_spot(SCAN_DIR) + "_link_stubs.ndjson")
+    with open(output_filename, "w") as writer:
+        writer.writelines(map(lambda x: json.dumps(x) + "\n", walker.link_stubs))
+
+metrics.write()
@@ -10,6 +10,7 @@ Date: 10 August 2018
 ########################################################################################################################
 
 Reads directory containing output from generate_dirs_from_spot and creates a unique set of directories.
+Links into other spots are expanded by copying the target spot's records below the link.
 This set is filtered for items which do not have moles metadata e.g. title and this list is dumped to file for further processing
 
 The remainder is uploaded to elasticsearch.
@@ -27,6 +28,7 @@ __license__ = "BSD - see LICENSE file in top-level package directory"
 __contact__ = "richard.d.smith@stfc.ac.uk"
 
 import argparse
+import sys
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 import os
@@ -34,11 +36,19 @@ from tqdm import tqdm
 import json
 import hashlib
 from ConfigParser import ConfigParser
+from utils.metrics import Metrics
+from utils.bulk_export import BulkFileWriter
+from utils.readme_reader import clear_digests
+from utils.link_stubs import read_link_stubs, resolve_link_stubs, expand_link_stubs
 
 import multiprocessing as mp
 
 parser = argparse.ArgumentParser(description='Collect all dirs together and submit to elasticsearch')
 parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--index", dest="index", help="Index to write to. Default: es-index from the config file")
+parser.add_argument("--export-dir", dest="export_dir",
+                    help="Write _bulk files to this directory instead of sending them to elasticsearch")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
 
 #################################################
 #                                               #
@@ -67,6 +77,7 @@ def load_file(file):
 
     return tree
 
+
 #################################################
 #                                               #
 #                End of Functions               #
@@ -78,7 +89,9 @@ conf = ConfigParser()
 conf.read(args.config)
 
 INPUT_DIR = conf.get("files", "processing-directory")
-ES_INDEX = conf.get("elasticsearch", "es-index")
+ES_INDEX = args.index or conf.get("elasticsearch", "es-index")
+
+metrics = Metrics.from_config("index_dirs", conf, profile=args.profile)
 
 # List input files
 print("Listing dirs...")
@@ -87,19 +100,33 @@ file_list = os.listdir(INPUT_DIR)
 # filter file list
 print("Filtering files...")
 file_list = [x for x in file_list if x.endswith(".txt")]
+metrics.incr("input_files", len(file_list))
 
 # Create set to hold dirs
 full_tree = set()
 
-pool = mp.Pool(processes=6)
+with metrics.stage("load"):
+    pool = mp.Pool(processes=6)
 
-# Find unique dirs
-r = pool.map(load_file, tqdm(file_list, desc="Loading directories"), chunksize=20)
-pool.close()
-pool.join()
+    # Find unique dirs
+    r = pool.map(load_file, tqdm(file_list, desc="Loading directories"), chunksize=20)
+    pool.close()
+    pool.join()
+
+with metrics.stage("dedup"):
+    for result in tqdm(r,desc="Processing results"):
+        metrics.incr("input_lines", len(result))
+        full_tree.update(result)
+
+# Copy the records of the spots which are linked to below the links
+with metrics.stage("expand_links"):
+    stubs = resolve_link_stubs(read_link_stubs(INPUT_DIR))
+    expanded = expand_link_stubs(stubs, INPUT_DIR, metrics=metrics, progress=tqdm)
+    full_tree.update(expanded)
 
-for result in tqdm(r,desc="Processing results"):
-    full_tree.update(result)
+print("Link stubs: {} Expanded directories: {}".format(len(stubs), len(expanded)))
+metrics.incr("link_stubs", len(stubs))
+metrics.incr("expanded_directories", len(expanded))
 
 
 
@@ -116,26 +143,55 @@ print("No. dirs: {}".format(len(full_tree)))
 missing_metadata = []
 complete = []
 
-for dir in tqdm(full_tree, desc="Filtering for missing metadata"):
-    if '"title": "' not in dir and '"depth": 1,' not in dir:
-        missing_metadata.append(dir)
-    else:
-        complete.append(dir)
+with metrics.stage("filter"):
+    for dir in tqdm(full_tree, desc="Filtering for missing metadata"):
+        if '"title": "' not in dir and '"depth": 1,' not in dir:
+            missing_metadata.append(dir)
+        else:
+            complete.append(dir)
 
 print("Complete: {} Missing: {}".format(len(complete), len(missing_metadata)))
+metrics.incr("directories", len(full_tree))
+metrics.incr("complete", len(complete))
+metrics.incr("missing_metadata", len(missing_metadata))
 
 print("Writing dirs missing metadata to file...")
-with open(conf.get("files", "missing-metadata-file"), 'w') as missing_file:
-    for item in missing_metadata:
-        missing_file.write(item + '\n')
-
-# Push complete results to elasticsearch
-# Setup elasticsearch connection
-es = Elasticsearch([conf.get("elasticsearch", "es-host")],
-                   http_auth=(conf.get("elasticsearch", "es-user"),
-                              conf.get("elasticsearch", "es-password")
-                              )
-                   )
-
-# Upload to elasticsearch
-bulk(es, gendata(complete))
+with metrics.stage("write_missing"):
+    with open(conf.get("files", "missing-metadata-file"), 'w') as missing_file:
+        for item in missing_metadata:
+            missing_file.write(item + '\n')
+
+# The documents are replaced without their README so update_readmes has to send every README again
+clear_digests(conf, ES_INDEX)
+
+if args.export_dir:
+    # Write the bulk requests to file to be loaded later with load_bulk_files
+    with metrics.stage("bulk_export"):
+        with BulkFileWriter.from_config(args.export_dir, "dirs", conf) as writer:
+            writer.write_all(gendata(complete))
+
+    print("Exported: {} Files: {}".format(writer.actions, len(writer.files)))
+    metrics.incr("exported", writer.actions)
+
+else:
+    # Push complete results to elasticsearch
+    # Setup elasticsearch connection
+    es = Elasticsearch([conf.get("elasticsearch", "es-host")],
+                       http_auth=(conf.get("elasticsearch", "es-user"),
+                                  conf.get("elasticsearch", "es-password")
+                                  )
+                       )
+
+    # Upload to elasticsearch
+    with metrics.stage("bulk_index"):
+        success, errors = bulk(es, gendata(complete), raise_on_error=False)
+
+    metrics.incr("indexed", success)
+    metrics.incr("index_errors", len(errors))
+
+metrics.write()
+
+# Fail the job so cron and rebuild_index.py see the failed writes
+if metrics.counters.get("index_errors"):
+    print("{} documents failed".format(metrics.counters["index_errors"]))
+    sys.exit(1)
@@ -32,17 +32,28 @@ __license__ = "BSD - see LICENSE file in top-level package directory"
 __contact__ = "richard.d.smith@stfc.ac.uk"
 
 import argparse
-import requests
+import sys
 import json
-import os
 from tqdm import tqdm
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 import hashlib
 from ConfigParser import ConfigParser
+from utils.moles_attribution import MolesAttributor
+from utils.metrics import Metrics
+from utils.moles_journal import MolesJournal, JournalledMapping, journal_from_config
+from utils.moles_snapshot import load_moles_mapping
+from utils.bulk_export import BulkFileWriter
+from utils.readme_reader import clear_digests
 
 parser = argparse.ArgumentParser(description="Load dirs missing metadata and try to add metadata to them")
 parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--index", dest="index", help="Index to write to. Default: es-index from the config file")
+parser.add_argument("--max-depth", dest="max_depth", type=int,
+                    help="Deepest directory level to attribute. Default: keep going until all levels are checked")
+parser.add_argument("--export-dir", dest="export_dir",
+                    help="Write _bulk files to this directory instead of sending them to elasticsearch")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
 
 
 #################################################
@@ -52,38 +63,8 @@ parser.add_argument("--config", dest="config", help="Path to configuration file"
 #################################################
 
 
-def filter_list(list, filter_key):
-    """
-    Filters list in place and returns the selected items
-
-    :param list: input list to filter in place
-    :param filter_key: key to select for extraction
-
-    :return: list of selected data
-    """
-
-    selection = []
-
-    for item in tqdm(list, desc="Filtering list on depth"):
-        if filter_key in item:
-            selection.append(item)
-
-    return selection
-
-
-def get_moles_record_meta(dir, mapping):
-    while len(dir) > 1:
-        if dir in mapping:
-            return mapping[dir]
-        elif dir + "/" in mapping:
-            return mapping[dir + "/"]
-        else:
-            dir = os.path.dirname(dir)
-
-
 def gendata(input):
     for item in tqdm(input, desc="Building elasticserch index"):
-        item = json.loads(item)
         path = item['path']
         id = hashlib.sha1(path).hexdigest()
         yield {
@@ -106,105 +87,79 @@ conf = ConfigParser()
 conf.read(args.config)
 
 INPUT_FILE = conf.get("files", "missing-metadata-file")
-ES_INDEX = conf.get("elasticsearch", "es-index")
+ES_INDEX = args.index or conf.get("elasticsearch", "es-index")
 MISSING_MOLES_MAP = conf.get("files", "moles-mapping")
 
-# Read the input file
-with open(INPUT_FILE) as missing:
-    data = missing.readlines()
-
-# Remove newline characters
-data = [d.strip() for d in data]
+metrics = Metrics.from_config("index_missing_metadata", conf, profile=args.profile)
 
 # Setup
-if MISSING_MOLES_MAP:
-    with open(MISSING_MOLES_MAP) as reader:
-        mapping = json.load(reader)
-else:
-    mapping = {}
-
-depth = 1
-url = "https://catalogue.ceda.ac.uk/api/v0/obs/get_info"
-output_list = []
-
-# Navigate top down and try to attribute as many dirs to MOLES catagories as possible
-while depth < 5:
-    if len(data) == 0:
-        break
-
-    sel = filter_list(data, '"depth": {},'.format(depth))
-
-    if depth > 1:
-        # Check to see if there is metadata available from MOLES api
-        for item in tqdm(sel, desc="Gathering metadata for filter results"):
-            item_dict = json.loads(item)
-            item_path = item_dict['path']
-
-            # Check to see if there is data in the mapping already
-            if item_path not in mapping.keys():
-
-                # If not in mapping check the MOLES api
-                r = requests.get(url + item_path)
-                try:
-                    r_json = r.json()
-
-                except ValueError:
-                    continue
-
-                if r_json['title']:
-                    path = item_path
-
-                    mapping[path] = r_json
-
-        # Process the input list using the new mappings to see if the list can be reduced
-        improved_metadata = []
-        remainder = []
-        for item in tqdm(data, desc="Updating metadata based on MOLES meta "):
-            dir_meta = json.loads(item)
-            record = get_moles_record_meta(dir_meta['path'], mapping)
-            if record and record['title']:
-                dir_meta["title"] = record["title"]
-                dir_meta["url"] = record.get("url") if record.get("url") else record.get("uuid")
-                dir_meta["record_type"] = record.get("record_type") if record.get("record_type") else record.get("type")
-
-                improved_metadata.append(dir_meta)
-            else:
-                remainder.append(item)
+with metrics.stage("load_moles_mapping"):
+    if MISSING_MOLES_MAP:
+        journal = MolesJournal(journal_from_config(conf))
+        mapping = JournalledMapping(load_moles_mapping(MISSING_MOLES_MAP), journal.read())
+    else:
+        journal = None
+        mapping = {}
 
-        # Add improved list of metadata to output_list
-        output_list.extend(improved_metadata)
+attributor = MolesAttributor(mapping=mapping, max_depth=args.max_depth, metrics=metrics)
 
-        # reset data list to just the remaining files
-        data = remainder
+# Build the tree of missing directories once
+with metrics.stage("build_tree"):
+    with open(INPUT_FILE) as missing:
+        attributor.build(tqdm(missing, desc="Building directory tree"))
 
+# Navigate top down and try to attribute as many dirs to MOLES catagories as possible
+with metrics.stage("attribute"):
+    attributor.run(progress=tqdm)
 
-    else:
-        # When only 1 deep, there is no MOLES information leave this blank
-        output_list.extend(sel)
+output_list = [dir_meta for dir_meta, attributed in attributor.records()]
+remainder = attributor.remainder()
 
-    # Try the next level
-    depth += 1
+print("Improved coverage: {} Missing Metadata: {}".format(len(output_list) - len(remainder), len(remainder)))
+metrics.incr("directories", len(output_list))
+metrics.incr("attributed", len(output_list) - len(remainder))
+metrics.incr("missing_metadata", len(remainder))
 
-print("Improved coverage: {} Missing Metadata: {}".format(len(output_list), len(remainder)))
+print("Writing new MOLES records to the journal...")
+with metrics.stage("write_output"):
+    if journal:
+        metrics.incr("journal_records", journal.append(attributor.new_records))
 
-# Add the remainder to the output to index
-output_list.extend(data)
+    # Output remaining data to a file
+    with open("reduced_missing.txt", 'w') as output:
+        for item in remainder:
+            output.write(json.dumps(item) + '\n')
 
-print("Writing mapping to file...")
-with open('missing_moles_mapping.json', 'w') as writer:
-    writer.write(json.dumps(mapping))
+# The documents are replaced without their README so update_readmes has to send every README again
+clear_digests(conf, ES_INDEX)
 
-# Output remaining data to a file
-with open("reduced_missing.txt", 'w') as output:
-    for line in remainder:
-        output.write(line + '\n')
+if args.export_dir:
+    # Write the bulk requests to file to be loaded later with load_bulk_files
+    with metrics.stage("bulk_export"):
+        with BulkFileWriter.from_config(args.export_dir, "missing_metadata", conf) as writer:
+            writer.write_all(gendata(output_list))
 
-# Push complete results to elasticsearch
-# Setup elasticsearch connection
-es = Elasticsearch([conf.get("elasticsearch", "es-host")],
-                   http_auth=(conf.get("elasticsearch", "es-user"),
-                              conf.get("elasticsearch", "es-password")
-                              )
-                   )
+    print("Exported: {} Files: {}".format(writer.actions, len(writer.files)))
+    metrics.incr("exported", writer.actions)
 
-bulk(es, gendata(output_list))
+else:
+    # Push complete results to elasticsearch
+    # Setup elasticsearch connection
+    es = Elasticsearch([conf.get("elasticsearch", "es-host")],
+                       http_auth=(conf.get("elasticsearch", "es-user"),
+                                  conf.get("elasticsearch", "es-password")
+                                  )
+                       )
+
+    with metrics.stage("bulk_index"):
+        success, errors = bulk(es, gendata(output_list), raise_on_error=False)
+
+    metrics.incr("indexed", success)
+    metrics.incr("index_errors", len(errors))
+
+metrics.write()
+
+# Fail the job so cron and rebuild_index.py see the failed writes
+if metrics.counters.get("index_errors"):
+    print("{} documents failed".format(metrics.counters["index_errors"]))
+    sys.exit(1)
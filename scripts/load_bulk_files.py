@@ -0,0 +1,249 @@
+"""
+########################################################################################################################
+
+LOAD BULK FILES
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Replay the _bulk NDJSON files written by index_dirs, index_missing_metadata and update_readmes with --export-dir.
+
+Each file is sent as a single _bulk request and files are loaded in parallel. The stages are loaded in order so that
+the directories exist before their READMEs are added. Items rejected because the cluster is busy are sent again and
+a file is only acknowledged once every item has been accepted. Every acknowledged file is recorded in loaded.manifest in the
+export directory and skipped on the next run, so an interrupted load resumes from where it stopped. The document ids
+are deterministic so sending a file twice is harmless.
+
+Usage:
+
+    load_bulk_files.py --config <config> --input <export_dir> [--index <index>] [--threads <n>]
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import os
+import sys
+import json
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from elasticsearch.exceptions import ConnectionError, TransportError
+from tqdm import tqdm
+from ConfigParser import ConfigParser
+from utils.index_tools import get_elasticsearch
+from utils.bulk_export import list_bulk_files, read_bulk_file, set_index, split_actions
+from utils.metrics import Metrics
+
+parser = argparse.ArgumentParser(description="Load exported _bulk files into elasticsearch")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--input", dest="input", help="Directory containing the exported files", required=True)
+parser.add_argument("--index", dest="index", help="Index to load into. Default: the index recorded in the files")
+parser.add_argument("--threads", dest="threads", type=int, default=4, help="Number of files to send at once")
+parser.add_argument("--retries", dest="retries", type=int, default=5,
+                    help="Number of times to retry a file, or the items in it, when the cluster is unavailable or busy")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+MANIFEST = "loaded.manifest"
+
+# Responses which mean the cluster is busy rather than the request being wrong. Also used for the
+# items of a _bulk response e.g. 429 for es_rejected_execution_exception
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def load_manifest(filename):
+    """
+    :param filename: Manifest file
+    :return: set of file names which have already been acknowledged
+    """
+    loaded = set()
+
+    if not os.path.exists(filename):
+        return loaded
+
+    with open(filename) as reader:
+        for line in reader:
+            try:
+                loaded.add(json.loads(line)["file"])
+            except (ValueError, KeyError):
+                # Partial line from an interrupted write
+                continue
+
+    return loaded
+
+
+def acknowledge(filename, items, errors):
+    """
+    Append a loaded file to the manifest
+    """
+    with manifest_lock:
+        manifest.write(json.dumps({"file": filename, "items": items, "errors": errors}) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+
+def send(body):
+    """
+    Send a _bulk request, backing off while the cluster is unavailable or busy
+
+    :param body: _bulk request body
+    :return: response
+    """
+    attempt = 0
+
+    while True:
+        try:
+            return es.bulk(body=body)
+
+        except TransportError as e:
+            retry = isinstance(e, ConnectionError) or e.status_code in RETRY_STATUS
+            if not retry or attempt >= args.retries:
+                raise
+
+        attempt += 1
+        metrics.incr("retries")
+        time.sleep(min(2 ** attempt, 60))
+
+
+def load_file(filename):
+    """
+    Items rejected because the cluster is busy are sent again with the same back off as the whole
+    request. The file is only acknowledged once every item has been accepted. A file with items which
+    failed for good is reported as failed.
+
+    :param filename: Bulk file name
+    :return: (file name, number of items, number of item errors, error message or None)
+    """
+    items = 0
+    errors = []
+
+    try:
+        body = read_bulk_file(os.path.join(args.input, filename))
+
+        if args.index:
+            body = set_index(body, args.index)
+
+        actions = split_actions(body)
+        attempt = 0
+
+        while True:
+            with metrics.timer("bulk_request"):
+                response = send(b"".join(actions))
+
+            # Items are returned in the order of the actions
+            retry = []
+            for action, item in zip(actions, response.get("items", [])):
+                result = list(item.values())[0]
+
+                if result.get("status") in RETRY_STATUS:
+                    retry.append(action)
+                    continue
+
+                items += 1
+                if result.get("error"):
+                    errors.append(result)
+
+            if not retry:
+                break
+
+            if attempt >= args.retries:
+                return filename, items, len(errors), "{} items still rejected after {} retries".format(
+                    len(retry), attempt)
+
+            attempt += 1
+            actions = retry
+            metrics.incr("item_retries", len(retry))
+            time.sleep(min(2 ** attempt, 60))
+
+    except Exception as e:
+        return filename, 0, 0, str(e)
+
+    for error in errors[:5]:
+        tqdm.write("{} {}: {}".format(filename, error.get("_id"), error.get("error")))
+
+    # Left out of the manifest so the file is sent again once the errors are fixed
+    if errors:
+        return filename, items, len(errors), "{} items failed".format(len(errors))
+
+    acknowledge(filename, items, len(errors))
+
+    return filename, items, len(errors), None
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+metrics = Metrics.from_config("load_bulk_files", conf, profile=args.profile)
+
+es = get_elasticsearch(conf)
+
+manifest_file = os.path.join(args.input, MANIFEST)
+loaded = load_manifest(manifest_file)
+
+manifest_lock = threading.Lock()
+manifest = open(manifest_file, "a")
+
+failed = []
+
+with metrics.stage("load"):
+    pool = ThreadPool(processes=args.threads)
+
+    # Each stage has to be complete before the next one starts
+    for stage_files in list_bulk_files(args.input):
+        todo = [filename for filename in stage_files if filename not in loaded]
+        metrics.incr("skipped_files", len(stage_files) - len(todo))
+
+        if not todo:
+            continue
+
+        for filename, items, errors, failure in tqdm(pool.imap_unordered(load_file, todo),
+                                                     total=len(todo), desc="Loading bulk files"):
+            if failure:
+                tqdm.write("Failed to load {}: {}".format(filename, failure))
+                failed.append(filename)
+                metrics.incr("item_errors", errors)
+                continue
+
+            metrics.incr("files")
+            metrics.incr("items", items)
+
+        # Later stages depend on this one
+        if failed:
+            break
+
+    pool.close()
+    pool.join()
+
+manifest.close()
+
+print("Loaded: {} Already loaded: {} Failed: {}".format(
+    metrics.counters.get("files", 0),
+    metrics.counters.get("skipped_files", 0),
+    len(failed)
+))
+
+metrics.write()
+
+if failed:
+    sys.exit(1)
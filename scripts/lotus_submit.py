@@ -41,6 +41,8 @@ import os
 import subprocess
 import requests
 from ConfigParser import ConfigParser
+from utils.metrics import Metrics
+from utils.moles_snapshot import load_moles_mapping
 
 parser = argparse.ArgumentParser(description="Submit script to lotus")
 
@@ -48,6 +50,8 @@ parser = argparse.ArgumentParser(description="Submit script to lotus")
 parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
 parser.add_argument('--generate-dirs', dest='generate_dirs', action='store_true')
 parser.add_argument('--dev', dest='dev', action='store_true')
+parser.add_argument('--profile', dest='profile', action='store_true',
+                    help="Capture cProfile output for each stage. Passed on to the submitted jobs")
 
 #################################################
 #                                               #
@@ -99,6 +103,8 @@ config.read(args.config)
 
 OUTPUT_DIR = config.get("files","processing-directory")
 
+metrics = Metrics.from_config("lotus_submit", config, profile=args.profile)
+
 if not os.path.isdir(OUTPUT_DIR):
     print("Output dir does not exist")
     exit()
@@ -117,14 +123,29 @@ else:
 # Use generate dir script
 if args.generate_dirs:
     print ("Generating spot mapping...")
-    download_spot_mapping()
+    with metrics.stage("download_spot_mapping"):
+        download_spot_mapping()
+
+    # Compile the MOLES mapping snapshot once so the jobs do not race to build it
+    print ("Compiling MOLES mapping snapshot...")
+    with metrics.stage("compile_moles_mapping"):
+        load_moles_mapping('moles_catalogue_mapping.json').close()
 
     print ("Processing spot mapping paths...")
     input_paths = get_spot_paths()
 
+    # Options passed on to each job
+    job_options = " --config {}".format(os.path.abspath(args.config))
+    if metrics.report_dir:
+        job_options += " --metrics-dir {}".format(metrics.report_dir)
+    if args.profile:
+        job_options += " --profile"
+
     for path in input_paths:
-        cmd = "python {script} {input_path} {output_dir}".format(script=SCRIPT, input_path=path,
-                                                                 output_dir=OUTPUT_DIR)
+        cmd = "python {script} {input_path} {output_dir}{options}".format(script=SCRIPT, input_path=path,
+                                                                          output_dir=OUTPUT_DIR,
+                                                                          options=job_options)
+        metrics.incr("jobs")
         if args.dev:
             print (cmd)
             subprocess.call(cmd, shell=True)
@@ -132,4 +153,5 @@ if args.generate_dirs:
         else:
             subprocess.call("bsub -q short-serial -e errors/%J.err -W 24:00 {}".format(cmd), shell=True)
 
+metrics.write()
 
@@ -0,0 +1,140 @@
+"""
+########################################################################################################################
+
+PATH INDEX
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Build and query an on-disk sorted path index of the output from generate_dirs_from_spot. Shows what the browser
+will show for a directory without querying elasticsearch or searching the directory listings.
+
+Usage:
+
+    path_index.py --config <config> [--index <name>] build
+    path_index.py --config <config> [--index <name>] children <path>
+    path_index.py --config <config> [--index <name>] get <path>
+    path_index.py --config <config> [--index <name>] count <path>
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import os
+import sys
+import json
+from tqdm import tqdm
+from ConfigParser import ConfigParser
+from utils.path_index import PathIndex, build_path_index
+from utils.link_stubs import read_link_stubs, resolve_link_stubs, expand_link_stubs
+from utils.metrics import Metrics
+
+parser = argparse.ArgumentParser(description="Build and query the sorted path index")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--index", dest="index",
+                    help="Path index name. Default: path_index in the processing directory")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+commands = parser.add_subparsers(dest="command")
+commands.add_parser("build", help="Build the index from the directory listings in the processing directory")
+
+children_parser = commands.add_parser("children", help="List the directories directly below a path")
+children_parser.add_argument("path")
+children_parser.add_argument("--records", dest="records", action="store_true", help="Print the full records")
+
+get_parser = commands.add_parser("get", help="Print the record for a path")
+get_parser.add_argument("path")
+
+count_parser = commands.add_parser("count", help="Count the directories below a path")
+count_parser.add_argument("path")
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def listing():
+    """
+    Read the output of generate_dirs_from_spot from the processing directory. The records of linked spots
+    are copied below the links into them, as in index_dirs.
+
+    :return: generator of directory record JSON strings
+    """
+    file_list = [x for x in os.listdir(INPUT_DIR) if x.endswith(".txt")]
+
+    for file in tqdm(file_list, desc="Reading directory listings"):
+        with open(os.path.join(INPUT_DIR, file)) as reader:
+            for line in reader:
+                yield line
+
+    stubs = resolve_link_stubs(read_link_stubs(INPUT_DIR))
+    for line in expand_link_stubs(stubs, INPUT_DIR, progress=tqdm):
+        yield line
+
+
+def output(text):
+    """
+    Print a path or record. Python 2 cannot print non-ASCII unicode when the output is a pipe
+
+    :param text: Text to print
+    """
+    if not isinstance(text, str):
+        text = text.encode("utf-8")
+    print(text)
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+INPUT_DIR = conf.get("files", "processing-directory")
+INDEX = args.index or os.path.join(INPUT_DIR, "path_index")
+
+if args.command == "build":
+    metrics = Metrics.from_config("path_index", conf, profile=args.profile)
+
+    with metrics.stage("build"):
+        count = build_path_index(listing(), INDEX, tmp_dir=conf.get("files", "status-directory"))
+
+    print("Indexed {} paths in {}".format(count, INDEX))
+    metrics.incr("paths", count)
+    metrics.write()
+
+elif args.command in ("children", "get", "count"):
+    index = PathIndex(INDEX)
+
+    if args.command == "children":
+        for path, record in index.list_children(args.path):
+            output(record if args.records else path)
+
+    elif args.command == "get":
+        record = index.get_path(args.path)
+        if record is None:
+            print("Not found: {}".format(args.path))
+            sys.exit(1)
+
+        print(json.dumps(record, indent=4, sort_keys=True))
+
+    else:
+        print(index.subtree_count(args.path))
+
+    index.close()
+
+else:
+    parser.print_help()
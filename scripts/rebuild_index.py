@@ -0,0 +1,148 @@
+"""
+########################################################################################################################
+
+REBUILD INDEX
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Full rebuild of the directory index without downtime.
+
+A new timestamped index is created with refresh disabled and no replicas. The indexing stages are run into it:
+
+    index_dirs.py
+    index_missing_metadata.py
+    update_readmes.py
+
+Each stage exits with a non-zero status if any document fails to index. A failed stage stops the build and the alias
+is not changed.
+
+Once complete the normal settings are restored, the index is force merged and the es-index alias is switched to it in a
+single atomic operation. Older rebuilt indices are kept for rollback up to the configured count.
+
+The output of generate_dirs_from_spot must already be in the processing directory.
+
+Usage:
+
+    rebuild_index.py --config <config> [--no-swap]
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import os
+import sys
+import subprocess
+from ConfigParser import ConfigParser
+from utils.index_tools import get_elasticsearch, create_build_index, finalise_build_index, swap_alias, \
+    prune_build_indices, DIRS_MAPPING
+from utils.metrics import Metrics
+
+parser = argparse.ArgumentParser(description="Rebuild the directory index into a new index and switch the alias")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--no-swap", dest="no_swap", action="store_true",
+                    help="Build and finalise the new index but leave the alias where it is")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = [
+    "index_dirs.py",
+    "index_missing_metadata.py",
+    "update_readmes.py"
+]
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def get_option(section, option, default):
+    if conf.has_option(section, option):
+        return conf.get(section, option)
+    return default
+
+
+def run_stage(script, index):
+    """
+    Run an indexing stage against the new index
+
+    :param script:  Script file name
+    :param index:   Index to write to
+    """
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, script), "--config", args.config, "--index", index]
+    if args.profile:
+        cmd.append("--profile")
+
+    print(" ".join(cmd))
+    subprocess.check_call(cmd)
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+ALIAS = conf.get("elasticsearch", "es-index")
+KEEP = int(get_option("rebuild", "keep-indices", 2))
+REPLICAS = int(get_option("rebuild", "replicas", 1))
+REFRESH_INTERVAL = get_option("rebuild", "refresh-interval", "1s")
+
+metrics = Metrics.from_config("rebuild_index", conf, profile=args.profile)
+
+es = get_elasticsearch(conf)
+
+with metrics.stage("create_index"):
+    INDEX = create_build_index(es, ALIAS, body=DIRS_MAPPING)
+
+print("Building {}".format(INDEX))
+
+try:
+    # A stage with failed documents exits non-zero, so a partial index is never swapped in
+    for stage in STAGES:
+        with metrics.stage(os.path.splitext(stage)[0]):
+            run_stage(stage, INDEX)
+
+except subprocess.CalledProcessError as e:
+    print("Stage failed: {}. {} has been left in place and the alias has not been changed".format(e, INDEX))
+    metrics.incr("failed_builds")
+    metrics.write()
+    sys.exit(1)
+
+print("Restoring settings and merging {}...".format(INDEX))
+with metrics.stage("finalise_index"):
+    finalise_build_index(es, INDEX, replicas=REPLICAS, refresh_interval=REFRESH_INTERVAL)
+
+if args.no_swap:
+    print("Alias not changed. {} is ready".format(INDEX))
+
+else:
+    with metrics.stage("swap_alias"):
+        previous = swap_alias(es, ALIAS, INDEX)
+
+    print("{} now points to {}. Previously: {}".format(ALIAS, INDEX, ", ".join(previous) or "none"))
+
+    with metrics.stage("prune_indices"):
+        deleted = prune_build_indices(es, ALIAS, KEEP)
+
+    for index in deleted:
+        print("Deleted old index: {}".format(index))
+
+    metrics.incr("deleted_indices", len(deleted))
+
+metrics.write()
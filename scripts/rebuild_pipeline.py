@@ -0,0 +1,434 @@
+"""
+########################################################################################################################
+
+REBUILD PIPELINE
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Full rebuild of the directory index in a single process, without writing and re-reading the intermediate files
+used by the multi-step build. Records stream through the stages:
+
+    walk        spots are walked by a pool of processes
+    dedup       repeated paths are dropped using the sha1 digest of the path
+    readmes     00README content is added to the directory record
+    attribute   directories missing MOLES metadata are attributed once the walk is complete
+    index       records are sent with parallel_bulk while the walk continues
+
+Each spot's records are kept in a listing in the spill directory, or a temporary directory in the status directory,
+so links into other spots can be expanded from them once the spots have been walked, as in index_dirs.
+
+By default a new timestamped index is built and the es-index alias is switched to it, as with rebuild_index.py.
+
+Wall time and peak memory are printed alongside those of the multi-step build, taken from the run reports in the
+metrics report directory.
+
+Usage:
+
+    rebuild_pipeline.py --config <config> [--index <index> | --export-dir <dir>] [--no-swap]
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import os
+import json
+import time
+import sys
+import shutil
+import hashlib
+import tempfile
+import multiprocessing as mp
+from tqdm import tqdm
+from ConfigParser import ConfigParser
+from elasticsearch.helpers import parallel_bulk
+from ceda_elasticsearch_tools.core.log_reader import SpotMapping
+from utils.index_tools import get_elasticsearch, create_build_index, finalise_build_index, swap_alias, \
+    prune_build_indices, DIRS_MAPPING
+from utils.metrics import Metrics
+from utils.moles_attribution import MolesAttributor
+from utils.moles_journal import MolesJournal, load_journalled_mapping, journal_from_config
+from utils.bulk_export import BulkFileWriter
+from utils.link_stubs import resolve_link_stubs, expand_link_stubs, LISTING_SUFFIX
+from utils.pruning import Pruner
+from utils.throttle import Throttle
+from utils.walker import DirectoryWalker
+
+parser = argparse.ArgumentParser(description="Walk the spots and build the directory index in a single pipeline")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--index", dest="index",
+                    help="Write to this existing index. Default: build a new index and switch the alias to it")
+parser.add_argument("--export-dir", dest="export_dir",
+                    help="Write _bulk files to this directory instead of sending them to elasticsearch")
+parser.add_argument("--no-swap", dest="no_swap", action="store_true",
+                    help="Build and finalise the new index but leave the alias where it is")
+parser.add_argument("--processes", dest="processes", type=int, default=mp.cpu_count(),
+                    help="Number of spots to walk at once. Default: number of CPUs")
+parser.add_argument("--threads", dest="threads", type=int, default=4,
+                    help="Number of bulk requests to send at once. Default: 4")
+parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=500,
+                    help="Number of documents in each bulk request. Default: 500")
+parser.add_argument("--spill-dir", dest="spill_dir",
+                    help="Write directories missing MOLES metadata to this directory during the walk rather than "
+                         "holding them in memory. The spot listings used to expand links are also kept here. "
+                         "Default: a temporary directory in the status directory")
+parser.add_argument("--max-depth", dest="max_depth", type=int,
+                    help="Deepest directory level to attribute. Default: keep going until all levels are checked")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+# Jobs which make up the multi-step build. generate_dirs runs as one job per spot
+MULTI_STEP_JOBS = ["index_dirs", "index_missing_metadata", "update_readmes"]
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def get_option(section, option, default):
+    if conf.has_option(section, option):
+        return conf.get(section, option)
+    return default
+
+
+def get_spot_paths(filename):
+    paths = []
+    with open(filename) as reader:
+        for line in reader:
+            if line.strip():
+                paths.append(line.strip().split('=', 1)[1])
+
+    return paths
+
+
+def walk_spot(scan_dir):
+    """
+    Walk a spot. Run in the pool processes.
+
+    :param scan_dir: Spot directory
+    :return: (spot, directory metadata, readmes, link stubs, walker counters, seconds)
+    """
+    start = time.time()
+
+    scan_dir = scan_dir.rstrip('/')
+    walker = DirectoryWalker(SPOTS, MOLES_MAPPING, pruner=PRUNER, throttle=THROTTLE)
+    output, readmes = walker.walk(scan_dir)
+
+    # The walker's counters include pruned_dirs
+    return SPOTS.get_spot(scan_dir), output, readmes, walker.link_stubs, walker.metrics.counters, time.time() - start
+
+
+def walk(pool, listing_dir):
+    """
+    Walk the spots, adding readmes to the records as they arrive. Each spot's records are also written to
+    <spot>_directories.txt in listing_dir so that, once every spot has been walked, the records below link
+    targets can be copied below the links into them as in index_dirs.
+
+    :param pool:        multiprocessing Pool
+    :param listing_dir: Directory to keep the spot listings in
+    :return: generator of directory metadata
+    """
+    stubs = []
+    results = pool.imap_unordered(walk_spot, SPOT_PATHS)
+
+    for spot, output, readmes, link_stubs, counters, seconds in tqdm(results, total=len(SPOT_PATHS),
+                                                                   desc="Walking spots"):
+        metrics.observe("walk_spot", seconds)
+        for name, value in counters.items():
+            metrics.incr(name, value)
+
+        stubs.extend(link_stubs)
+
+        with open(os.path.join(listing_dir, spot + LISTING_SUFFIX), "a") as listing:
+            for record in output:
+                listing.write(json.dumps(record) + "\n")
+
+                if record["path"] in readmes:
+                    record["readme"] = readmes[record["path"]]
+                    metrics.incr("readmes")
+
+                yield record
+
+    # Links into other spots, once every spot has been walked
+    for line in expand_link_stubs(resolve_link_stubs(stubs), listing_dir, metrics=metrics, progress=tqdm):
+        metrics.incr("expanded_directories")
+        yield json.loads(line)
+
+
+def dedup(records):
+    """
+    Drop repeated paths. Only the 20 byte digest of each path is kept.
+
+    :param records: iterable of directory metadata
+    :return: generator of (document id, directory metadata)
+    """
+    seen = set()
+
+    for record in records:
+        metrics.incr("input_records")
+        digest = hashlib.sha1(record["path"])
+        key = digest.digest()
+
+        if key in seen:
+            continue
+        seen.add(key)
+
+        yield digest.hexdigest(), record
+
+
+def attribute(records):
+    """
+    Pass on the records which have MOLES metadata as they arrive. The rest are attributed once the walk
+    is complete, as the tree is attributed from the top down.
+
+    :param records: iterable of (document id, directory metadata)
+    :return: generator of (document id, directory metadata)
+    """
+    attributor = MolesAttributor(mapping=MOLES_MAPPING, max_depth=args.max_depth, metrics=metrics)
+    spill = None
+
+    if args.spill_dir:
+        spill = open(os.path.join(args.spill_dir, "missing_metadata_{}.txt".format(os.getpid())), "w+")
+
+    for id, record in records:
+        if record.get("title") or record["depth"] == 1:
+            metrics.incr("complete")
+            yield id, record
+
+        elif spill:
+            spill.write(json.dumps(record) + "\n")
+        else:
+            attributor.add(record)
+
+    if spill:
+        spill.seek(0)
+        attributor.build(spill)
+        spill.close()
+        os.remove(spill.name)
+
+    metrics.incr("missing_metadata", len(attributor.nodes))
+
+    with metrics.stage("attribute"):
+        attributor.run(progress=tqdm)
+
+    if JOURNAL:
+        metrics.incr("journal_records", JOURNAL.append(attributor.new_records))
+
+    for dir_meta, attributed in attributor.records():
+        if attributed:
+            metrics.incr("attributed")
+        yield hashlib.sha1(dir_meta["path"]).hexdigest(), dir_meta
+
+    # Kept for the next pass, as with index_missing_metadata
+    with open("reduced_missing.txt", 'w') as output:
+        for item in attributor.remainder():
+            output.write(json.dumps(item) + '\n')
+
+
+def gendata(records):
+    for id, record in records:
+        yield {
+            "_index": INDEX,
+            "_type": "dir",
+            "_id": id,
+            "_source": record
+        }
+
+
+def load_reports(report_dir):
+    """
+    Load the latest run reports of the multi-step build
+
+    :param report_dir: Metrics report directory
+    :return: (list of generate_dirs reports, list of reports for the later steps)
+    """
+    generate, steps = [], []
+
+    if not report_dir or not os.path.isdir(report_dir):
+        return generate, steps
+
+    for file in os.listdir(report_dir):
+        if not file.endswith("_report.json"):
+            continue
+
+        job = file[:-len("_report.json")]
+        if job.startswith("generate_dirs_"):
+            reports = generate
+        elif job in MULTI_STEP_JOBS:
+            reports = steps
+        else:
+            continue
+
+        with open(os.path.join(report_dir, file)) as reader:
+            reports.append(json.load(reader))
+
+    return generate, steps
+
+
+def format_kb(kb):
+    if not kb:
+        return "unknown"
+    return "{:.1f} MB".format(kb / 1024.0)
+
+
+def compare(report):
+    """
+    Print the wall time and peak memory of this run against the multi-step build. The generate_dirs jobs
+    run in parallel so their wall time is from the first start to the last finish.
+
+    :param report: Run report for this run
+    """
+    generate, steps = load_reports(metrics.report_dir)
+
+    print("{:<24}{:>16}{:>20}{:>20}".format("", "Wall time (s)", "Peak memory", "Largest worker"))
+    print("{:<24}{:>16.1f}{:>20}{:>20}".format("pipeline", report["seconds"], format_kb(report["peak_rss_kb"]),
+                                               format_kb(report["children_peak_rss_kb"])))
+
+    if not generate and not steps:
+        print("No multi-step run reports to compare against")
+        return
+
+    total = 0
+
+    if generate:
+        seconds = max(r["end"] for r in generate) - min(r["start"] for r in generate)
+        total += seconds
+        print("{:<24}{:>16.1f}{:>20}".format("generate_dirs ({})".format(len(generate)), seconds,
+                                             format_kb(max(r.get("peak_rss_kb", 0) for r in generate))))
+
+    for r in sorted(steps, key=lambda r: MULTI_STEP_JOBS.index(r["job"])):
+        total += r["seconds"]
+        print("{:<24}{:>16.1f}{:>20}".format(r["job"], r["seconds"], format_kb(r.get("peak_rss_kb"))))
+
+    missing = sorted(set(MULTI_STEP_JOBS) - set(r["job"] for r in steps))
+    if not generate:
+        missing.insert(0, "generate_dirs")
+
+    print("{:<24}{:>16.1f}{:>20}".format("multi-step total", total,
+                                         format_kb(max(r.get("peak_rss_kb", 0) for r in generate + steps))))
+
+    if missing:
+        print("Reports missing for: {}".format(", ".join(missing)))
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+ALIAS = conf.get("elasticsearch", "es-index")
+MOLES_MAP = conf.get("files", "moles-mapping")
+
+# Read before the build so a bad value fails before any work is done. Same defaults as rebuild_index.py
+KEEP = int(get_option("rebuild", "keep-indices", 2))
+REPLICAS = int(get_option("rebuild", "replicas", 1))
+REFRESH_INTERVAL = get_option("rebuild", "refresh-interval", "1s")
+
+# The multi-step reports are read before this run writes its own
+metrics = Metrics.from_config("rebuild_pipeline", conf, profile=args.profile)
+
+# Loaded before the pool is created so the processes share them
+print("Loading spot mapping...")
+with metrics.stage("load_spot_mapping"):
+    SPOTS = SpotMapping(spot_file="spot_mapping.txt")
+    SPOT_PATHS = get_spot_paths("spot_mapping.txt")
+
+print("Loading MOLES mapping...")
+with metrics.stage("load_moles_mapping"):
+    if MOLES_MAP:
+        JOURNAL = MolesJournal(journal_from_config(conf))
+        MOLES_MAPPING = load_journalled_mapping(MOLES_MAP, JOURNAL.filename)
+    else:
+        JOURNAL = None
+        MOLES_MAPPING = {}
+
+PRUNER = Pruner.from_config(conf, SPOTS)
+
+# Each process adjusts its own rate. The shared bucket caps the total
+THROTTLE = Throttle.from_config(conf)
+
+pool = mp.Pool(processes=args.processes)
+
+es = None
+if args.export_dir:
+    INDEX = args.index or ALIAS
+elif args.index:
+    INDEX = args.index
+    es = get_elasticsearch(conf)
+else:
+    es = get_elasticsearch(conf)
+    with metrics.stage("create_index"):
+        INDEX = create_build_index(es, ALIAS, body=DIRS_MAPPING)
+
+print("Building {}".format(INDEX))
+
+LISTING_DIR = tempfile.mkdtemp(prefix="rebuild_pipeline_", dir=args.spill_dir or conf.get("files", "status-directory"))
+
+actions = gendata(attribute(dedup(walk(pool, LISTING_DIR))))
+
+try:
+    with metrics.stage("pipeline"):
+        if args.export_dir:
+            with BulkFileWriter.from_config(args.export_dir, "dirs", conf) as writer:
+                writer.write_all(actions)
+
+            print("Exported: {} Files: {}".format(writer.actions, len(writer.files)))
+            metrics.incr("exported", writer.actions)
+
+        else:
+            for ok, item in parallel_bulk(es, actions, thread_count=args.threads, chunk_size=args.chunk_size,
+                                          raise_on_error=False):
+                metrics.incr("indexed" if ok else "index_errors")
+
+finally:
+    pool.close()
+    pool.join()
+    shutil.rmtree(LISTING_DIR, ignore_errors=True)
+
+print("Directories: {} Complete: {} Missing metadata: {} Attributed: {}".format(
+    metrics.counters.get("input_records", 0), metrics.counters.get("complete", 0),
+    metrics.counters.get("missing_metadata", 0), metrics.counters.get("attributed", 0)))
+
+if metrics.counters.get("index_errors"):
+    print("{} documents failed".format(metrics.counters["index_errors"]))
+    if not args.index:
+        print("{} has been left in place and the alias has not been changed".format(INDEX))
+        metrics.incr("failed_builds")
+
+    metrics.write()
+    sys.exit(1)
+
+if not (args.export_dir or args.index):
+    print("Restoring settings and merging {}...".format(INDEX))
+    with metrics.stage("finalise_index"):
+        finalise_build_index(es, INDEX, replicas=REPLICAS, refresh_interval=REFRESH_INTERVAL)
+
+    if args.no_swap:
+        print("Alias not changed. {} is ready".format(INDEX))
+
+    else:
+        with metrics.stage("swap_alias"):
+            previous = swap_alias(es, ALIAS, INDEX)
+
+        print("{} now points to {}. Previously: {}".format(ALIAS, INDEX, ", ".join(previous) or "none"))
+
+        with metrics.stage("prune_indices"):
+            for index in prune_build_indices(es, ALIAS, KEEP):
+                print("Deleted old index: {}".format(index))
+
+compare(metrics.report())
+metrics.write()
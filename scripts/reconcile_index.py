@@ -0,0 +1,372 @@
+"""
+########################################################################################################################
+
+RECONCILE INDEX
+
+Author: Richard Smith
+Email: richard.d.smith@stfc.ac.uk
+Date: 25 January 2019
+
+########################################################################################################################
+
+Find drift between the directory index and the archive without a full rebuild.
+
+The index is read with sliced scrolls in parallel and compared with a directory listing using a sorted merge join on
+path. Both sides are sorted on disk so memory use is bounded. Only the differences are written out:
+
+    add     - directory exists in the archive but not in the index
+    delete  - document in the index with no directory in the archive
+    update  - MOLES metadata or link information is out of date. Only the changed fields are sent
+
+The listing is either the cached output of generate_dirs_from_spot in the processing directory, a path index built
+from it with path_index.py or a fresh walk of the given spots. The path index is already sorted so it is read directly.
+Links into other spots are expanded from the cached listing, as in index_dirs.
+
+MOLES fields are only compared when the listing has a title. Titles attributed by index_missing_metadata are not in
+the listing and are left alone.
+
+Adds and deletes are only applied with --walk. The cached listing and the path index are from the last
+generate_dirs_from_spot run, so with them only updates are applied.
+
+Usage:
+
+    reconcile_index.py --config <config> [--walk --spot <path> ... | --path-index <name>] [--slices <n>]
+                       [--output <file>] [--apply]
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import os
+import sys
+import json
+import hashlib
+import heapq
+from multiprocessing.pool import ThreadPool
+from elasticsearch.helpers import scan, bulk
+from tqdm import tqdm
+from ConfigParser import ConfigParser
+from utils.index_tools import get_elasticsearch, subtree_query, collapse_to_roots
+from utils.sorting import sort_runs, merge_runs
+from utils.path_index import PathIndex
+from utils.link_stubs import read_link_stubs, resolve_link_stubs, expand_link_stubs
+from utils.metrics import Metrics
+
+parser = argparse.ArgumentParser(description="Compare the directory index with the archive and apply the differences")
+parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--walk", dest="walk", action="store_true",
+                    help="Walk the spots given by --spot instead of using the cached listing in the processing directory")
+parser.add_argument("--path-index", dest="path_index",
+                    help="Use the path index with this name as the listing instead of the cached listing")
+parser.add_argument("--spot", dest="spots", action="append", default=[],
+                    help="Spot root to reconcile. Can be given more than once. Default: whole index")
+parser.add_argument("--slices", dest="slices", type=int, default=4, help="Number of parallel scroll slices")
+parser.add_argument("--output", dest="output", help="File to write the differences to")
+parser.add_argument("--apply", dest="apply", action="store_true",
+                    help="Apply the differences to the index. Adds and deletes are only applied with --walk")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+# Fields the listing owns. Compared between the listing and the index
+COMPARE_FIELDS = ("archive_path", "link", "parent", "ancestors", "sort_key")
+
+# MOLES fields. Only compared when the listing has a title, as titles added by index_missing_metadata are not
+# in the listing
+MOLES_FIELDS = ("title", "url", "record_type")
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def path_key(line):
+    return json.loads(line)['path']
+
+
+def index_query():
+    """
+    :return: query for the documents to reconcile
+    """
+    if not args.spots:
+        return {"query": {"match_all": {}}}
+
+    return {
+        "query": {
+            "bool": {
+                "should": [subtree_query(spot.rstrip('/'))["query"] for spot in args.spots]
+            }
+        }
+    }
+
+
+def scroll_slice(slice_id):
+    """
+    Read one slice of the index and sort it to disk
+
+    :param slice_id: Slice number
+    :return: list of sorted run files
+    """
+    body = index_query()
+    body["_source"] = ["path"] + list(COMPARE_FIELDS + MOLES_FIELDS)
+
+    if args.slices > 1:
+        body["slice"] = {"id": slice_id, "max": args.slices}
+
+    docs = scan(es, index=ES_INDEX, query=body, size=5000)
+
+    return sort_runs((json.dumps(doc["_source"]) for doc in docs), path_key, tmp_dir=TMP_DIR)
+
+
+def expanded_listing(stubs):
+    """
+    Copy the records of linked spots from the cached listing to below the links into them, as in index_dirs
+
+    :param stubs: iterable of link stubs
+    :return: generator of directory metadata JSON strings
+    """
+    for line in expand_link_stubs(resolve_link_stubs(stubs), INPUT_DIR, metrics=metrics, progress=tqdm):
+        if not args.spots or in_spots(path_key(line)):
+            yield line
+
+
+def cached_listing():
+    """
+    Read the output of generate_dirs_from_spot from the processing directory
+
+    :return: generator of directory metadata JSON strings
+    """
+    file_list = [x for x in os.listdir(INPUT_DIR) if x.endswith(".txt")]
+
+    for file in tqdm(file_list, desc="Reading cached listing"):
+        with open(os.path.join(INPUT_DIR, file)) as reader:
+            for line in reader:
+                line = line.strip()
+                if not line:
+                    continue
+
+                if args.spots and not in_spots(path_key(line)):
+                    continue
+
+                yield line
+
+    for line in expanded_listing(read_link_stubs(INPUT_DIR)):
+        yield line
+
+
+def walk_listing():
+    """
+    Walk the spots and generate fresh metadata. Links are followed as in generate_dirs_from_spot, and links into
+    other spots are expanded from the cached listing.
+
+    :return: generator of directory metadata JSON strings
+    """
+    # Imported here as the walk needs the spot and MOLES mappings
+    from utils.path_tools import PathTools
+    from utils.moles_journal import journal_from_config
+    from utils.pruning import Pruner
+    from utils.walker import DirectoryWalker
+
+    pt = PathTools(moles_mapping=conf.get("files", "moles-mapping") or None, metrics=metrics,
+                   moles_journal=journal_from_config(conf))
+
+    walker = DirectoryWalker(pt.spots, pt.moles_mapping or {}, metrics=metrics,
+                             pruner=Pruner.from_config(conf, pt.spots))
+
+    for spot in tqdm(args.spots, desc="Walking spots"):
+        output, readmes = walker.walk(spot.rstrip('/'))
+        for metadata in output:
+            yield json.dumps(metadata)
+
+    for line in expanded_listing(walker.link_stubs):
+        yield line
+
+
+def path_index_listing():
+    """
+    Read the listing from a path index. The index is sorted on path so no sort is needed
+
+    :return: generator of (path, directory metadata JSON string) in path order
+    """
+    index = PathIndex(args.path_index)
+
+    if not args.spots:
+        return index.items()
+
+    # The spot subtrees can interleave e.g. /a, /a-b/c, /a/c so they are merged
+    return heapq.merge(*[index.subtree(spot) for spot in collapse_to_roots(args.spots)])
+
+
+def in_spots(path):
+    for spot in args.spots:
+        spot = spot.rstrip('/')
+        if path == spot or path.startswith(spot + '/'):
+            return True
+    return False
+
+
+def unique(items):
+    """
+    Drop repeated keys from a sorted stream
+
+    :param items: generator of (key, line) in key order
+    """
+    last = None
+    for key, line in items:
+        if key != last:
+            yield key, line
+            last = key
+
+
+def merge_join(listing, index):
+    """
+    Compare two sorted streams on path
+
+    :param listing: generator of (path, line) from the filesystem
+    :param index:   generator of (path, line) from the index
+    :return: generator of difference dictionaries
+    """
+    listing = unique(listing)
+    index = unique(index)
+
+    fs_item = next(listing, None)
+    es_item = next(index, None)
+
+    while fs_item is not None or es_item is not None:
+
+        if es_item is None or (fs_item is not None and fs_item[0] < es_item[0]):
+            yield {"op": "add", "path": fs_item[0], "doc": json.loads(fs_item[1])}
+            fs_item = next(listing, None)
+
+        elif fs_item is None or es_item[0] < fs_item[0]:
+            yield {"op": "delete", "path": es_item[0]}
+            es_item = next(index, None)
+
+        else:
+            fs_doc = json.loads(fs_item[1])
+            es_doc = json.loads(es_item[1])
+
+            fields = COMPARE_FIELDS + MOLES_FIELDS if fs_doc.get("title") else COMPARE_FIELDS
+
+            changes = dict(
+                (field, fs_doc.get(field)) for field in fields if fs_doc.get(field) != es_doc.get(field)
+            )
+            if changes:
+                yield {"op": "update", "path": fs_item[0], "doc": changes}
+
+            fs_item = next(listing, None)
+            es_item = next(index, None)
+
+
+def gendata(diff_file):
+    with open(diff_file) as reader:
+        for line in tqdm(reader, desc="Applying differences"):
+            diff = json.loads(line)
+
+            if diff["op"] not in APPLY_OPS:
+                metrics.incr("not_applied")
+                continue
+
+            action = {
+                "_index": ES_INDEX,
+                "_type": "dir",
+                "_id": hashlib.sha1(diff["path"].encode("utf-8")).hexdigest()
+            }
+
+            if diff["op"] == "add":
+                action["_source"] = diff["doc"]
+
+            elif diff["op"] == "delete":
+                action["_op_type"] = "delete"
+
+            else:
+                action["_op_type"] = "update"
+                action["_source"] = {"doc": diff["doc"]}
+
+            yield action
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+args = parser.parse_args()
+
+conf = ConfigParser()
+conf.read(args.config)
+
+INPUT_DIR = conf.get("files", "processing-directory")
+ES_INDEX = conf.get("elasticsearch", "es-index")
+TMP_DIR = conf.get("files", "status-directory")
+OUTPUT_FILE = args.output or os.path.join(TMP_DIR, "reconcile_diff.ndjson")
+
+if args.walk and not args.spots:
+    parser.error("--walk needs at least one --spot")
+
+if args.walk and args.path_index:
+    parser.error("--walk and --path-index cannot be used together")
+
+# The cached listing and the path index are from the last generate_dirs_from_spot run. Applying their adds and
+# deletes would reverse every directory created or removed since, so only a fresh walk applies them
+APPLY_OPS = ("add", "delete", "update") if args.walk else ("update",)
+
+metrics = Metrics.from_config("reconcile_index", conf, profile=args.profile)
+
+es = get_elasticsearch(conf)
+
+# Read the index in parallel. Each slice is sorted to disk.
+print("Reading index...")
+with metrics.stage("read_index"):
+    pool = ThreadPool(processes=args.slices)
+    index_runs = sum(pool.map(scroll_slice, range(args.slices)), [])
+    pool.close()
+    pool.join()
+
+# Sort the filesystem listing to disk
+print("Reading listing...")
+with metrics.stage("read_listing"):
+    if args.path_index:
+        listing_runs = None
+    else:
+        listing = walk_listing() if args.walk else cached_listing()
+        listing_runs = sort_runs(listing, path_key, tmp_dir=TMP_DIR)
+
+# Compare and write out the differences
+print("Comparing...")
+counts = {"add": 0, "delete": 0, "update": 0}
+
+with metrics.stage("compare"):
+    with open(OUTPUT_FILE, 'w') as writer:
+        listing = path_index_listing() if args.path_index else merge_runs(listing_runs)
+
+        for diff in merge_join(listing, merge_runs(index_runs)):
+            counts[diff["op"]] += 1
+            writer.write(json.dumps(diff) + '\n')
+
+for op, count in counts.items():
+    metrics.incr(op, count)
+
+print("Add: {add} Delete: {delete} Update: {update}".format(**counts))
+print("Differences written to {}".format(OUTPUT_FILE))
+
+if args.apply:
+    with metrics.stage("apply"):
+        success, errors = bulk(es, gendata(OUTPUT_FILE), raise_on_error=False)
+
+    metrics.incr("applied", success)
+    metrics.incr("apply_errors", len(errors))
+
+    if not args.walk:
+        print("Only updates were applied. Use --walk to apply adds and deletes")
+
+metrics.write()
+
+if metrics.counters.get("apply_errors"):
+    print("Failed to apply {} differences".format(metrics.counters["apply_errors"]))
+    sys.exit(1)
@@ -17,10 +17,19 @@ __license__ = "BSD - see LICENSE file in top-level package directory"
 __contact__ = "richard.d.smith@stfc.ac.uk"
 
 import argparse
-from ceda_elasticsearch_tools.core.log_reader import DepositLog, SpotMapping
+from ceda_elasticsearch_tools.core.log_reader import SpotMapping
 from ceda_elasticsearch_tools.index_tools.index_updaters import CedaDirs
 from ceda_elasticsearch_tools.core.utils import get_latest_log
 from utils.path_tools import PathTools
+from utils.metrics import Metrics
+from utils.moles_journal import journal_from_config
+from utils.index_tools import get_elasticsearch, collapse_to_roots, delete_subtrees, upsert_dirs
+from utils.rollups import AncestorDeltas, scan_directory, rollup, get_stats, add_stats, add_new_children
+from utils.pipeline import OrderedPipeline
+from utils.pruning import Pruner
+from utils.deposit_log import DepositLogReader, LogCheckpoint, DEPOSIT_LOG_DIR, MKDIR, RMDIR, SYMLINK, README, \
+    DEPOSIT, REMOVE
+from elasticsearch.helpers import bulk
 from tqdm import tqdm
 import os
 import hashlib
@@ -32,6 +41,20 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument("--conf", dest="conf", required=True)
+parser.add_argument("--batch-size", dest="batch_size", type=int, default=5000,
+                    help="Largest number of documents to send to elasticsearch at a time")
+parser.add_argument("--workers", dest="workers", type=int, default=4,
+                    help="Number of threads generating directory metadata")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+
+# Returned by prepare_event for events which are not indexed
+PRUNED = object()
+
+# File events change the counts and sizes of the directory they are in
+FILE_EVENTS = (DEPOSIT, REMOVE)
+
+EVENTS = (MKDIR, RMDIR, SYMLINK, README) + FILE_EVENTS
 
 
 #################################################
@@ -69,6 +92,335 @@ def check_logging_dir(directory, log):
         return False, action_output
 
 
+def prepare_event(event, pt, pruner):
+    """
+    Generate the metadata needed to write an event to the index. Run in the pipeline worker threads
+
+    :param event:   DepositEvent
+    :param pt:      PathTools object
+    :param pruner:  Pruner object
+    :return: PRUNED, or the prepared data for the event
+    """
+    path = os.path.dirname(event.path) if event.action in (README,) + FILE_EVENTS else event.path
+
+    # Removals are always applied so directories indexed before a rule was added are cleared out
+    if pruner and event.action != RMDIR and pruner.prune(path):
+        return PRUNED
+
+    try:
+        if event.action == MKDIR:
+            metadata, islink = pt.generate_path_metadata(path)
+            if metadata:
+                return metadata, scan_directory(path)[1]
+
+        elif event.action == SYMLINK:
+            metadata, islink = pt.generate_path_metadata(path)
+            return metadata
+
+        elif event.action == README:
+            return pt.get_readme(path)
+
+    except OSError:
+        # Removed again before the event was processed
+        pass
+
+
+def write_creations(items, cd, es, index, deltas, metrics):
+    """
+    Add new directories to the index. Trees created within the run are rolled up and the totals of
+    each new tree are added to the ancestor deltas.
+
+    A parent created in an earlier run may have been listed after the new directory was made, so its
+    child_count already includes it. The parent is listed again and only the sub-directories missing
+    from its document are added.
+
+    :param items:   List of (path, (metadata, stats) or None)
+    :param cd:      CedaDirs object
+    :param es:      Elasticsearch client
+    :param index:   Index name
+    :param deltas:  AncestorDeltas object
+    :param metrics: Metrics object
+    :return: Operation status
+    """
+    content_list = []
+    stats = dict((path, result[1]) for path, result in items if result)
+
+    with metrics.stage("creations"):
+        rollup(stats)
+
+        # Only the top of each new tree changes the totals of existing ancestors
+        roots = collapse_to_roots(stats)
+        for root in roots:
+            deltas.add(root, stats[root], count_child=False)
+
+        metrics.incr("children_already_counted", add_new_children(es, index, roots, deltas))
+
+        for path, result in items:
+            if result:
+                metadata = result[0]
+                add_stats(metadata, stats[path])
+
+                content_list.append({
+                    "id": hashlib.sha1(metadata["path"]).hexdigest(),
+                    "document": metadata
+                })
+
+        result = cd.add_dirs(content_list)
+
+    metrics.incr("creations", len(items))
+    return result
+
+
+def write_deletions(dirs, es, index, deltas, metrics, result_list):
+    """
+    Removing a tree logs an rmdir for every directory. Collapse these to the top-most roots
+    and remove each root and its descendants in one request.
+
+    :param dirs:        List of removed directories
+    :param es:          Elasticsearch client
+    :param index:       Index name
+    :param deltas:      AncestorDeltas object
+    :param metrics:     Metrics object
+    :param result_list: Report lines. The number of documents removed for each root is added
+    :return: (number of roots, number of documents removed)
+    """
+    deleted = 0
+
+    with metrics.stage("deletions"):
+        roots = collapse_to_roots(dirs)
+
+        # Get the totals of the removed trees before they are deleted
+        for root, root_stats in get_stats(es, index, roots).items():
+            deltas.add(root, root_stats, sign=-1)
+
+        for root, count in delete_subtrees(es, index, roots):
+            deleted += count
+            result_list.append("Deleted tree: {} Documents removed: {}".format(root, count))
+
+    metrics.incr("deletions", len(dirs))
+    metrics.incr("deleted_documents", deleted)
+    return len(roots), deleted
+
+
+def write_file_changes(files, es, index, deltas, metrics):
+    """
+    Files deposited or removed change the counts and sizes of the directory they are in. Each directory
+    is listed once and compared with its document. The difference is added to the directory and its ancestors.
+
+    :param files:   List of deposited or removed files
+    :param es:      Elasticsearch client
+    :param index:   Index name
+    :param deltas:  AncestorDeltas object
+    :param metrics: Metrics object
+    :return: number of directories changed
+    """
+    changed = 0
+
+    with metrics.stage("file_changes"):
+        dirs = sorted(set(os.path.dirname(path) for path in files))
+
+        for path, stored in get_stats(es, index, dirs).items():
+
+            # Indexed before the rollups were added
+            if "file_count" not in stored:
+                continue
+
+            try:
+                stats = scan_directory(path)[1]
+            except OSError:
+                # Removed since. The rmdir event updates the ancestors
+                continue
+
+            if stats["file_count"] != stored.get("file_count") or stats["size"] != stored.get("size") or \
+                    stats["last_modified"] > (stored.get("last_modified") or 0):
+                deltas.add_files(path, stats, stored)
+                changed += 1
+
+    metrics.incr("file_events", len(files))
+    metrics.incr("file_change_dirs", changed)
+    return changed
+
+
+def write_rollups(es, index, deltas, metrics):
+    """
+    Send a single scripted update to each ancestor whose totals have changed
+
+    :return: (number of updates, number of errors)
+    """
+    with metrics.stage("rollups"):
+        success, errors = bulk(es, deltas.actions(index), raise_on_error=False)
+
+    metrics.incr("rollup_updates", success)
+    return success, len(errors)
+
+
+def write_symlinks(items, es, index, metrics):
+    """
+    If there are symlink actions in the deposit log. Process the directory as if
+    it is a new directory. The document is updated rather than replaced so any
+    rolled up totals are kept.
+
+    :param items:   List of (path, metadata or None)
+    :param es:      Elasticsearch client
+    :param index:   Index name
+    :param metrics: Metrics object
+    :return: (number of documents written, number of errors)
+    """
+    content_list = []
+
+    with metrics.stage("symlinks"):
+        for path, metadata in items:
+            if metadata:
+                content_list.append({
+                    "id": hashlib.sha1(metadata["path"]).hexdigest(),
+                    "document": metadata
+                })
+
+        result = upsert_dirs(es, index, content_list)
+
+    metrics.incr("symlinks", len(items))
+    return result
+
+
+def write_readmes(items, cd, metrics):
+    """
+    Update the readme content for the directories containing the deposited 00READMEs
+
+    :param items: List of (00README path, content or None)
+    :return: Operation status
+    """
+    content_list = []
+
+    with metrics.stage("readmes"):
+        for readme, content in items:
+            if content:
+                content_list.append({
+                    "id": hashlib.sha1(os.path.dirname(readme)).hexdigest(),
+                    "document": {"readme": content}
+                })
+
+        result = cd.update_readmes(content_list)
+
+    metrics.incr("readmes", len(items))
+    return result
+
+
+class EventWriter():
+    """
+    Single consumer of the event pipeline. Consecutive events of the same kind are written together.
+    Each run is written before the next one is started so the operations on every path are applied
+    in log order. The checkpoint is moved on after each run.
+    """
+
+    def __init__(self, cd, es, index, checkpoint, metrics, batch_size=5000):
+        """
+        :param cd:          CedaDirs object
+        :param es:          Elasticsearch client
+        :param index:       Index name
+        :param checkpoint:  LogCheckpoint object
+        :param metrics:     Metrics object
+        :param batch_size:  Longest run of events to write at once
+        """
+        self.cd = cd
+        self.es = es
+        self.index = index
+        self.checkpoint = checkpoint
+        self.metrics = metrics
+        self.batch_size = batch_size
+
+        self.action = None
+        self.run = []
+        self.end = None
+
+        # Documents have been added since the last refresh
+        self.dirty = False
+
+        self.totals = {
+            MKDIR: 0, RMDIR: 0, SYMLINK: 0, README: 0, DEPOSIT: 0, REMOVE: 0,
+            "creations": [], "symlinks": [], "readmes": [],
+            "roots": 0, "deleted": 0, "file_dirs": 0, "rollups": 0, "rollup_errors": 0, "pruned": 0
+        }
+        self.result_list = []
+
+    def add(self, event, result):
+        """
+        :param event:   DepositEvent
+        :param result:  Prepared data from prepare_event
+        """
+        if result is PRUNED:
+            self.totals["pruned"] += 1
+            self.metrics.incr("pruned_events")
+
+        else:
+            if self.run and (event.action != self.action or len(self.run) >= self.batch_size):
+                self.flush()
+
+            self.action = event.action
+            self.run.append((event.path, result))
+
+        self.end = event.end
+
+    def flush(self):
+        if not self.run:
+            return
+
+        deltas = AncestorDeltas()
+
+        if self.action == MKDIR:
+            self.totals["creations"].append(write_creations(self.run, self.cd, self.es, self.index, deltas,
+                                                                   self.metrics))
+            self.dirty = True
+
+        elif self.action == RMDIR:
+            # Directories added in an earlier run must be searchable before they can be deleted by query
+            if self.dirty:
+                self.es.indices.refresh(index=self.index)
+                self.dirty = False
+
+            roots, deleted = write_deletions([path for path, result in self.run], self.es, self.index, deltas,
+                                             self.metrics, self.result_list)
+            self.totals["roots"] += roots
+            self.totals["deleted"] += deleted
+
+        elif self.action == SYMLINK:
+            self.totals["symlinks"].append(write_symlinks(self.run, self.es, self.index, self.metrics))
+            self.dirty = True
+
+        elif self.action in FILE_EVENTS:
+            self.totals["file_dirs"] += write_file_changes([path for path, result in self.run], self.es,
+                                                           self.index, deltas, self.metrics)
+
+        else:
+            self.totals["readmes"].append(write_readmes(self.run, self.cd, self.metrics))
+
+        if deltas.deltas:
+            updated, errors = write_rollups(self.es, self.index, deltas, self.metrics)
+            self.totals["rollups"] += updated
+            self.totals["rollup_errors"] += errors
+
+        self.totals[self.action] += len(self.run)
+        self.run = []
+
+        self.checkpoint.save(self.end)
+
+    def report(self):
+        """
+        :return: report lines for the log
+        """
+        totals = self.totals
+
+        return self.result_list + [
+            "New dirs: {} Operation status: {}".format(totals[MKDIR], totals["creations"]),
+            "Deleted dirs: {} Roots: {} Documents removed: {}".format(totals[RMDIR], totals["roots"], totals["deleted"]),
+            "Deposited files: {} Removed files: {} Directories re-counted: {}".format(
+                totals[DEPOSIT], totals[REMOVE], totals["file_dirs"]),
+            "Updated ancestors: {} Errors: {}".format(totals["rollups"], totals["rollup_errors"]),
+            "Symlinked dirs: {} Operation status: {}".format(totals[SYMLINK], totals["symlinks"]),
+            "Added 00READMEs: {} Operation status: {}".format(totals[README], totals["readmes"]),
+            "Pruned events: {}".format(totals["pruned"])
+        ]
+
+
 #################################################
 #                                               #
 #                End of Functions               #
@@ -89,133 +441,81 @@ def main():
     conf = ConfigParser()
     conf.read(args.conf)
 
+    metrics = Metrics.from_config("update_ceda_dirs", conf, profile=args.profile)
+
+    index = conf.get("elasticsearch", "es-index")
+    status_dir = conf.get("files", "status-directory")
+
     # Get the latest logs
-    deposit_logs = get_latest_log("/badc/ARCHIVE_INFO/deposit_logs", "deposit_ingest", rank=-2)
+    deposit_logs = get_latest_log(DEPOSIT_LOG_DIR, "deposit_ingest", rank=-2)
     # deposit_logs = ['deposit_ingest1.ceda.ac.uk_20180824.log']
 
     # Check to see if logging directory exists
-    make_logging_dir(conf.get("files", "status-directory"))
+    make_logging_dir(status_dir)
 
     # Initialise ceda dirs updater
-    cd = CedaDirs(index=conf.get("elasticsearch", "es-index"), host_url=conf.get("elasticsearch", "es-host"), **{
+    cd = CedaDirs(index=index, host_url=conf.get("elasticsearch", "es-host"), **{
         "http_auth": (
             conf.get("elasticsearch", "es-user"),
             conf.get("elasticsearch", "es-password")
         )
     })
 
+    # Connection used for sub-tree deletions and rollups
+    es = get_elasticsearch(conf)
+
     # Prepare path tools
-    if conf.get("files", "moles-mapping"):
-        pt = PathTools(moles_mapping=conf.get("files", "moles-mapping"))
-    else:
-        pt = PathTools()
+    with metrics.stage("load_moles_mapping"):
+        if conf.get("files", "moles-mapping"):
+            pt = PathTools(moles_mapping=conf.get("files", "moles-mapping"), metrics=metrics,
+                           moles_journal=journal_from_config(conf))
+        else:
+            pt = PathTools(metrics=metrics)
 
-    for log in deposit_logs:
+    pruner = Pruner.from_config(conf, pt.spots)
 
-        # Read deposit logs
-        dl = DepositLog(log_filename=log)
+    for log in deposit_logs:
 
         # Check to see if log has already been processed
-        processed, logging_path = check_logging_dir(conf.get("files", "status-directory"), log)
+        processed, logging_path = check_logging_dir(status_dir, log)
 
         # Skip processing if log has already been processed
         if processed:
             continue
 
-        #################################################
-        #                                               #
-        #         Process directory creations           #
-        #                                               #
-        #################################################
-        content_list = []
-        result_list = []
+        metrics.incr("logs")
 
-        for dir in tqdm(dl.mkdir_list, desc="Processing creations", file=sys.stdout):
-            metadata, islink = pt.generate_path_metadata(dir)
-            if metadata:
-                content_list.append({
-                    "id": hashlib.sha1(metadata["path"]).hexdigest(),
-                    "document": metadata
-                })
+        # Resume from the last completed batch if a previous run was interrupted
+        checkpoint = LogCheckpoint(status_dir, log)
+        start = checkpoint.load()
 
-        result = cd.add_dirs(content_list)
+        reader = DepositLogReader(log)
 
-        result_list.append(
-            "New dirs: {} Operation status: {}".format(
-                len(dl.mkdir_list),
-                result
-            )
-        )
+        writer = EventWriter(cd, es, index, checkpoint, metrics, batch_size=args.batch_size)
 
         #################################################
         #                                               #
-        #         Process directory deletions           #
+        #         Stream events from the log            #
         #                                               #
         #################################################
-        deletion_list = []
-
-        for dir in tqdm(dl.rmdir_list, desc="Processing deletions", file=sys.stdout):
-            deletion_list.append({"id": hashlib.sha1(dir).hexdigest()})
-
-        result = cd.delete_dirs(deletion_list)
-
-        result_list.append(
-            "Deleted dirs: {} Operation status: {}".format(
-                len(dl.rmdir_list),
-                result
-            )
+        # Metadata is generated by the workers while the writer sends the previous run to the index
+        pipeline = OrderedPipeline(
+            lambda event: prepare_event(event, pt, pruner),
+            workers=args.workers,
+            window=args.batch_size * 2,
+            metrics=metrics
         )
 
-        #################################################
-        #                                               #
-        #               Process symlinks                #
-        #                                               #
-        #################################################
-        # If there are symlink actions in the deposit log. Process the directory as if
-        # it is a new directory.
-        content_list = []
+        for event, result in tqdm(pipeline.run(reader.events(start=start, actions=EVENTS)), desc="Processing {}".format(log),
+                                  file=sys.stdout):
+            writer.add(event, result)
 
-        for dir in tqdm(dl.symlink_list, desc="Processing symlinks", file=sys.stdout):
-            metadata, islink = pt.generate_path_metadata(dir)
-            if metadata:
-                content_list.append({
-                    "id": hashlib.sha1(metadata["path"]).hexdigest(),
-                    "document": metadata
-                })
+        writer.flush()
 
-        result = cd.add_dirs(content_list)
+        result_list = writer.report()
 
-        result_list.append(
-            "Symlinked dirs: {} Operation status: {}".format(
-                len(dl.symlink_list),
-                result
-            )
-        )
-
-        #################################################
-        #                                               #
-        #               Process 00READMEs               #
-        #                                               #
-        #################################################
-        content_list = []
-
-        for readme in tqdm(dl.readme00_list, desc="Processing 00READMEs", file=sys.stdout):
-            path = os.path.dirname(readme)
-            content = pt.get_readme(path)
-            if content:
-                content_list.append({
-                    "id": hashlib.sha1(path).hexdigest(),
-                    "document": {"readme": content}
-                })
-
-        result = cd.update_readmes(content_list)
-
-        result_list.append(
-            "Added 00READMEs: {} Operation status: {}".format(
-                len(dl.readme00_list),
-                result
-            )
-        )
+        if start:
+            result_list.insert(0, "Resumed from byte offset: {}".format(start))
 
         #################################################
         #                                               #
@@ -226,6 +526,8 @@ def main():
         with open(logging_path, 'w') as writer:
             writer.writelines(map(lambda x: x + "\n", result_list))
 
+        checkpoint.remove()
+
     #################################################
     #                                               #
     #               Process Spot Roots              #
@@ -236,24 +538,40 @@ def main():
     spot_paths = spot_log.path2spotmapping.keys()
 
     content_list = []
+    result = []
 
-    for spot in tqdm(spot_paths, desc="Processing spot roots", file=sys.stdout):
-        metadata, islink = pt.generate_path_metadata(spot)
-        if metadata:
-            content_list.append({
-                "id": hashlib.sha1(metadata["path"]).hexdigest(),
-                "document": metadata
-            })
+    pipeline = OrderedPipeline(
+        lambda spot: pt.generate_path_metadata(spot)[0],
+        workers=args.workers,
+        window=args.batch_size * 2,
+        metrics=metrics
+    )
 
-    result = cd.add_dirs(content_list)
+    with metrics.stage("spot_roots"):
+        for spot, metadata in tqdm(pipeline.run(spot_paths), desc="Processing spot roots", file=sys.stdout):
+            if metadata:
+                content_list.append({
+                    "id": hashlib.sha1(metadata["path"]).hexdigest(),
+                    "document": metadata
+                })
+
+            # Updated rather than replaced so the rolled up totals are kept
+            if len(content_list) >= args.batch_size:
+                result.append(upsert_dirs(es, index, content_list))
+                content_list = []
 
-    pt.update_moles_mapping()
+        result.append(upsert_dirs(es, index, content_list))
+
+    with metrics.stage("update_moles_mapping"):
+        pt.update_moles_mapping()
 
     print("Spot dirs: {} Operation status: {}".format(
         len(spot_log),
         result
     ))
 
+    metrics.write()
+
 
 if __name__ == "__main__":
     main()
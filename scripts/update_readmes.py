@@ -11,6 +11,10 @@ Date: 29 August 2018
 
 Update elasticsearch records with readme content
 
+README entries are streamed one at a time from the JSON object (.json) and line-delimited (.jsonl) files in the
+processing directory. Malformed entries are skipped. A README is only sent if its digest differs from the one recorded
+for that directory on the last run. Digests are kept in the status directory.
+
 Usage:
 
     update_readmes.py <input_dir> --index <index>
@@ -23,6 +27,7 @@ __license__ = "BSD - see LICENSE file in top-level package directory"
 __contact__ = "richard.d.smith@stfc.ac.uk"
 
 import argparse
+import sys
 import json
 import os
 from tqdm import tqdm
@@ -30,10 +35,19 @@ from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 import hashlib
 from ConfigParser import ConfigParser
+from utils.metrics import Metrics
+from utils.readme_reader import ReadmeReader, digest_file
+from utils.bulk_export import BulkFileWriter
 
 parser = argparse.ArgumentParser(
-    description="")
+    description="Update elasticsearch records with readme content")
 parser.add_argument("--config", dest="config", help="Path to configuration file", required=True)
+parser.add_argument("--index", dest="index", help="Index to write to. Default: es-index from the config file")
+parser.add_argument("--force", dest="force", action="store_true",
+                    help="Send every README, even if it has not changed since the last run")
+parser.add_argument("--export-dir", dest="export_dir",
+                    help="Write _bulk files to this directory instead of sending them to elasticsearch")
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
 
 
 #################################################
@@ -42,26 +56,63 @@ parser.add_argument("--config", dest="config", help="Path to configuration file"
 #                                               #
 #################################################
 
+def readme_digest(readme):
+    if not isinstance(readme, bytes):
+        readme = readme.encode("utf-8")
+    return hashlib.sha1(readme).hexdigest()
+
+
+def load_digests(filename):
+    """
+    Load the README digests recorded by the last run
+
+    :param filename: Digest file
+    :return: dictionary of directory id to README digest
+    """
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename) as reader:
+        return json.load(reader)
+
+
+def save_digests(filename, digests):
+    tmp = filename + ".tmp"
+    with open(tmp, 'w') as writer:
+        json.dump(digests, writer)
+    os.rename(tmp, filename)
+
+
 def gendata(input):
-    for file in tqdm(input, desc="Processing README JSON files"):
-        with open(os.path.join(INPUT_DIR, file)) as reader:
-            try:
-                data = json.load(reader)
-            except ValueError:
-                tqdm.write("Unable to read: {}".format(file))
+    reader = ReadmeReader()
+
+    for file in tqdm(input, desc="Processing README files"):
+        errors = reader.errors
+
+        for path, readme in reader.read(os.path.join(INPUT_DIR, file)):
+            metrics.incr("readmes")
+            id = hashlib.sha1(path).hexdigest()
+            digest = readme_digest(readme)
+
+            # Only send READMEs which have changed since the last run
+            if not args.force and digests.get(id) == digest:
+                metrics.incr("unchanged")
                 continue
 
-        for item in data:
-            id = hashlib.sha1(item).hexdigest()
+            sent[id] = digest
 
             yield {
                 "_op_type": "update",
                 "_index": INDEX,
                 "_type": "dir",
                 "_id": id,
-                "_source": {"readme": data[item]}
+                "_source": {"doc": {"readme": readme}}
             }
 
+        if reader.errors > errors:
+            tqdm.write("Skipped {} malformed entries in: {}".format(reader.errors - errors, file))
+            metrics.incr("malformed_entries", reader.errors - errors)
+
 #################################################
 #                                               #
 #                End of Functions               #
@@ -73,21 +124,62 @@ args = parser.parse_args()
 conf = ConfigParser()
 conf.read(args.config)
 
-INDEX = conf.get("elasticsearch", "es-index")
+INDEX = args.index or conf.get("elasticsearch", "es-index")
 INPUT_DIR = conf.get("files", "processing-directory")
 
-# Setup elasticsearch connection
-es = Elasticsearch([conf.get("elasticsearch", "es-host")],
-                   http_auth=(conf.get("elasticsearch", "es-user"),
-                              conf.get("elasticsearch", "es-password")
-                              )
-                   )
+# Digests are kept per index so a rebuilt index receives every README
+DIGEST_FILE = digest_file(conf, INDEX)
+
+metrics = Metrics.from_config("update_readmes", conf, profile=args.profile)
 
 # Get input file list
 files = os.listdir(INPUT_DIR)
 
 # Filter for readme data files
-files = [x for x in files if x.endswith(".json")]
+files = [x for x in files if x.endswith(".json") or x.endswith(".jsonl")]
+
+metrics.incr("input_files", len(files))
+
+digests = load_digests(DIGEST_FILE)
+sent = {}
+
+if args.export_dir:
+    # Write the bulk requests to file to be loaded later with load_bulk_files.
+    # The digests are not recorded as the READMEs have not reached the index yet
+    with metrics.stage("bulk_export"):
+        with BulkFileWriter.from_config(args.export_dir, "readmes", conf) as writer:
+            writer.write_all(gendata(files))
+
+    print("Exported: {} Files: {}".format(writer.actions, len(writer.files)))
+    metrics.incr("exported", writer.actions)
+    sent = {}
+    errors = []
+
+else:
+    # Setup elasticsearch connection
+    es = Elasticsearch([conf.get("elasticsearch", "es-host")],
+                       http_auth=(conf.get("elasticsearch", "es-user"),
+                                  conf.get("elasticsearch", "es-password")
+                                  )
+                       )
+
+    # Index readmes using update operation
+    with metrics.stage("bulk_update"):
+        success, errors = bulk(es, gendata(files), raise_on_error=False)
+
+    metrics.incr("updated", success)
+    metrics.incr("update_errors", len(errors))
+
+# Record the digests of the READMEs which were accepted. Failures are retried next run
+for error in errors:
+    sent.pop(error.get("update", {}).get("_id"), None)
+
+digests.update(sent)
+save_digests(DIGEST_FILE, digests)
+
+metrics.write()
 
-# Index readmes using update operation
-bulk(es, gendata(files))
+# Fail the job so cron and rebuild_index.py see the failed writes
+if metrics.counters.get("update_errors"):
+    print("{} documents failed".format(metrics.counters["update_errors"]))
+    sys.exit(1)
@@ -0,0 +1,305 @@
+"""
+Daemon to keep the ceda directory index up to date for spots which change outside of the deposit logs
+e.g. manual moves and symlink re-pointing.
+
+inotify watches are placed on the configured spots up to the kernel watch limit. Subtrees which do not
+fit are polled for changes. Bursts of events are debounced and the net changes are sent to the index.
+
+Useage:
+
+    watch_spots.py --conf <config>
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import argparse
+import hashlib
+import json
+import os
+import signal
+import sys
+import time
+from ceda_elasticsearch_tools.index_tools.index_updaters import CedaDirs
+from utils.path_tools import PathTools
+from utils.metrics import Metrics
+from utils.moles_journal import journal_from_config
+from utils.index_tools import get_elasticsearch, collapse_to_roots, delete_subtrees, delete_stale, upsert_dirs
+from utils.link_stubs import find_ancestor, resolve_link_stubs, expand_link_stubs
+from utils.rollups import AncestorDeltas, scan_directory, rollup, get_stats, add_stats, add_new_children
+from utils.pruning import Pruner
+from utils.walker import DirectoryWalker
+from utils.watcher import SpotWatcher, CREATED, CHANGED, REMOVED, README
+from elasticsearch.helpers import bulk
+from ConfigParser import ConfigParser
+
+parser = argparse.ArgumentParser(
+    description="Watch spots for changes which do not appear in the deposit logs and update the directory index"
+)
+
+parser.add_argument("--conf", dest="conf", required=True)
+parser.add_argument("--profile", dest="profile", action="store_true", help="Capture cProfile output for each stage")
+
+
+#################################################
+#                                               #
+#                Functions                      #
+#                                               #
+#################################################
+
+def get_option(conf, option, default):
+    if conf.has_option("watcher", option):
+        return conf.get("watcher", option)
+    return default
+
+
+def walk_change(path, pt, walker, listing_dir):
+    """
+    Generate the records for a directory and the tree below it. Links into other spots are not followed,
+    as in generate_dirs_from_spot.py, but the other spot's records are copied below them from the cached
+    listing, as in index_dirs.py
+
+    :param path:        Directory to walk
+    :param pt:          PathTools object
+    :param walker:      DirectoryWalker object
+    :param listing_dir: Directory containing the <spot>_directories.txt listings
+    :return: list of directory metadata
+    """
+    output = None
+    stubs = []
+
+    if os.path.islink(path):
+        metadata, islink = pt.generate_path_metadata(path)
+        if not metadata:
+            return []
+
+        stub = walker.link_stub(path, pt.spots.get_spot(os.path.dirname(path)))
+        if stub:
+            output = [metadata]
+            stubs = [stub]
+
+        elif not islink:
+            return [metadata]
+
+    if output is None:
+        if not os.path.isdir(path):
+            return []
+
+        output, readmes = walker.walk(path)
+        stubs = walker.link_stubs
+        walker.link_stubs = []
+
+        for metadata in output:
+            if metadata["path"] in readmes:
+                metadata["readme"] = readmes[metadata["path"]]
+
+    for line in expand_link_stubs(resolve_link_stubs(stubs), listing_dir, metrics=walker.metrics):
+        output.append(json.loads(line))
+
+    return output
+
+
+def apply_changes(changes, pt, cd, es, index, walker, listing_dir, metrics):
+    """
+    Send the net changes to the index. Trees which are walked again are written before the documents
+    which no longer exist are removed, so they are never missing from the index. The rolled up totals
+    of the ancestors are updated as in update_ceda_dirs.py
+
+    :param changes:     dictionary of path to change
+    :param pt:          PathTools object
+    :param cd:          CedaDirs object
+    :param es:          Elasticsearch client
+    :param index:       Index name
+    :param walker:      DirectoryWalker object
+    :param listing_dir: Directory containing the <spot>_directories.txt listings
+    :param metrics:     Metrics object
+    """
+    deltas = AncestorDeltas()
+
+    # Re-pointed links, new links and spots which are rescanned are walked again. Changes below them
+    # are picked up by the walk
+    walk_roots = collapse_to_roots(
+        path for path, change in changes.items() if change == CHANGED or (change == CREATED and os.path.islink(path))
+    )
+    walk_set = set(walk_roots)
+
+    def walked(path):
+        return find_ancestor(path, walk_set) is not None
+
+    records = []
+    with metrics.stage("walk"):
+        stored = get_stats(es, index, walk_roots)
+
+        for root in walk_roots:
+            output = walk_change(root, pt, walker, listing_dir)
+            records.extend(output)
+
+            if not output or output[0]["path"] != root:
+                continue
+
+            if changes[root] == CREATED:
+                deltas.add(root, output[0], count_child=False)
+
+            # The totals of a tree which was already indexed are replaced
+            elif root in stored and not output[0]["link"]:
+                deltas.add(root, stored[root], sign=-1, count_child=False)
+                deltas.add(root, output[0], count_child=False)
+
+    # New directories. Trees created together are rolled up
+    with metrics.stage("creations"):
+        created = {}
+        for path in sorted(p for p, change in changes.items() if change == CREATED and not walked(p)):
+            metadata, islink = pt.generate_path_metadata(path)
+            if metadata:
+                try:
+                    created[path] = (metadata, scan_directory(path)[1])
+                except OSError:
+                    continue
+
+        stats = dict((path, result[1]) for path, result in created.items())
+        rollup(stats)
+
+        for path, (metadata, path_stats) in created.items():
+            add_stats(metadata, path_stats)
+            records.append(metadata)
+
+        created_roots = collapse_to_roots(stats)
+        for root in created_roots:
+            deltas.add(root, stats[root], count_child=False)
+
+        new_roots = created_roots + [root for root in walk_roots if changes[root] == CREATED]
+        metrics.incr("children_already_counted", add_new_children(es, index, new_roots, deltas))
+
+    with metrics.stage("write"):
+        written, errors = upsert_dirs(es, index, [
+            {"id": hashlib.sha1(metadata["path"]).hexdigest(), "document": metadata} for metadata in records
+        ])
+
+    # Documents which no longer exist. Removals below a walked tree are found by the walk
+    deleted = 0
+    with metrics.stage("deletions"):
+        paths = set(metadata["path"] for metadata in records)
+        for root in walk_roots:
+            deleted += delete_stale(es, index, root, paths)
+
+        removed = collapse_to_roots(p for p, change in changes.items() if change == REMOVED and not walked(p))
+        for root, root_stats in get_stats(es, index, removed).items():
+            deltas.add(root, root_stats, sign=-1)
+
+        for root, count in delete_subtrees(es, index, removed):
+            deleted += count
+
+    if deltas.deltas:
+        with metrics.stage("rollups"):
+            updated, rollup_errors = bulk(es, deltas.actions(index), raise_on_error=False)
+
+        metrics.incr("rollup_updates", updated)
+        metrics.incr("rollup_errors", len(rollup_errors))
+
+    readme_list = []
+    for path in [p for p, change in changes.items() if change == README]:
+        if not os.path.isdir(path):
+            continue
+
+        readme_list.append({
+            "id": hashlib.sha1(path).hexdigest(),
+            "document": {"readme": pt.get_readme(path) or ""}
+        })
+
+    if readme_list:
+        cd.update_readmes(readme_list)
+
+    metrics.incr("added", written)
+    metrics.incr("index_errors", errors)
+    metrics.incr("deleted_documents", deleted)
+    metrics.incr("readmes", len(readme_list))
+
+    print("{} Added: {} Errors: {} Removed: {} READMEs: {}".format(
+        time.strftime("%Y-%m-%d %H:%M:%S"),
+        written,
+        errors,
+        deleted,
+        len(readme_list)
+    ))
+    sys.stdout.flush()
+
+
+#################################################
+#                                               #
+#                End of Functions               #
+#                                               #
+#################################################
+
+
+def main():
+    """
+    Watch the spots and update elasticsearch index
+    """
+    args = parser.parse_args()
+
+    conf = ConfigParser()
+    conf.read(args.conf)
+
+    index = conf.get("elasticsearch", "es-index")
+    metrics = Metrics.from_config("watch_spots", conf, profile=args.profile)
+
+    cd = CedaDirs(index=index, host_url=conf.get("elasticsearch", "es-host"), **{
+        "http_auth": (
+            conf.get("elasticsearch", "es-user"),
+            conf.get("elasticsearch", "es-password")
+        )
+    })
+    es = get_elasticsearch(conf)
+
+    if conf.get("files", "moles-mapping"):
+        pt = PathTools(moles_mapping=conf.get("files", "moles-mapping"), metrics=metrics,
+                       moles_journal=journal_from_config(conf))
+    else:
+        pt = PathTools(metrics=metrics)
+
+    spots = [spot for spot in get_option(conf, "spots", "").replace(",", " ").split() if spot]
+    if not spots:
+        print("No spots configured in [watcher] spots")
+        sys.exit(1)
+
+    max_watches = get_option(conf, "max-watches", None)
+
+    walker = DirectoryWalker(pt.spots, pt.moles_mapping or {}, metrics=metrics,
+                             pruner=Pruner.from_config(conf, pt.spots))
+
+    watcher = SpotWatcher(
+        spots,
+        max_watches=int(max_watches) if max_watches else None,
+        poll_interval=float(get_option(conf, "poll-interval", 300)),
+        debounce=float(get_option(conf, "debounce", 5)),
+        max_delay=float(get_option(conf, "max-delay", 60)),
+        metrics=metrics
+    )
+
+    # Stop cleanly on SIGTERM
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    watcher.start()
+
+    try:
+        for changes in watcher.changes():
+            apply_changes(changes, pt, cd, es, index, walker, conf.get("files", "processing-directory"), metrics)
+            metrics.write()
+
+    except KeyboardInterrupt:
+        print("Stopping watcher")
+
+    finally:
+        watcher.close()
+        pt.update_moles_mapping()
+        metrics.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import re
+import gzip
+import json
+
+# Stages in the order they must be loaded. READMEs are partial updates so the directories have to exist first
+STAGES = ("dirs", "missing_metadata", "readmes")
+
+# <stage>_<sequence>.ndjson[.gz]
+BULK_FILE = re.compile(r"^(?P<stage>[a-z_]+)_(?P<sequence>\d+)\.ndjson(?:\.gz)?$")
+
+# Bulk files a little under the recommended bulk request size so each file can be sent as a single request
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+# Fields from an elasticsearch.helpers style action which belong in the action line
+ACTION_FIELDS = ("_index", "_type", "_id", "_routing", "_version", "_retry_on_conflict")
+
+
+def _encode(line):
+    if not isinstance(line, bytes):
+        line = line.encode("utf-8")
+    return line
+
+
+def action_lines(action):
+    """
+    Convert an elasticsearch.helpers style action into the lines of a _bulk request body
+
+    :param action: Action dictionary. Must have an _id so that replaying the file is idempotent
+    :return: list of lines, without newlines
+    """
+    if not action.get("_id"):
+        raise ValueError("Exported actions must have a deterministic _id")
+
+    op_type = action.get("_op_type", "index")
+    meta = dict((field, action[field]) for field in ACTION_FIELDS if field in action)
+    lines = [json.dumps({op_type: meta})]
+
+    if op_type != "delete":
+        lines.append(json.dumps(action["_source"]))
+
+    return lines
+
+
+def set_index(body, index):
+    """
+    Point every action in a _bulk request body at a different index
+
+    :param body:    _bulk request body
+    :param index:   Index name
+    :return: rewritten body
+    """
+    lines = []
+    expect_action = True
+
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+
+        if expect_action:
+            action = json.loads(line)
+            op_type, meta = list(action.items())[0]
+            meta["_index"] = index
+            line = _encode(json.dumps(action))
+
+            # Deletes have no source line
+            expect_action = op_type == "delete"
+        else:
+            expect_action = True
+
+        lines.append(line)
+
+    return b"\n".join(lines) + b"\n"
+
+
+def split_actions(body):
+    """
+    Split a _bulk request body into its actions, so that some of them can be sent again
+
+    :param body: _bulk request body
+    :return: list of actions. Each is the action line and any source line, with newlines
+    """
+    actions = []
+    expect_action = True
+
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+
+        line = _encode(line) + b"\n"
+
+        if expect_action:
+            op_type = list(json.loads(line))[0]
+            actions.append(line)
+
+            # Deletes have no source line
+            expect_action = op_type == "delete"
+        else:
+            actions[-1] += line
+            expect_action = True
+
+    return actions
+
+
+def read_bulk_file(filename):
+    """
+    :param filename: Exported bulk file
+    :return: _bulk request body
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as reader:
+        return reader.read()
+
+
+def list_bulk_files(directory):
+    """
+    List the completed bulk files in a directory in the order they should be loaded
+
+    :param directory: Export directory
+    :return: list of lists of file names. One list per stage
+    """
+    stages = {}
+
+    for filename in os.listdir(directory):
+        match = BULK_FILE.match(filename)
+        if match:
+            stages.setdefault(match.group("stage"), []).append((int(match.group("sequence")), filename))
+
+    order = list(STAGES) + sorted(stage for stage in stages if stage not in STAGES)
+
+    return [[filename for sequence, filename in sorted(stages[stage])] for stage in order if stage in stages]
+
+
+class BulkFileWriter():
+    """
+    Write bulk actions to size capped, ready to send _bulk NDJSON files instead of a live cluster.
+
+    Files are named <stage>_<sequence>.ndjson (.ndjson.gz when compressed) and only appear under that name
+    once they are complete, so a loader never sees a partial file.
+    """
+
+    def __init__(self, directory, stage, max_bytes=DEFAULT_MAX_BYTES, compress=False):
+        """
+        :param directory:   Directory to write to
+        :param stage:       Name of the indexing stage. Used to order the files when they are loaded
+        :param max_bytes:   Uncompressed size limit for each file
+        :param compress:    gzip the files
+        """
+        self.directory = directory
+        self.stage = stage
+        self.max_bytes = max_bytes
+        self.compress = compress
+
+        self.files = []
+        self.actions = 0
+
+        self._writer = None
+        self._tmp = None
+        self._size = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Start after any files left by an earlier export of this stage
+        existing = [
+            int(m.group("sequence")) for m in map(BULK_FILE.match, os.listdir(directory))
+            if m and m.group("stage") == stage
+        ]
+        self._sequence = max(existing) + 1 if existing else 0
+
+    @classmethod
+    def from_config(cls, directory, stage, conf):
+        """
+        Create a writer using the [export] section of the config file, if present.
+
+        :param directory:   Directory to write to
+        :param stage:       Name of the indexing stage
+        :param conf:        ConfigParser object
+        """
+        max_bytes = DEFAULT_MAX_BYTES
+        compress = False
+
+        if conf.has_option("export", "max-file-size") and conf.get("export", "max-file-size"):
+            max_bytes = int(conf.get("export", "max-file-size"))
+
+        if conf.has_option("export", "compress"):
+            compress = conf.getboolean("export", "compress")
+
+        return cls(directory, stage, max_bytes=max_bytes, compress=compress)
+
+    def _filename(self):
+        extension = ".ndjson.gz" if self.compress else ".ndjson"
+        return os.path.join(self.directory, "{}_{:05d}{}".format(self.stage, self._sequence, extension))
+
+    def _open(self):
+        self._tmp = self._filename() + ".tmp"
+        self._writer = gzip.open(self._tmp, "wb") if self.compress else open(self._tmp, "wb")
+        self._size = 0
+
+    def _finish(self):
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        filename = self._filename()
+        os.rename(self._tmp, filename)
+
+        self.files.append(filename)
+        self._writer = None
+        self._sequence += 1
+
+    def write(self, action):
+        """
+        :param action: elasticsearch.helpers style action
+        """
+        data = b"".join(_encode(line) + b"\n" for line in action_lines(action))
+
+        if self._writer is not None and self._size + len(data) > self.max_bytes:
+            self._finish()
+
+        if self._writer is None:
+            self._open()
+
+        self._writer.write(data)
+        self._size += len(data)
+        self.actions += 1
+
+    def write_all(self, actions):
+        """
+        :param actions: iterable of actions
+        :return: number of actions written
+        """
+        count = 0
+        for action in actions:
+            self.write(action)
+            count += 1
+        return count
+
+    def close(self):
+        self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            # Don't leave a partial file behind
+            self._writer.close()
+            os.remove(self._tmp)
+            self._writer = None
@@ -0,0 +1,131 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import re
+import mmap
+from collections import namedtuple
+
+DEPOSIT_LOG_DIR = "/badc/ARCHIVE_INFO/deposit_logs"
+
+MKDIR = "MKDIR"
+RMDIR = "RMDIR"
+SYMLINK = "SYMLINK"
+DEPOSIT = "DEPOSIT"
+REMOVE = "REMOVE"
+README = "README"
+
+# <date> <time>:<path>:<action>[:...]
+LINE = re.compile(
+    br"^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}):(?P<path>/[^:\n]*):(?P<action>[A-Z]+)(?=:|\r?$)",
+    re.MULTILINE
+)
+
+# offset:   byte offset of the start of the line
+# end:      byte offset of the start of the next line. Save this to resume after the event
+DepositEvent = namedtuple("DepositEvent", ["offset", "end", "timestamp", "action", "path"])
+
+
+class DepositLogReader():
+    """
+    Stream typed events from a deposit log. The log is memory mapped and parsed lazily so memory use
+    does not depend on the size of the log and events are available as soon as the reader starts.
+
+    Deposits of 00README files are reported as README events with the path of the file.
+    """
+
+    def __init__(self, log_filename, log_dir=DEPOSIT_LOG_DIR):
+        """
+        :param log_filename:    Name of the log file
+        :param log_dir:         Directory containing the logs
+        """
+        self.log_filename = log_filename
+        self.path = os.path.join(log_dir, log_filename)
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def events(self, start=0, actions=(MKDIR, RMDIR, SYMLINK, README)):
+        """
+        :param start:   Byte offset to start reading from. Must be the start of a line
+        :param actions: Event types to yield. None yields everything
+        :return: generator of DepositEvent
+        """
+        if self.size() == 0:
+            return
+
+        with open(self.path, "rb") as reader:
+            mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                for match in LINE.finditer(mm, start):
+                    action = match.group("action").decode("ascii")
+                    path = _native(match.group("path"))
+
+                    if action == DEPOSIT and os.path.basename(path) == "00README":
+                        action = README
+
+                    if actions is not None and action not in actions:
+                        continue
+
+                    end = mm.find(b"\n", match.end())
+                    end = len(mm) if end < 0 else end + 1
+
+                    yield DepositEvent(
+                        match.start(),
+                        end,
+                        match.group("timestamp").decode("ascii"),
+                        action,
+                        path
+                    )
+            finally:
+                mm.close()
+
+
+class LogCheckpoint():
+    """
+    Record how far through a deposit log processing has got so it can resume from there
+    """
+
+    def __init__(self, directory, log_filename):
+        log_root = os.path.splitext(log_filename)[0]
+        self.filename = os.path.join(directory, "{}_CEDA_DIRS_OFFSET".format(log_root))
+
+    def load(self):
+        """
+        :return: saved byte offset or 0
+        """
+        try:
+            with open(self.filename) as reader:
+                return int(reader.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def save(self, offset):
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as writer:
+            writer.write(str(offset))
+        os.rename(tmp, self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def _native(value):
+    """
+    Paths are returned as the native str, as the document ids are the sha1 of the path. On python 2 the
+    bytes are kept unchanged. On python 3 undecodable bytes are kept with surrogateescape.
+
+    :param value: bytes from the log
+    :return: str
+    """
+    if isinstance(value, str):
+        return value
+    return value.decode("utf-8", "surrogateescape")
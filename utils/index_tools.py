@@ -0,0 +1,254 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import re
+import time
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk, scan
+
+# Exact value of the path. The index is dynamically mapped so this is the keyword sub-field
+PATH_FIELD = "path.keyword"
+
+# Exact values of the parent and ancestor paths
+PARENT_FIELD = "parent.keyword"
+ANCESTORS_FIELD = "ancestors.keyword"
+
+# The path fields keep the same shape as the dynamic mapping so queries work against either.
+# Only the keyword sub-field of parent, ancestors and sort_key is indexed
+_KEYWORD_ONLY = {"type": "text", "index": False, "fields": {"keyword": {"type": "keyword"}}}
+
+# Mapping used when the rebuild tooling creates an index. Other fields are mapped dynamically
+DIRS_MAPPING = {
+    "mappings": {
+        "dir": {
+            "properties": {
+                "path": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                "dir": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                "depth": {"type": "integer"},
+                "parent": _KEYWORD_ONLY,
+                "ancestors": _KEYWORD_ONLY,
+                "sort_key": _KEYWORD_ONLY
+            }
+        }
+    }
+}
+
+
+def get_elasticsearch(conf):
+    """
+    Create an elasticsearch connection from the [elasticsearch] section of the config file
+
+    :param conf: ConfigParser object
+    :return: Elasticsearch client
+    """
+    return Elasticsearch([conf.get("elasticsearch", "es-host")],
+                         http_auth=(conf.get("elasticsearch", "es-user"),
+                                    conf.get("elasticsearch", "es-password")
+                                    )
+                         )
+
+
+def collapse_to_roots(paths):
+    """
+    Reduce a list of paths to the minimal set of top-most roots. Any path which is below
+    another path in the list is dropped.
+
+    :param paths: iterable of directory paths
+    :return: sorted list of root paths
+    """
+    roots = []
+
+    # Sorting on the path components places every descendant directly after its ancestor
+    for path in sorted(set(p.rstrip('/') for p in paths if p), key=lambda p: p.split('/')):
+        if roots and (path == roots[-1] or path.startswith(roots[-1] + '/')):
+            continue
+        roots.append(path)
+
+    return roots
+
+
+def subtree_query(root):
+    """
+    Documents indexed before the ancestors field was added are matched by the path prefix.
+
+    :param root: Top of the subtree
+    :return: query matching root and every directory below it
+    """
+    return {
+        "query": {
+            "bool": {
+                "should": [
+                    {"term": {PATH_FIELD: root}},
+                    {"term": {ANCESTORS_FIELD: root}},
+                    {"prefix": {PATH_FIELD: root + '/'}}
+                ]
+            }
+        }
+    }
+
+
+def delete_subtrees(es, index, roots):
+    """
+    Remove each root and all of its descendants with a single delete by query per root.
+
+    :param es:      Elasticsearch client
+    :param index:   Index to delete from
+    :param roots:   List of root paths. Use collapse_to_roots to avoid overlapping deletes
+    :return: generator of (root, number of documents removed)
+    """
+    for root in roots:
+        result = es.delete_by_query(index=index, body=subtree_query(root), conflicts="proceed")
+        yield root, result.get("deleted", 0)
+
+
+def delete_stale(es, index, root, paths):
+    """
+    Remove the documents below root which are not in paths, e.g. after the tree has been walked again
+
+    :param es:      Elasticsearch client
+    :param index:   Index name
+    :param root:    Top of the tree
+    :param paths:   Set of the paths which still exist
+    :return: number of documents removed
+    """
+    query = subtree_query(root)
+    query["_source"] = ["path"]
+
+    actions = (
+        {"_op_type": "delete", "_index": index, "_type": "dir", "_id": doc["_id"]}
+        for doc in scan(es, index=index, query=query)
+        if doc["_source"]["path"] not in paths
+    )
+
+    success, errors = bulk(es, actions, raise_on_error=False)
+    return success
+
+
+def upsert_actions(index, content_list):
+    """
+    Partial updates which create the document if it does not exist. Fields which are not in the new
+    metadata, such as the rollups, are kept.
+
+    :param index:           Index name
+    :param content_list:    List of {"id": ..., "document": ...} as passed to CedaDirs.add_dirs
+    :return: generator of bulk update actions
+    """
+    for item in content_list:
+        yield {
+            "_op_type": "update",
+            "_index": index,
+            "_type": "dir",
+            "_id": item["id"],
+            "_source": {"doc": item["document"], "doc_as_upsert": True}
+        }
+
+
+def upsert_dirs(es, index, content_list):
+    """
+    :param es:              Elasticsearch client
+    :param index:           Index name
+    :param content_list:    List of {"id": ..., "document": ...}
+    :return: (number of documents written, number of errors)
+    """
+    success, errors = bulk(es, upsert_actions(index, content_list), raise_on_error=False)
+    return success, len(errors)
+
+
+def create_build_index(es, alias, body=None):
+    """
+    Create a new timestamped index for a full rebuild. Refresh is disabled and there
+    are no replicas so bulk loading is as fast as possible.
+
+    :param es:      Elasticsearch client
+    :param alias:   Alias which will point to the index once the rebuild is complete
+    :param body:    Optional index body e.g. mappings
+    :return: name of the new index
+    """
+    if es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias):
+        raise ValueError(
+            "{} is an index, not an alias. Reindex it into a timestamped index and "
+            "point the alias at it before running a rebuild".format(alias)
+        )
+
+    index = "{}_{}".format(alias, time.strftime("%Y%m%d%H%M%S"))
+
+    body = dict(body or {})
+    body["settings"] = dict(body.get("settings", {}))
+    body["settings"].update({
+        "index.refresh_interval": "-1",
+        "index.number_of_replicas": 0
+    })
+
+    es.indices.create(index=index, body=body)
+
+    return index
+
+
+def finalise_build_index(es, index, replicas=1, refresh_interval="1s"):
+    """
+    Restore the normal settings on a rebuilt index and merge it down to a single segment
+
+    :param es:                  Elasticsearch client
+    :param index:               Index to finalise
+    :param replicas:            Number of replicas for the live index
+    :param refresh_interval:    Refresh interval for the live index
+    """
+    es.indices.put_settings(index=index, body={
+        "index": {
+            "refresh_interval": refresh_interval,
+            "number_of_replicas": replicas
+        }
+    })
+    es.indices.refresh(index=index)
+    es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+
+
+def swap_alias(es, alias, index):
+    """
+    Atomically point the alias at the index and remove it from any others
+
+    :param es:      Elasticsearch client
+    :param alias:   Alias name
+    :param index:   Index to point the alias at
+    :return: list of indices the alias was removed from
+    """
+    if es.indices.exists_alias(name=alias):
+        previous = list(es.indices.get_alias(name=alias).keys())
+    else:
+        previous = []
+
+    actions = [{"remove": {"index": old, "alias": alias}} for old in previous if old != index]
+    actions.append({"add": {"index": index, "alias": alias}})
+
+    es.indices.update_aliases(body={"actions": actions})
+
+    return [old for old in previous if old != index]
+
+
+def prune_build_indices(es, alias, keep):
+    """
+    Delete the oldest rebuilt indices, keeping the newest for rollback. The index
+    the alias points to is never deleted.
+
+    :param es:      Elasticsearch client
+    :param alias:   Alias name
+    :param keep:    Number of rebuilt indices to keep, including the live one
+    :return: list of deleted indices
+    """
+    live = set(es.indices.get_alias(name=alias).keys()) if es.indices.exists_alias(name=alias) else set()
+
+    # Timestamped names sort in creation order. Other indices which share the prefix are left alone
+    name = re.compile(r"^{}_\d{{14}}$".format(re.escape(alias)))
+    indices = sorted(index for index in es.indices.get(index="{}_*".format(alias)) if name.match(index))
+    old = [index for index in indices[:-keep] if index not in live] if keep > 0 else []
+
+    for index in old:
+        es.indices.delete(index=index)
+
+    return old
@@ -0,0 +1,132 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from collections import namedtuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events which change the directory tree or the 00README files
+DIRECTORY_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF | \
+                   IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT = struct.Struct("iIII")
+
+Event = namedtuple("Event", ["wd", "mask", "cookie", "name"])
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+def max_user_watches():
+    """
+    :return: kernel limit on the number of watches per user, or None if it cannot be read
+    """
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as reader:
+            return int(reader.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Inotify():
+    """
+    Minimal ctypes wrapper around the Linux inotify API
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=DIRECTORY_EVENTS):
+        """
+        :param path:    Directory to watch
+        :param mask:    Events to watch for
+        :return: watch descriptor
+        :raises OSError: ENOSPC when the kernel watch limit has been reached
+        """
+        if not isinstance(path, bytes):
+            path = path.encode("utf-8")
+
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events
+
+        :param timeout: Seconds to wait. None waits forever
+        :return: list of Event
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+
+            name = data[pos:pos + length].rstrip(b"\0").decode("utf-8", "replace")
+            pos += length
+
+            events.append(Event(wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
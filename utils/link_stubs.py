@@ -0,0 +1,162 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import json
+from utils.path_tools import path_fields
+
+# Number of times links through other links are resolved
+MAX_LINK_DEPTH = 10
+
+# Written by generate_dirs_from_spot for each spot
+STUB_SUFFIX = "_link_stubs.ndjson"
+LISTING_SUFFIX = "_directories.txt"
+
+
+def find_ancestor(path, paths):
+    """
+    :param path:    Directory path
+    :param paths:   Dictionary of paths
+    :return: path or its closest ancestor in paths, or None
+    """
+    while len(path) > 1:
+        if path in paths:
+            return path
+        path = os.path.dirname(path)
+
+
+def read_link_stubs(input_dir):
+    """
+    Read the links into other spots written by generate_dirs_from_spot.
+
+    :param input_dir: Processing directory
+    :return: list of link stubs
+    """
+    stubs = []
+    for file in os.listdir(input_dir):
+        if not file.endswith(STUB_SUFFIX):
+            continue
+
+        with open(os.path.join(input_dir, file)) as reader:
+            for line in reader:
+                if line.strip():
+                    stubs.append(json.loads(line))
+
+    return stubs
+
+
+def resolve_link_stubs(stub_list):
+    """
+    A link whose target is below another link is pointed at the real target. A link to a directory which
+    contains a link into a third spot gets a stub for that link too, so the third spot's records are also
+    copied below it.
+
+    :param stub_list: iterable of link stubs
+    :return: dictionary of link path to (target path, target spot)
+    """
+    stubs = {}
+    for stub in stub_list:
+        stubs[stub["path"]] = (stub["target"], stub["spot"])
+
+    for i in range(MAX_LINK_DEPTH):
+        changed = False
+
+        # Targets which are below another link
+        for link, (target, spot) in list(stubs.items()):
+            ancestor = find_ancestor(target, stubs)
+            if ancestor and ancestor != link:
+                real_target, real_spot = stubs[ancestor]
+                stubs[link] = (real_target + target[len(ancestor):], real_spot)
+                changed = True
+
+        # Links below a target
+        targets = {}
+        for link, (target, spot) in stubs.items():
+            targets.setdefault(target, []).append(link)
+
+        for link, (target, spot) in list(stubs.items()):
+            ancestor = find_ancestor(os.path.dirname(link), targets)
+            if ancestor:
+                for outer in targets[ancestor]:
+                    derived = outer + link[len(ancestor):]
+                    if derived not in stubs:
+                        stubs[derived] = (target, spot)
+                        changed = True
+
+        if not changed:
+            break
+
+    return stubs
+
+
+def expand_records(records, targets):
+    """
+    Copy the records below each link target to below the link. The path, depth, directory name and
+    ancestor fields are rewritten. The other fields describe the target so they are kept.
+
+    :param records: iterable of directory metadata JSON strings from the target spot
+    :param targets: dictionary of target path to list of link paths
+    :return: generator of directory metadata dictionaries
+    """
+    for line in records:
+        line = line.strip()
+        if not line:
+            continue
+
+        record = json.loads(line)
+        path = record["path"]
+
+        # Every target the directory is below
+        ancestor = find_ancestor(os.path.dirname(path), targets)
+        while ancestor:
+            for link in targets[ancestor]:
+                copy = dict(record)
+                copy["path"] = link + path[len(ancestor):]
+                copy["depth"] = copy["path"].count('/')
+                copy["dir"] = os.path.basename(copy["path"])
+                copy.update(path_fields(copy["path"]))
+                yield copy
+
+            ancestor = find_ancestor(os.path.dirname(ancestor), targets)
+
+
+def expand_link_stubs(stubs, listing_dir, metrics=None, progress=None):
+    """
+    Copy the records of each linked spot, read from its listing, to below the links into it.
+
+    :param stubs:       dictionary of link path to (target path, target spot) from resolve_link_stubs
+    :param listing_dir: Directory containing the <spot>_directories.txt listings
+    :param metrics:     Metrics object. Counts the links whose spot has no listing
+    :param progress:    Optional wrapper for the spot iterable e.g. tqdm
+    :return: set of directory metadata JSON strings
+    """
+    spots = {}
+    for link, (target, spot) in stubs.items():
+        spots.setdefault(spot, {}).setdefault(target, []).append(link)
+
+    items = spots.items()
+    if progress:
+        items = progress(items, desc="Expanding links")
+
+    expanded = set()
+
+    for spot, targets in items:
+        filename = os.path.join(listing_dir, spot + LISTING_SUFFIX)
+
+        if not os.path.exists(filename):
+            print("No directory listing for {}. Links to it are not expanded".format(spot))
+            if metrics:
+                metrics.incr("missing_link_targets", len(targets))
+            continue
+
+        with open(filename) as reader:
+            for record in expand_records(reader, targets):
+                expanded.add(json.dumps(record))
+
+    return expanded
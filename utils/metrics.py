@@ -0,0 +1,248 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import re
+import json
+import time
+import socket
+import resource
+import cProfile
+import threading
+from contextlib import contextmanager
+
+
+class Metrics():
+    """
+    Lightweight timers, counters and histograms for the indexing scripts.
+    Results can be written as a JSON run report and as a Prometheus textfile-collector file.
+    """
+
+    PREFIX = "ceda_dirs"
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, job, report_dir=None, profile=False):
+        """
+        :param job:         Name of the script. Used to label the output
+        :param report_dir:  Directory to write reports to. If None, reports are not written
+        :param profile:     Capture cProfile output for each stage
+        """
+        self.job = job
+        self.report_dir = report_dir
+        self.profile = profile
+
+        self.start_time = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+
+        self._lock = threading.Lock()
+        self._profiling = False
+
+    @classmethod
+    def from_config(cls, job, conf, profile=False):
+        """
+        Create metrics using the report-directory from the [metrics] section of the config file, if present.
+
+        :param job:     Name of the script
+        :param conf:    ConfigParser object
+        :param profile: Capture cProfile output for each stage
+        """
+        report_dir = None
+        if conf.has_option("metrics", "report-directory"):
+            report_dir = conf.get("metrics", "report-directory") or None
+
+        return cls(job, report_dir=report_dir, profile=profile)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the script. If profiling is enabled, the stage is run under cProfile
+        and the stats are dumped to <report_dir>/profiles/<job>_<stage>.prof
+
+        :param name: Stage name
+        """
+        profiler = None
+        if self.profile and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+
+            if profiler:
+                profiler.disable()
+                self._profiling = False
+                self._dump_profile(name, profiler)
+
+            with self._lock:
+                stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0})
+                stage["count"] += 1
+                stage["seconds"] += elapsed
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time a small, frequently called operation and add the result to a histogram.
+
+        :param name: Histogram name
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter
+
+        :param name:    Counter name
+        :param value:   Amount to add
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Add a value to a histogram
+
+        :param name:    Histogram name
+        :param value:   Value to record, usually seconds
+        """
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = {
+                    "buckets": [0] * len(self.BUCKETS),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": 0.0
+                }
+
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+
+            hist["count"] += 1
+            hist["sum"] += value
+            hist["max"] = max(hist["max"], value)
+
+    def report(self):
+        """
+        :return: dictionary describing the run
+        """
+        with self._lock:
+            return {
+                "job": self.job,
+                "host": socket.gethostname(),
+                "start": self.start_time,
+                "end": time.time(),
+                "seconds": time.time() - self.start_time,
+                "peak_rss_kb": peak_rss(),
+                "children_peak_rss_kb": peak_rss(children=True),
+                "stages": dict((k, dict(v)) for k, v in self.stages.items()),
+                "counters": dict(self.counters),
+                "histograms": dict(
+                    (k, {
+                        "buckets": dict(zip(map(str, self.BUCKETS), v["buckets"])),
+                        "count": v["count"],
+                        "sum": v["sum"],
+                        "max": v["max"]
+                    }) for k, v in self.histograms.items()
+                )
+            }
+
+    def prometheus(self):
+        """
+        :return: report in the Prometheus text exposition format
+        """
+        report = self.report()
+        job = 'job="{}"'.format(self.job)
+        lines = []
+
+        def metric(name, mtype):
+            name = "{}_{}".format(self.PREFIX, _sanitise(name))
+            lines.append("# TYPE {} {}".format(name, mtype))
+            return name
+
+        name = metric("last_run_timestamp_seconds", "gauge")
+        lines.append("{}{{{}}} {}".format(name, job, report["end"]))
+
+        name = metric("run_seconds", "gauge")
+        lines.append("{}{{{}}} {}".format(name, job, report["seconds"]))
+
+        name = metric("peak_rss_bytes", "gauge")
+        lines.append("{}{{{}}} {}".format(name, job, report["peak_rss_kb"] * 1024))
+
+        if report["stages"]:
+            name = metric("stage_seconds", "gauge")
+            for stage, values in sorted(report["stages"].items()):
+                lines.append('{}{{{},stage="{}"}} {}'.format(name, job, stage, values["seconds"]))
+
+        for counter, value in sorted(report["counters"].items()):
+            name = metric(counter + "_total", "counter")
+            lines.append("{}{{{}}} {}".format(name, job, value))
+
+        for hist_name, hist in sorted(self.histograms.items()):
+            name = metric(hist_name + "_seconds", "histogram")
+            for bound, count in zip(self.BUCKETS, hist["buckets"]):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, job, bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, job, hist["count"]))
+            lines.append("{}_sum{{{}}} {}".format(name, job, hist["sum"]))
+            lines.append("{}_count{{{}}} {}".format(name, job, hist["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Write the JSON run report and the Prometheus textfile to the report directory.
+        Files are written to a temporary name and renamed so collectors never see a partial file.
+        """
+        if not self.report_dir:
+            return
+
+        if not os.path.isdir(self.report_dir):
+            os.makedirs(self.report_dir)
+
+        _atomic_write(os.path.join(self.report_dir, "{}_report.json".format(self.job)),
+                      json.dumps(self.report(), indent=4))
+
+        _atomic_write(os.path.join(self.report_dir, "{}.prom".format(self.job)), self.prometheus())
+
+    def _dump_profile(self, stage, profiler):
+        profile_dir = os.path.join(self.report_dir or os.getcwd(), "profiles")
+
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+        profiler.dump_stats(os.path.join(profile_dir, "{}_{}.prof".format(self.job, _sanitise(stage))))
+
+
+def peak_rss(children=False):
+    """
+    :param children: Report the largest child process which has been waited for instead of this process
+    :return: peak resident set size in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sanitise(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _atomic_write(filename, content):
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp, "w") as writer:
+        writer.write(content)
+    os.rename(tmp, filename)
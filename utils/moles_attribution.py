@@ -0,0 +1,176 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import json
+import requests
+from utils.metrics import Metrics
+
+
+class MolesAttributor():
+    """
+    Attribute directories which are missing MOLES metadata by working top down through the tree
+    of missing directories. The tree is built once and only the unresolved directories at the current
+    depth (the frontier) are checked against the mapping and the MOLES api. A hit is pushed down to
+    every descendant in a single pass over the subtree so those directories are never queried.
+    """
+
+    API_URL = "https://catalogue.ceda.ac.uk/api/v0/obs/get_info"
+
+    def __init__(self, mapping=None, max_depth=None, min_query_depth=2, metrics=None):
+        """
+        :param mapping:         MOLES mapping to use before querying the api
+        :param max_depth:       Deepest level to attribute. None will keep going until the frontier is empty
+        :param min_query_depth: Shallowest level to query the api for. Directories above this have no MOLES record
+        :param metrics:         Metrics object to record api calls against
+        """
+        self.mapping = mapping if mapping is not None else {}
+        self.max_depth = max_depth
+        self.min_query_depth = min_query_depth
+        self.metrics = metrics or Metrics("moles_attribution")
+
+        # Answers from the api gathered during this run
+        self.new_records = {}
+
+        self.nodes = {}
+        self.children = {}
+        self.levels = {}
+        self.resolved = {}
+
+    def add(self, item):
+        """
+        Add a directory to the tree
+
+        :param item: directory metadata as a dict or JSON string
+        """
+        if not isinstance(item, dict):
+            item = json.loads(item)
+
+        path = item['path']
+        if path in self.nodes:
+            return
+
+        self.nodes[path] = item
+        self.children.setdefault(os.path.dirname(path), []).append(path)
+        self.levels.setdefault(item['depth'], []).append(path)
+
+    def build(self, lines):
+        """
+        Build the tree from an iterable of JSON strings. Blank lines are ignored.
+
+        :param lines: iterable of directory metadata JSON strings
+        """
+        for line in lines:
+            line = line.strip()
+            if line:
+                self.add(line)
+
+    def lookup(self, path):
+        """
+        Walk up the path to find the closest record in the mapping or the records found this run.
+
+        :param path: directory to test
+        :return: MOLES record info for the given dir
+        """
+        while len(path) > 1:
+            for key in (path, path + "/"):
+                if key in self.new_records:
+                    return self.new_records[key]
+                if key in self.mapping:
+                    return self.mapping[key]
+
+            path = os.path.dirname(path)
+
+    def query(self, path):
+        """
+        Ask the MOLES api for a record for the given path.
+
+        :param path: directory to query
+        :return: MOLES record if it has a title, otherwise None
+        """
+        self.metrics.incr("moles_api_requests")
+        with self.metrics.timer("moles_api"):
+            r = requests.get(self.API_URL + path)
+
+        try:
+            r_json = r.json()
+        except ValueError:
+            return
+
+        if r_json and r_json.get('title'):
+            return r_json
+
+    def run(self, progress=None):
+        """
+        Attribute the tree level by level until there are no unresolved directories or max_depth is reached.
+
+        :param progress: Optional wrapper for the frontier iterable e.g. tqdm
+        """
+        for depth in sorted(self.levels):
+
+            if len(self.resolved) == len(self.nodes):
+                break
+
+            if self.max_depth is not None and depth > self.max_depth:
+                break
+
+            frontier = [path for path in self.levels[depth] if path not in self.resolved]
+
+            if progress:
+                frontier = progress(frontier, desc="Attributing depth {}".format(depth))
+
+            for path in frontier:
+                record = self.lookup(path)
+
+                if not (record and record.get('title')) and depth >= self.min_query_depth:
+                    record = self.query(path)
+                    if record:
+                        self.new_records[path] = record
+
+                if record and record.get('title'):
+                    self._push_down(path, record)
+
+    def _push_down(self, path, record):
+        """
+        Assign the record to path and all of its unresolved descendants
+
+        :param path:    Root of the subtree
+        :param record:  MOLES record
+        """
+        stack = [path]
+        while stack:
+            node = stack.pop()
+
+            if node in self.resolved:
+                continue
+
+            self.resolved[node] = record
+            stack.extend(self.children.get(node, []))
+
+    def records(self):
+        """
+        Generate directory metadata with MOLES information added where it could be attributed.
+
+        :return: generator of (dir_meta, attributed)
+        """
+        for path, dir_meta in self.nodes.items():
+            record = self.resolved.get(path)
+
+            if record:
+                dir_meta["title"] = record["title"]
+                dir_meta["url"] = record.get("url") if record.get("url") else record.get("uuid")
+                dir_meta["record_type"] = record.get("record_type") if record.get("record_type") else record.get("type")
+
+            yield dir_meta, bool(record)
+
+    def remainder(self):
+        """
+        :return: list of directory metadata which could not be attributed
+        """
+        return [self.nodes[path] for path in self.nodes if path not in self.resolved]
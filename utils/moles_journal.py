@@ -0,0 +1,194 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+from utils.moles_snapshot import load_moles_mapping
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+def journal_from_config(conf):
+    """
+    Get the journal file from the [files] section of the config file.
+
+    :param conf: ConfigParser object
+    :return: moles-journal if set, otherwise <moles-mapping>.journal. None if there is no mapping
+    """
+    if conf.has_option("files", "moles-journal") and conf.get("files", "moles-journal"):
+        return conf.get("files", "moles-journal")
+
+    if conf.get("files", "moles-mapping"):
+        return conf.get("files", "moles-mapping") + ".journal"
+
+
+def load_journalled_mapping(json_file, journal_file=None):
+    """
+    Load the MOLES mapping snapshot with the journal laid over it
+
+    :param json_file:       MOLES mapping JSON file
+    :param journal_file:    Journal file. Default: <json_file>.journal
+    :return: JournalledMapping
+    """
+    journal = MolesJournal(journal_file or json_file + ".journal")
+    return JournalledMapping(load_moles_mapping(json_file), journal.read())
+
+
+class MolesJournal():
+    """
+    Append-only record of MOLES catalogue answers found since the mapping was last compacted.
+
+    Each line is {"path": <path>, "record": <record>}. Later lines win. Appends take an exclusive lock
+    and reads a shared lock, so concurrent jobs add to the journal without losing each other's records.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        """
+        Open the journal and hold a lock on it
+
+        :param exclusive: Take an exclusive lock. Otherwise a shared lock
+        :return: file object opened for reading and appending
+        """
+        with open(self.filename, "a+") as journal:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                journal.seek(0)
+                yield journal
+            finally:
+                fcntl.flock(journal.fileno(), fcntl.LOCK_UN)
+
+    def append(self, records):
+        """
+        :param records: dictionary of path to MOLES record
+        :return: number of records written
+        """
+        if not records:
+            return 0
+
+        # Written in one go so a crash can only leave a partial last line
+        data = "".join(
+            json.dumps({"path": path, "record": record}) + "\n" for path, record in records.items()
+        )
+
+        with self.locked() as journal:
+
+            # Start on a new line if an interrupted write left a partial one
+            journal.seek(0, os.SEEK_END)
+            if journal.tell():
+                journal.seek(journal.tell() - 1)
+                if journal.read(1) != "\n":
+                    data = "\n" + data
+
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        return len(records)
+
+    @staticmethod
+    def _parse(journal):
+        records = {}
+
+        for line in journal:
+            try:
+                entry = json.loads(line)
+                records[entry["path"]] = entry["record"]
+            except (ValueError, KeyError, TypeError):
+                # Partial line left by an interrupted write
+                continue
+
+        return records
+
+    def read(self):
+        """
+        :return: dictionary of path to MOLES record
+        """
+        if not os.path.exists(self.filename):
+            return {}
+
+        with self.locked(exclusive=False) as journal:
+            return self._parse(journal)
+
+    def compact(self, json_file):
+        """
+        Fold the journal into the JSON mapping, recompile the snapshot and empty the journal.
+        Appends wait until this has finished.
+
+        :param json_file: MOLES mapping JSON file
+        :return: number of journal records folded in
+        """
+        with self.locked() as journal:
+            records = self._parse(journal)
+
+            if not records:
+                return 0
+
+            with open(json_file) as reader:
+                mapping = json.load(reader)
+
+            mapping.update(records)
+
+            tmp = "{}.{}.tmp".format(json_file, os.getpid())
+            with open(tmp, "w") as writer:
+                writer.write(json.dumps(mapping))
+            os.rename(tmp, json_file)
+
+            load_moles_mapping(json_file).close()
+
+            # Readers who loaded the new snapshot and the old journal see the same records twice, which is harmless
+            journal.truncate(0)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        return len(records)
+
+
+class JournalledMapping(Mapping):
+    """
+    Read-only view of the MOLES mapping with the journal records laid over it
+    """
+
+    def __init__(self, base, overlay):
+        """
+        :param base:    MolesSnapshot
+        :param overlay: dictionary of journal records
+        """
+        self.base = base
+        self.overlay = overlay
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key in self.overlay or key in self.base
+
+    def __iter__(self):
+        for key in self.overlay:
+            yield key
+
+        for key in self.base:
+            if key not in self.overlay:
+                yield key
+
+    def __len__(self):
+        return len(self.base) + len([key for key in self.overlay if key not in self.base])
+
+    def close(self):
+        self.base.close()
@@ -0,0 +1,209 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+MAGIC = b"MOLESNAP"
+VERSION = 1
+
+# magic, version, number of keys, number of values, source mtime, source size
+HEADER = struct.Struct("<8sIIIdQ")
+
+# key offset, key length, value number
+KEY_ENTRY = struct.Struct("<QII")
+
+# value offset, value length
+VALUE_ENTRY = struct.Struct("<QI")
+
+
+def compile_snapshot(json_file, snapshot_file):
+    """
+    Compile the JSON MOLES mapping into a read-only binary snapshot.
+
+    The snapshot contains a header, a key index sorted by key, a value index and a string table.
+    Identical records are only stored once. The file is written to a temporary name and renamed
+    so readers never see a partial snapshot.
+
+    :param json_file:       MOLES mapping JSON file
+    :param snapshot_file:   Snapshot file to write
+    """
+    stat = os.stat(json_file)
+
+    with open(json_file) as reader:
+        mapping = json.load(reader)
+
+    strings = bytearray()
+    values = []
+    value_numbers = {}
+    keys = []
+
+    for key in sorted(mapping, key=_encode):
+        value = json.dumps(mapping[key], sort_keys=True).encode("utf-8")
+
+        if value not in value_numbers:
+            value_numbers[value] = len(values)
+            values.append((len(strings), len(value)))
+            strings.extend(value)
+
+        key_bytes = _encode(key)
+        keys.append((len(strings), len(key_bytes), value_numbers[value]))
+        strings.extend(key_bytes)
+
+    # Jobs on different hosts can share the directory, so the process id alone is not a unique name
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(snapshot_file) + ".", suffix=".tmp",
+                               dir=os.path.dirname(os.path.abspath(snapshot_file)))
+    try:
+        # mkstemp creates the file readable by the owner only
+        os.fchmod(fd, 0o644)
+
+        with os.fdopen(fd, "wb") as writer:
+            writer.write(HEADER.pack(MAGIC, VERSION, len(keys), len(values), stat.st_mtime, stat.st_size))
+            for entry in keys:
+                writer.write(KEY_ENTRY.pack(*entry))
+            for entry in values:
+                writer.write(VALUE_ENTRY.pack(*entry))
+            writer.write(bytes(strings))
+
+        os.rename(tmp, snapshot_file)
+
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_moles_mapping(json_file, snapshot_file=None):
+    """
+    Load the MOLES mapping from the compiled snapshot. The snapshot is rebuilt if it is
+    missing or was compiled from a different version of the JSON file.
+
+    :param json_file:       MOLES mapping JSON file
+    :param snapshot_file:   Snapshot file. Default: <json_file>.snap
+    :return: MolesSnapshot
+    """
+    snapshot_file = snapshot_file or json_file + ".snap"
+
+    if not MolesSnapshot.is_current(snapshot_file, json_file):
+        compile_snapshot(json_file, snapshot_file)
+
+    return MolesSnapshot(snapshot_file)
+
+
+class MolesSnapshot(Mapping):
+    """
+    Read-only view of a compiled MOLES mapping. The file is memory mapped so all processes
+    on a node share the same pages. Keys are found by binary search and records are only
+    decoded when they are requested.
+    """
+
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+
+        with open(snapshot_file, "rb") as reader:
+            self._mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._n_keys, self._n_values, self.source_mtime, self.source_size = \
+            HEADER.unpack_from(self._mm, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a MOLES mapping snapshot".format(snapshot_file))
+
+        self._keys_start = HEADER.size
+        self._values_start = self._keys_start + self._n_keys * KEY_ENTRY.size
+        self._strings_start = self._values_start + self._n_values * VALUE_ENTRY.size
+
+        self._cache = {}
+
+    @staticmethod
+    def is_current(snapshot_file, json_file):
+        """
+        :return: True if the snapshot exists and was compiled from the current json file
+        """
+        if not os.path.exists(snapshot_file):
+            return False
+
+        stat = os.stat(json_file)
+
+        with open(snapshot_file, "rb") as reader:
+            header = reader.read(HEADER.size)
+
+        if len(header) < HEADER.size:
+            return False
+
+        magic, version, n_keys, n_values, mtime, size = HEADER.unpack(header)
+
+        return magic == MAGIC and version == VERSION and mtime == stat.st_mtime and size == stat.st_size
+
+    def _key_entry(self, i):
+        return KEY_ENTRY.unpack_from(self._mm, self._keys_start + i * KEY_ENTRY.size)
+
+    def _key(self, i):
+        offset, length, value = self._key_entry(i)
+        start = self._strings_start + offset
+        return self._mm[start:start + length]
+
+    def _value(self, n):
+        if n not in self._cache:
+            offset, length = VALUE_ENTRY.unpack_from(self._mm, self._values_start + n * VALUE_ENTRY.size)
+            start = self._strings_start + offset
+            self._cache[n] = json.loads(self._mm[start:start + length].decode("utf-8"))
+
+        return self._cache[n]
+
+    def _find(self, key):
+        """
+        :return: index of key in the key index or None
+        """
+        key = _encode(key)
+        lo, hi = 0, self._n_keys
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._n_keys and self._key(lo) == key:
+            return lo
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+
+        return self._value(self._key_entry(i)[2])
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        for i in range(self._n_keys):
+            yield self._key(i).decode("utf-8")
+
+    def __len__(self):
+        return self._n_keys
+
+    def close(self):
+        self._mm.close()
+
+
+def _encode(key):
+    if isinstance(key, bytes):
+        return key
+    return key.encode("utf-8")
@@ -0,0 +1,252 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import json
+import mmap
+import struct
+from utils.sorting import external_sort
+
+MAGIC = b"PATHIDX\0"
+VERSION = 1
+
+# magic, version, number of entries
+HEADER = struct.Struct("<8sIQ")
+
+# byte offset of the line in the data file
+OFFSET = struct.Struct("<Q")
+
+# The next byte after '/'. Every path below P sorts between P + '/' and P + '0'
+SEP = b"/"
+AFTER_SEP = b"0"
+
+
+def index_files(prefix):
+    """
+    :param prefix: Path index name
+    :return: (data file, offset file)
+    """
+    return prefix + ".data", prefix + ".idx"
+
+
+def build_path_index(lines, prefix, chunk_size=500000, tmp_dir=None):
+    """
+    Build a sorted path index from directory records.
+
+    The data file has one "<path>\\t<record>" line per directory, sorted by path. The offset file has a
+    header followed by the fixed width offset of each line, so the n-th path can be found without reading
+    the data file. Repeated paths are only stored once. Both files are written to temporary names and renamed.
+
+    :param lines:       iterable of directory record JSON strings
+    :param prefix:      Path index name. The files are <prefix>.data and <prefix>.idx
+    :param chunk_size:  Number of records to sort in memory at once
+    :param tmp_dir:     Directory for the sort runs
+    :return: number of paths in the index
+    """
+    data_file, offset_file = index_files(prefix)
+    data_tmp = data_file + ".tmp"
+    offset_tmp = offset_file + ".tmp"
+
+    count = 0
+    offset = 0
+    last = None
+
+    with open(data_tmp, "wb") as data, open(offset_tmp, "wb") as offsets:
+        offsets.write(HEADER.pack(MAGIC, VERSION, 0))
+
+        for path, line in external_sort(_records(lines), _path_key, chunk_size, tmp_dir):
+            if path == last:
+                continue
+            last = path
+
+            entry = _encode(path) + b"\t" + _encode(line) + b"\n"
+            data.write(entry)
+            offsets.write(OFFSET.pack(offset))
+
+            offset += len(entry)
+            count += 1
+
+        offsets.seek(0)
+        offsets.write(HEADER.pack(MAGIC, VERSION, count))
+
+    os.rename(data_tmp, data_file)
+    os.rename(offset_tmp, offset_file)
+
+    return count
+
+
+def _records(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        path = json.loads(line)["path"]
+
+        # The data file is tab and newline separated
+        if "\t" in path or "\n" in path:
+            continue
+
+        yield line
+
+
+def _path_key(line):
+    return json.loads(line)["path"]
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+class PathIndex():
+    """
+    Read-only view of a sorted path index. Both files are memory mapped and paths are found by binary search,
+    so queries only touch the pages they need.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: Path index name
+        """
+        self.prefix = prefix
+        data_file, offset_file = index_files(prefix)
+
+        with open(offset_file, "rb") as reader:
+            self._offsets = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._count = HEADER.unpack_from(self._offsets, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a path index".format(offset_file))
+
+        if self._count:
+            with open(data_file, "rb") as reader:
+                self._data = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = None
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, i):
+        return OFFSET.unpack_from(self._offsets, HEADER.size + i * OFFSET.size)[0]
+
+    def _key(self, i):
+        start = self._offset(i)
+        return self._data[start:self._data.find(b"\t", start)]
+
+    def _entry(self, i):
+        """
+        :return: (path, record JSON string)
+        """
+        start = self._offset(i)
+        end = self._data.find(b"\n", start)
+        path, record = self._data[start:end].split(b"\t", 1)
+        return path.decode("utf-8"), record.decode("utf-8")
+
+    def lower_bound(self, key, lo=0):
+        """
+        :param key: Path as bytes
+        :param lo:  Position to start the search from
+        :return: position of the first path which is not less than key
+        """
+        hi = self._count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _range(self, path):
+        """
+        :return: (start, end) positions of the paths below path
+        """
+        base = _encode(path.rstrip("/"))
+        start = self.lower_bound(base + SEP)
+        return start, self.lower_bound(base + AFTER_SEP, start)
+
+    def get_path(self, path):
+        """
+        :param path: Directory path
+        :return: directory record or None
+        """
+        key = _encode(path.rstrip("/") or "/")
+        i = self.lower_bound(key)
+
+        if i < self._count and self._key(i) == key:
+            return json.loads(self._entry(i)[1])
+
+    def subtree_count(self, path):
+        """
+        :param path: Directory path
+        :return: number of directories below path, not including path itself
+        """
+        start, end = self._range(path)
+        return end - start
+
+    def list_children(self, path):
+        """
+        List the directories directly below path. Each child's subtree is jumped over with a binary search
+        so the cost depends on the number of children, not the size of the subtree.
+
+        :param path: Directory path
+        :return: generator of (child path, record JSON string)
+        """
+        base = _encode(path.rstrip("/"))
+        start, end = self._range(path)
+        i = start
+
+        while i < end:
+            key = self._key(i)
+            name = key[len(base) + 1:]
+
+            if not name:
+                # The root itself
+                i += 1
+            elif SEP not in name:
+                yield self._entry(i)
+                i += 1
+            else:
+                # Below a child. Skip to the end of that child's subtree
+                child = base + SEP + name.split(SEP, 1)[0]
+                i = self.lower_bound(child + AFTER_SEP, i)
+
+    def subtree(self, path):
+        """
+        :param path: Directory path
+        :return: generator of (path, record JSON string) for path and everything below it, in path order
+        """
+        base = path.rstrip("/")
+        key = _encode(base or "/")
+        i = self.lower_bound(key)
+
+        if base and i < self._count and self._key(i) == key:
+            yield self._entry(i)
+
+        start, end = self._range(path)
+        for i in range(start, end):
+            yield self._entry(i)
+
+    def items(self):
+        """
+        :return: generator of (path, record JSON string) for every path, in path order
+        """
+        for i in range(self._count):
+            yield self._entry(i)
+
+    def close(self):
+        self._offsets.close()
+        if self._data is not None:
+            self._data.close()
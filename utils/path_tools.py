@@ -10,22 +10,69 @@ __contact__ = "richard.d.smith@stfc.ac.uk"
 
 from ceda_elasticsearch_tools.core.log_reader import SpotMapping
 import os
-import json
+import re
 import requests
+from utils.metrics import Metrics
+from utils.moles_journal import MolesJournal, JournalledMapping
+from utils.moles_snapshot import load_moles_mapping
+
+# Runs of digits are padded to this width in the sort key so they sort by value
+SORT_KEY_DIGITS = 12
+
+NUMBER = re.compile(r"\d+")
+
+
+def sort_key(name):
+    """
+    Normalised sort key for a directory name. Case insensitive, with numbers compared by value
+    so run2 sorts before run10.
+
+    :param name: Directory name
+    :return: sort key
+    """
+    return NUMBER.sub(lambda m: m.group().zfill(SORT_KEY_DIGITS), name.lower())
+
+
+def path_fields(path):
+    """
+    Fields which let the browser list children and build breadcrumbs with term queries
+
+    :param path: Directory path
+    :return: dictionary with the parent, the list of ancestors from the top down and the sort key
+    """
+    ancestors = []
+    parent = os.path.dirname(path)
+
+    while len(parent) > 1:
+        ancestors.append(parent)
+        parent = os.path.dirname(parent)
+
+    ancestors.reverse()
+
+    return {
+        "parent": os.path.dirname(path) if path != "/" else None,
+        "ancestors": ancestors,
+        "sort_key": sort_key(os.path.basename(path))
+    }
 
 
 class PathTools():
 
-    def __init__(self, spot_file=None, moles_mapping=None):
+    def __init__(self, spot_file=None, moles_mapping=None, metrics=None, moles_journal=None):
+        self.metrics = metrics or Metrics("path_tools")
         self.spots = SpotMapping(spot_file=spot_file)
         self.moles_mapping_file = moles_mapping
 
         if moles_mapping:
-            with open(moles_mapping) as reader:
-                self.moles_mapping = json.load(reader)
+            self.journal = MolesJournal(moles_journal or moles_mapping + ".journal")
+            self.moles_mapping = JournalledMapping(load_moles_mapping(moles_mapping), self.journal.read())
         else:
+            self.journal = None
             self.moles_mapping = None
 
+        # The snapshot is read-only. Answers from the MOLES api are kept here
+        self.moles_updates = {}
+
 
     def generate_path_metadata(self, path):
         """
@@ -33,8 +80,9 @@ class PathTools():
         :param path:
         :return:
         """
-        if not os.path.isdir(path):
-            return None,None
+        with self.metrics.timer("isdir"):
+            if not os.path.isdir(path):
+                return None,None
 
         archive_path = self.spots.get_archive_path(path)
 
@@ -46,11 +94,14 @@ class PathTools():
             'link': False,
             'type': 'dir'
         }
+        dir_meta.update(path_fields(path))
 
-        if os.path.islink(path) and path is not archive_path:
-            dir_meta['link'] = True
+        with self.metrics.timer("islink"):
+            if os.path.islink(path) and path is not archive_path:
+                dir_meta['link'] = True
 
-        record = self.get_moles_record_metadata(path)
+        with self.metrics.timer("moles_lookup"):
+            record = self.get_moles_record_metadata(path)
 
         if record and record["title"]:
             dir_meta["title"] = record["title"]
@@ -67,11 +118,13 @@ class PathTools():
 
     def get_moles_record_metadata(self, path):
         orig_path = path
-        if self.moles_mapping:
+        if self.moles_mapping is not None:
 
             # recursively check for a match
             while len(path) > 1:
-                if path in self.moles_mapping:
+                if path in self.moles_updates:
+                    return self.moles_updates[path]
+                elif path in self.moles_mapping:
                     return self.moles_mapping[path]
                 elif path + "/" in self.moles_mapping:
                     return self.moles_mapping[path + "/"]
@@ -79,21 +132,28 @@ class PathTools():
                     path = os.path.dirname(path)
 
         url = "http://catalogue.ceda.ac.uk/api/v0/obs/get_info{}".format(orig_path)
-        response = requests.get(url)
+        self.metrics.incr("moles_api_requests")
+        with self.metrics.timer("moles_api"):
+            response = requests.get(url)
 
         # Update moles mapping file
         if response:
-            self.moles_mapping[orig_path] = response.json()
+            self.moles_updates[orig_path] = response.json()
             return response.json()
 
     def get_readme(self, path):
-        if "00README" in os.listdir(path):
+        with self.metrics.timer("listdir"):
+            listing = os.listdir(path)
+
+        if "00README" in listing:
             with open(os.path.join(path,"00README")) as reader:
                 content = reader.read()
 
             return content.decode('utf-8','ignore').encode("utf-8")
 
     def update_moles_mapping(self):
-        if self.moles_mapping:
-            with open(self.moles_mapping_file,'w') as writer:
-                writer.write(json.dumps(self.moles_mapping))
+        if self.journal and self.moles_updates:
+
+            # Only the new answers are written. compact_moles_mapping.py folds them into the mapping
+            self.journal.append(self.moles_updates)
+            self.moles_updates = {}
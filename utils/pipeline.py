@@ -0,0 +1,125 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Marks the end of the input for a worker
+_DONE = object()
+
+
+class OrderedPipeline():
+    """
+    Run a function over a stream of items with a pool of worker threads and hand the results back in
+    input order. Each item is tagged with a sequence number so results can be put back in order.
+
+    At most window items are in flight, counting the items waiting to be consumed. When the consumer
+    falls behind, the producer blocks, which keeps memory use bounded.
+    """
+
+    def __init__(self, func, workers=4, window=1000, metrics=None):
+        """
+        :param func:    Function to apply to each item. Run in the worker threads
+        :param workers: Number of worker threads
+        :param window:  Maximum number of items in flight
+        :param metrics: Metrics object. Counts how often the producer waits for space
+        """
+        self.func = func
+        self.workers = workers
+        self.window = window
+        self.metrics = metrics
+
+        self._slots = threading.Semaphore(window)
+        self._input = queue.Queue()
+        self._output = queue.Queue()
+        self._stop = threading.Event()
+
+    def _produce(self, items):
+        seq = 0
+        try:
+            for item in items:
+                # Wait for space, checking whether the consumer has stopped
+                while not self._slots.acquire(False):
+                    if self._stop.wait(0.05):
+                        return
+                    if self.metrics:
+                        self.metrics.incr("pipeline_waits")
+
+                self._input.put((seq, item))
+                seq += 1
+
+        except Exception:
+            # Raised in the consumer once the items before it have been consumed
+            self._output.put((seq, None, None, sys.exc_info()))
+
+        finally:
+            for i in range(self.workers):
+                self._input.put(_DONE)
+
+    def _work(self):
+        while True:
+            task = self._input.get()
+            if task is _DONE:
+                self._output.put(_DONE)
+                return
+
+            seq, item = task
+            try:
+                self._output.put((seq, item, self.func(item), None))
+            except Exception:
+                self._output.put((seq, item, None, sys.exc_info()))
+
+    def run(self, items):
+        """
+        :param items: iterable of items. Read in a separate thread
+        :return: generator of (item, result) in input order
+        """
+        threads = [threading.Thread(target=self._produce, args=(items,))]
+        threads += [threading.Thread(target=self._work) for i in range(self.workers)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        expected = 0
+        running = self.workers
+
+        try:
+            while running or pending:
+                if expected in pending:
+                    item, result, error = pending.pop(expected)
+                    expected += 1
+                    self._slots.release()
+
+                    if error:
+                        raise error[1]
+
+                    yield item, result
+                    continue
+
+                if not running:
+                    break
+
+                task = self._output.get()
+
+                if task is _DONE:
+                    running -= 1
+                    continue
+
+                seq, item, result, error = task
+                pending[seq] = (item, result, error)
+
+        finally:
+            self._stop.set()
@@ -0,0 +1,216 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import re
+import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+SECTION = "pruning"
+
+OPTIONS = ("exclude", "exclude-regex", "max-depth", "max-children")
+
+
+class PruningRules():
+    """
+    Rules which limit how much of a spot is indexed
+    """
+
+    def __init__(self, exclude=None, exclude_regex=None, max_depth=None, max_children=None):
+        """
+        :param exclude:         List of glob patterns. Patterns containing a / are matched against the
+                                full path, otherwise against the directory name
+        :param exclude_regex:   Regular expression searched for in the full path
+        :param max_depth:       Deepest directory to index, using the same depth as the directory records
+        :param max_children:    Directories with more sub-directories than this are summarised. Their
+                                sub-directories are not indexed
+        """
+        exclude = exclude or []
+        self.path_globs = [pattern for pattern in exclude if '/' in pattern]
+        self.name_globs = [pattern for pattern in exclude if '/' not in pattern]
+        self.exclude_regex = re.compile(exclude_regex) if exclude_regex else None
+        self.max_depth = max_depth
+        self.max_children = max_children
+
+    def __bool__(self):
+        return bool(self.path_globs or self.name_globs or self.exclude_regex or
+                    self.max_depth is not None or self.max_children is not None)
+
+    __nonzero__ = __bool__
+
+    def excluded(self, path):
+        """
+        :param path: Directory path
+        :return: True if the directory should not be indexed or descended into
+        """
+        if self.max_depth is not None and path.count('/') > self.max_depth:
+            return True
+
+        name = os.path.basename(path)
+        for pattern in self.name_globs:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+
+        for pattern in self.path_globs:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+
+        if self.exclude_regex is not None and self.exclude_regex.search(path):
+            return True
+
+        return False
+
+    def summarise(self, child_count):
+        """
+        :param child_count: Number of sub-directories
+        :return: True if the sub-directories should not be enumerated
+        """
+        return self.max_children is not None and child_count > self.max_children
+
+
+class Pruner():
+    """
+    Apply the pruning rules from the [pruning] section of the config file. Rules in a [pruning:<spot>]
+    section replace the defaults for that spot.
+    """
+
+    # Number of directory child counts to remember when checking events
+    CACHE_SIZE = 10000
+
+    def __init__(self, default=None, spot_rules=None, spots=None):
+        """
+        :param default:     PruningRules used for every spot
+        :param spot_rules:  Dictionary of spot name to PruningRules
+        :param spots:       SpotMapping object. Needed to find the spot for a path if there are spot rules
+        """
+        self.default = default or PruningRules()
+        self.spot_rules = spot_rules or {}
+        self.spots = spots
+        self._children = {}
+
+    @classmethod
+    def from_config(cls, conf, spots=None):
+        """
+        :param conf:    ConfigParser object. Can be None
+        :param spots:   SpotMapping object
+        :return: Pruner
+        """
+        if conf is None:
+            return cls()
+
+        default = {}
+        if conf.has_section(SECTION):
+            default = dict((option, conf.get(SECTION, option)) for option in OPTIONS
+                           if conf.has_option(SECTION, option))
+
+        spot_rules = {}
+        for section in conf.sections():
+            if section.startswith(SECTION + ":"):
+                options = dict(default)
+                options.update((option, conf.get(section, option)) for option in OPTIONS
+                               if conf.has_option(section, option))
+                spot_rules[section.split(":", 1)[1]] = _rules(options)
+
+        return cls(_rules(default), spot_rules, spots)
+
+    def __bool__(self):
+        return bool(self.default) or any(self.spot_rules.values())
+
+    __nonzero__ = __bool__
+
+    def rules(self, path):
+        """
+        :param path: Directory path
+        :return: PruningRules for the spot containing path
+        """
+        if self.spot_rules and self.spots is not None:
+            spot = self.spots.get_spot(path)
+            if spot in self.spot_rules:
+                return self.spot_rules[spot]
+
+        return self.default
+
+    def excluded(self, path):
+        return self.rules(path).excluded(path)
+
+    def summarise(self, path, child_count):
+        return self.rules(path).summarise(child_count)
+
+    def prune(self, path):
+        """
+        Check a single directory from an event. The directory is pruned if it or any ancestor below the
+        spot root is excluded, or if its parent or any ancestor up to the spot root has too many
+        sub-directories to be enumerated, as the walker would not have reached it.
+
+        :param path: Directory path
+        :return: True if the directory should not be indexed
+        """
+        rules = self.rules(path)
+
+        if not rules:
+            return False
+
+        root = self._spot_root(path)
+
+        # The walker adds the spot root without checking it
+        directory = path
+        while len(directory) > 1 and directory != root:
+            if rules.excluded(directory):
+                return True
+
+            parent = os.path.dirname(directory)
+            if rules.max_children is not None and rules.summarise(self._child_count(parent)):
+                return True
+
+            directory = parent
+
+        return False
+
+    def _spot_root(self, path):
+        """
+        :param path: Directory path
+        :return: Root of the spot containing path, or None if it is not known
+        """
+        if self.spots is None:
+            return None
+
+        mapping = self.spots.path2spotmapping
+        while len(path) > 1:
+            if path in mapping:
+                return path
+            path = os.path.dirname(path)
+
+    def _child_count(self, path):
+        if path not in self._children:
+            if len(self._children) >= self.CACHE_SIZE:
+                self._children.clear()
+
+            try:
+                self._children[path] = sum(1 for entry in scandir(path) if entry.is_dir())
+            except OSError:
+                self._children[path] = 0
+
+        return self._children[path]
+
+
+def _rules(options):
+    exclude = [pattern for pattern in options.get("exclude", "").replace(",", " ").split() if pattern]
+    max_depth = options.get("max-depth")
+    max_children = options.get("max-children")
+
+    return PruningRules(
+        exclude=exclude,
+        exclude_regex=options.get("exclude-regex") or None,
+        max_depth=int(max_depth) if max_depth else None,
+        max_children=int(max_children) if max_children else None
+    )
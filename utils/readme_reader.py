@@ -0,0 +1,205 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import re
+import json
+
+# Start of the next entry in a JSON object keyed on absolute paths. Used to recover after a malformed entry
+NEXT_ENTRY = re.compile(r'(?<!\\)",\s*("/)')
+
+WHITESPACE = " \t\n\r"
+
+
+def digest_file(conf, index):
+    """
+    :param conf:    ConfigParser object
+    :param index:   Index the READMEs are sent to
+    :return: file of README digests sent to index, in the status directory
+    """
+    return os.path.join(conf.get("files", "status-directory"), "readme_digests_{}.json".format(index))
+
+
+def clear_digests(conf, index):
+    """
+    Forget which READMEs have been sent to index. Used when the directory documents are overwritten
+    without their README, so update_readmes sends every README again.
+
+    :param conf:    ConfigParser object
+    :param index:   Index being written to
+    """
+    filename = digest_file(conf, index)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+class ReadmeReader():
+    """
+    Stream (path, readme) entries one at a time from the README files written by generate_dirs_from_spot.
+
+    Two formats are supported:
+
+        .json   A single JSON object {"<path>": "<readme>", ...}
+        .jsonl  One JSON object per line {"path": "<path>", "readme": "<readme>"}
+
+    Malformed entries are skipped and counted in `errors` rather than dropping the whole file.
+    """
+
+    def __init__(self, chunk_size=1 << 16, max_entry_size=1 << 26):
+        """
+        :param chunk_size:      Number of characters to read at a time
+        :param max_entry_size:  Size at which an entry that cannot be decoded is treated as malformed
+        """
+        self.chunk_size = chunk_size
+        self.max_entry_size = max_entry_size
+        self.errors = 0
+        self._decoder = json.JSONDecoder()
+
+    def read(self, filename):
+        """
+        :param filename: README file
+        :return: generator of (path, readme)
+        """
+        with open(filename) as reader:
+            if filename.endswith(".jsonl"):
+                entries = self.read_lines(reader)
+            else:
+                entries = self.read_object(reader)
+
+            for entry in entries:
+                yield entry
+
+    def read_lines(self, reader):
+        """
+        :param reader: Open line-delimited file
+        :return: generator of (path, readme)
+        """
+        for line in reader:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                entry = json.loads(line)
+                path, readme = entry["path"], entry["readme"]
+            except (ValueError, KeyError, TypeError):
+                self.errors += 1
+                continue
+
+            yield path, readme
+
+    def read_object(self, reader):
+        """
+        Incrementally decode a JSON object holding one entry per path.
+
+        :param reader: Open JSON file
+        :return: generator of (path, readme)
+        """
+        self._reader = reader
+        self._buf = ""
+        self._eof = False
+
+        pos = self._skip(0)
+        if not self._buf[pos:pos + 1] == "{":
+            self.errors += 1
+            return
+        pos += 1
+
+        while True:
+            pos = self._skip(pos)
+
+            if pos >= len(self._buf):
+                # Truncated file
+                self.errors += 1
+                return
+
+            char = self._buf[pos]
+            if char == "}":
+                return
+
+            if char == ",":
+                pos += 1
+                continue
+
+            try:
+                path, pos = self._decode(pos)
+                pos = self._skip(pos)
+                if self._buf[pos:pos + 1] != ":":
+                    raise ValueError("Expecting ':'")
+                readme, pos = self._decode(self._skip(pos + 1))
+
+            except ValueError:
+                self.errors += 1
+                pos = self._recover(pos)
+                if pos is None:
+                    return
+                continue
+
+            yield path, readme
+
+            # Drop the consumed part of the buffer
+            self._buf = self._buf[pos:]
+            pos = 0
+
+    def _fill(self):
+        """
+        Read the next chunk into the buffer
+        :return: False at the end of the file
+        """
+        if self._eof:
+            return False
+
+        chunk = self._reader.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+
+        self._buf += chunk
+        return True
+
+    def _skip(self, pos):
+        while True:
+            while pos < len(self._buf) and self._buf[pos] in WHITESPACE:
+                pos += 1
+
+            if pos < len(self._buf) or not self._fill():
+                return pos
+
+    def _decode(self, pos):
+        """
+        Decode the value at pos, reading more of the file until it is complete
+        """
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, pos)
+
+                # A value which runs to the end of the buffer may be incomplete e.g. a number
+                if end < len(self._buf) or self._eof:
+                    return value, end
+
+            except ValueError:
+                if self._eof or len(self._buf) - pos > self.max_entry_size:
+                    raise
+
+            self._fill()
+
+    def _recover(self, pos):
+        """
+        Find the start of the next entry after a malformed one
+        :return: position of the next key or None if there are no more entries
+        """
+        while True:
+            match = NEXT_ENTRY.search(self._buf, pos + 1)
+            if match:
+                return match.start(1)
+
+            # Keep a little of the buffer in case the separator spans two chunks
+            pos = max(len(self._buf) - 8, pos)
+            if not self._fill():
+                return None
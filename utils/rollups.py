@@ -0,0 +1,316 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import hashlib
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+# Fields which are summed up the tree
+TOTAL_FIELDS = ("total_file_count", "total_size")
+
+# Fields added to each directory record
+ROLLUP_FIELDS = ("child_count", "file_count", "size") + TOTAL_FIELDS + ("last_modified",)
+
+UPDATE_SCRIPT = """
+for (field in params.add.keySet()) {
+    def value = ctx._source[field];
+    ctx._source[field] = (value == null ? 0 : value) + params.add[field];
+}
+if (params.last_modified != null && (ctx._source.last_modified == null || ctx._source.last_modified < params.last_modified)) {
+    ctx._source.last_modified = params.last_modified;
+}
+"""
+
+
+def new_stats():
+    return {
+        "child_count": 0,
+        "file_count": 0,
+        "size": 0,
+        "total_file_count": 0,
+        "total_size": 0,
+        "last_modified": 0
+    }
+
+
+def scan_directory(path, charge=None, batch=20):
+    """
+    List a directory once, collecting the sub-directories and the statistics for the files it contains.
+
+    :param path:    Directory to list
+    :param charge:  Called with the number of file stats about to be made, before each batch of them, so
+                    the caller can limit the rate within a large directory
+    :param batch:   Number of file stats to charge at a time
+    :return: (list of sub-directory DirEntry objects, stats dictionary, True if there is a 00README)
+    """
+    dirs = []
+    stats = new_stats()
+    readme = False
+    stat_calls = 0
+
+    for entry in scandir(path):
+        try:
+            if entry.is_dir():
+                dirs.append(entry)
+                continue
+
+            if entry.name == "00README":
+                readme = True
+
+            if charge is not None and stat_calls % batch == 0:
+                charge(batch)
+            stat_calls += 1
+
+            stat = entry.stat(follow_symlinks=False)
+
+        except OSError:
+            continue
+
+        stats["file_count"] += 1
+        stats["size"] += stat.st_size
+        stats["last_modified"] = max(stats["last_modified"], int(stat.st_mtime))
+
+    stats["child_count"] = len(dirs)
+    stats["total_file_count"] = stats["file_count"]
+    stats["total_size"] = stats["size"]
+
+    return dirs, stats, readme
+
+
+def rollup(stats, links=()):
+    """
+    Add the totals for each directory to its ancestors in a single post-order pass.
+
+    A link's totals include the tree below it but are not added to its ancestors, as the storage is
+    already counted where the target is.
+
+    :param stats: dictionary of path to stats for every directory in the tree. Updated in place
+    :param links: Paths of the followed links in the tree
+    """
+    for path in sorted(stats, key=lambda p: p.count('/'), reverse=True):
+        if path in links:
+            continue
+
+        parent = os.path.dirname(path)
+
+        if parent in stats and parent != path:
+            for field in TOTAL_FIELDS:
+                stats[parent][field] += stats[path][field]
+
+            stats[parent]["last_modified"] = max(stats[parent]["last_modified"], stats[path]["last_modified"])
+
+
+def subtree_stats(root, pruner=None):
+    """
+    Walk a directory tree and calculate the rolled up stats for every directory in it.
+
+    :param root:    Top of the tree
+    :param pruner:  Pruner object. Excluded directories are not walked
+    :return: dictionary of path to stats
+    """
+    stats = {}
+    stack = [root]
+
+    while stack:
+        path = stack.pop()
+        try:
+            dirs, stats[path], readme = scan_directory(path)
+        except OSError:
+            continue
+
+        if pruner is not None and pruner.summarise(path, len(dirs)):
+            continue
+
+        for entry in dirs:
+            child = os.path.join(path, entry.name)
+            if not entry.is_symlink() and not (pruner is not None and pruner.excluded(child)):
+                stack.append(child)
+
+    rollup(stats)
+    return stats
+
+
+def add_stats(dir_meta, stats):
+    """
+    Add the rollup fields to a directory record. Empty directories have no last_modified
+
+    :param dir_meta:    Directory metadata
+    :param stats:       Stats for the directory
+    """
+    for field in ROLLUP_FIELDS:
+        if stats.get(field):
+            dir_meta[field] = stats[field]
+        elif field != "last_modified":
+            dir_meta[field] = 0
+
+
+def get_stats(es, index, paths):
+    """
+    Get the rolled up stats currently in the index for a list of directories
+
+    :param es:      Elasticsearch client
+    :param index:   Index to read from
+    :param paths:   List of directory paths
+    :return: dictionary of path to stats and link flag for the directories which were found
+    """
+    if not paths:
+        return {}
+
+    ids = dict((hashlib.sha1(path).hexdigest(), path) for path in paths)
+    response = es.mget(index=index, doc_type="dir", body={"ids": list(ids)}, _source=list(ROLLUP_FIELDS) + ["link"])
+
+    return dict(
+        (ids[doc["_id"]], doc.get("_source", {})) for doc in response["docs"] if doc.get("found")
+    )
+
+
+def add_new_children(es, index, roots, deltas):
+    """
+    Add new directories to the child_count of their parents. A parent may have been listed after a new
+    directory was made, so its child_count already includes it. The parent is listed again and only
+    the sub-directories missing from its document are added.
+
+    :param es:      Elasticsearch client
+    :param index:   Index name
+    :param roots:   New directories at the top of each new tree
+    :param deltas:  AncestorDeltas object
+    :return: number of new directories which were already counted
+    """
+    new_children = {}
+    for root in roots:
+        parent = os.path.dirname(root)
+        new_children[parent] = new_children.get(parent, 0) + 1
+
+    counted = 0
+
+    for parent, stored in get_stats(es, index, list(new_children)).items():
+        try:
+            children = scan_directory(parent)[1]["child_count"]
+        except OSError:
+            continue
+
+        missing = max(0, min(new_children[parent], children - stored.get("child_count", 0)))
+        counted += new_children[parent] - missing
+
+        deltas.add_children(parent, missing)
+
+    return counted
+
+
+class AncestorDeltas():
+    """
+    Collect the changes to the rolled up totals of ancestors caused by directories being created
+    or removed, or by files changing. Each changed directory gets a single scripted update.
+    """
+
+    def __init__(self):
+        self.deltas = {}
+
+    def add(self, path, stats, sign=1, count_child=True):
+        """
+        Apply the totals of a created (sign=1) or removed (sign=-1) tree to all of its ancestors
+
+        :param path:        Root of the tree which changed
+        :param stats:       Rolled up stats for the tree. Stats from get_stats say whether it is a link
+        :param sign:        1 for creation, -1 for removal
+        :param count_child: Change the child_count of the parent. False if it is set with add_children
+        """
+        parent = os.path.dirname(path)
+
+        if parent != path and count_child:
+            self._delta(parent)["add"]["child_count"] += sign
+
+        # The totals of links are not added to their ancestors
+        if stats.get("link"):
+            return
+
+        while len(parent) > 1:
+            delta = self._delta(parent)
+
+            for field in TOTAL_FIELDS:
+                delta["add"][field] += sign * stats.get(field, 0)
+
+            if sign > 0 and stats.get("last_modified"):
+                delta["last_modified"] = max(delta["last_modified"] or 0, stats["last_modified"])
+
+            parent = os.path.dirname(parent)
+
+    def add_files(self, path, stats, stored):
+        """
+        Apply the change in the files directly inside a directory to the directory and its ancestors
+
+        :param path:    Directory whose files changed
+        :param stats:   Stats from scan_directory for the directory now
+        :param stored:  Rollup fields currently in the index for the directory
+        """
+        change = {
+            "file_count": stats["file_count"] - stored.get("file_count", 0),
+            "size": stats["size"] - stored.get("size", 0)
+        }
+
+        delta = self._delta(path)
+        delta["add"]["file_count"] += change["file_count"]
+        delta["add"]["size"] += change["size"]
+
+        newer = stats.get("last_modified") and stats["last_modified"] > (stored.get("last_modified") or 0)
+
+        while len(path) > 1:
+            delta = self._delta(path)
+            delta["add"]["total_file_count"] += change["file_count"]
+            delta["add"]["total_size"] += change["size"]
+
+            if newer:
+                delta["last_modified"] = max(delta["last_modified"] or 0, stats["last_modified"])
+
+            path = os.path.dirname(path)
+
+    def add_children(self, path, count):
+        """
+        :param path:    Directory
+        :param count:   Number of sub-directories to add to its child_count
+        """
+        if count:
+            self._delta(path)["add"]["child_count"] += count
+
+    def _delta(self, path):
+        if path not in self.deltas:
+            self.deltas[path] = {
+                "add": dict((field, 0) for field in ("child_count", "file_count", "size") + TOTAL_FIELDS),
+                "last_modified": None
+            }
+        return self.deltas[path]
+
+    def actions(self, index):
+        """
+        :param index: Index to update
+        :return: generator of bulk update actions
+        """
+        for path, delta in self.deltas.items():
+            add = dict((field, value) for field, value in delta["add"].items() if value)
+
+            if not add and not delta["last_modified"]:
+                continue
+
+            yield {
+                "_op_type": "update",
+                "_index": index,
+                "_type": "dir",
+                "_id": hashlib.sha1(path).hexdigest(),
+                "_source": {
+                    "script": {
+                        "lang": "painless",
+                        "source": UPDATE_SCRIPT,
+                        "params": {"add": add, "last_modified": delta["last_modified"]}
+                    }
+                }
+            }
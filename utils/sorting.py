@@ -0,0 +1,101 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import heapq
+import tempfile
+
+# Separates the sort key from the line in the run files. Paths cannot contain a null byte
+SEPARATOR = b'\0'
+
+
+def sort_runs(lines, key, chunk_size=500000, tmp_dir=None):
+    """
+    Sort lines in chunks and write each sorted chunk to a temporary run file.
+    Only chunk_size lines are held in memory at once.
+
+    The keys and lines are written as UTF-8 and sorted as bytes, which is the same order as the
+    unicode code points.
+
+    :param lines:       iterable of strings without newlines
+    :param key:         function to extract the sort key from a line
+    :param chunk_size:  number of lines per run
+    :param tmp_dir:     directory for the run files
+    :return: list of run file paths
+    """
+    runs = []
+    chunk = []
+
+    for line in lines:
+        chunk.append((_encode(key(line)), _encode(line)))
+
+        if len(chunk) >= chunk_size:
+            runs.append(_write_run(chunk, tmp_dir))
+            chunk = []
+
+    if chunk:
+        runs.append(_write_run(chunk, tmp_dir))
+
+    return runs
+
+
+def merge_runs(runs):
+    """
+    Merge sorted run files. The run files are removed once they have been read.
+
+    :param runs: list of run file paths
+    :return: generator of (key, line) in key order, decoded from UTF-8
+    """
+    readers = [open(run, 'rb') for run in runs]
+
+    try:
+        for key, line in heapq.merge(*[_read_run(reader) for reader in readers]):
+            yield key.decode('utf-8'), line.decode('utf-8')
+    finally:
+        for reader in readers:
+            reader.close()
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+
+def external_sort(lines, key, chunk_size=500000, tmp_dir=None):
+    """
+    Sort lines in bounded memory
+
+    :param lines:       iterable of strings without newlines
+    :param key:         function to extract the sort key from a line
+    :param chunk_size:  number of lines to hold in memory
+    :param tmp_dir:     directory for temporary files
+    :return: generator of (key, line) in key order
+    """
+    return merge_runs(sort_runs(lines, key, chunk_size, tmp_dir))
+
+
+def _write_run(chunk, tmp_dir):
+    chunk.sort()
+
+    fd, filename = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as writer:
+        for key, line in chunk:
+            writer.write(key + SEPARATOR + line + b'\n')
+
+    return filename
+
+
+def _read_run(reader):
+    for line in reader:
+        key, value = line.rstrip(b'\n').split(SEPARATOR, 1)
+        yield key, value
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
@@ -0,0 +1,268 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import time
+import fcntl
+import struct
+import threading
+
+SECTION = "throttle"
+
+# Name of the shared token bucket in the processing directory
+STATE_FILE = ".throttle"
+
+# tokens, time of last refill
+STATE = struct.Struct("<dd")
+
+
+class SharedTokenBucket():
+    """
+    Token bucket shared by every job which uses the same state file. The number of tokens and the time they
+    were last topped up are kept in the file, which is locked while they are updated, so the combined rate of
+    all the jobs is capped at rate.
+
+    Tokens are reserved rather than waited for. A job which takes more tokens than are available leaves the
+    bucket negative and sleeps until its reservation is covered, so the lock is only held for a read and a write.
+
+    The jobs run on different hosts so a refill time in the future is treated as now.
+    """
+
+    def __init__(self, filename, rate, burst=None):
+        """
+        :param filename:    State file. Created if it does not exist
+        :param rate:        Operations per second across all jobs
+        :param burst:       Most tokens which can build up while the jobs are idle. Default: one second's worth
+        """
+        self.filename = filename
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+    def acquire(self, n):
+        """
+        Reserve n tokens
+
+        :param n: Number of tokens
+        :return: seconds to wait before using them
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            now = time.time()
+            data = os.read(fd, STATE.size)
+
+            if len(data) == STATE.size:
+                tokens, last = STATE.unpack(data)
+                tokens = min(self.burst, tokens + max(0, now - last) * self.rate)
+                now = max(now, last)
+            else:
+                tokens = self.burst
+
+            tokens -= n
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, STATE.pack(tokens, now))
+
+        finally:
+            os.close(fd)
+
+        return max(0.0, -tokens / self.rate)
+
+
+class AIMDController():
+    """
+    Additive increase, multiplicative decrease. The value is cut by a factor when the latency is above the
+    target and grows by a fixed step when it is not.
+    """
+
+    def __init__(self, minimum, maximum, step, decrease=0.5, initial=None):
+        """
+        :param minimum:     Lowest value
+        :param maximum:     Highest value
+        :param step:        Amount to add while the latency is below the target
+        :param decrease:    Factor to multiply by when the latency is above the target
+        :param initial:     Starting value. Default: maximum
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.decrease = decrease
+        self.value = maximum if initial is None else initial
+
+    def update(self, congested):
+        """
+        :param congested: True if the latency was above the target
+        :return: new value
+        """
+        if congested:
+            self.value = max(self.minimum, self.value * self.decrease)
+        else:
+            self.value = min(self.maximum, self.value + self.step)
+
+        return self.value
+
+
+class Throttle():
+    """
+    Limit the rate of metadata operations (directory listings and file stats) made by a walker.
+
+    The latency of each operation is measured. Once every window of operations, the mean latency is compared
+    with the target and the rate and number of concurrent listings are adjusted with AIMD. The rate is also
+    limited by the shared token bucket, which caps the total across all the jobs.
+
+    A Throttle with no limits does nothing.
+    """
+
+    # Number of operations to average the latency over before adjusting
+    WINDOW = 50
+
+    # Number of tokens to take from the shared bucket at a time, to keep the number of lock file updates down
+    BATCH = 20
+
+    def __init__(self, target_latency=None, max_rate=None, min_rate=None, max_threads=1, shared=None):
+        """
+        :param target_latency:  Mean seconds per operation above which the job backs off. None: no feedback
+        :param max_rate:        Most operations per second for this job. None: no limit
+        :param min_rate:        Lowest rate to back off to. Default: 1% of max_rate
+        :param max_threads:     Most directories to list at once
+        :param shared:          SharedTokenBucket
+        """
+        self.target_latency = target_latency
+        self.max_threads = max(1, max_threads)
+        self.shared = shared
+
+        self.rate = None
+        if max_rate:
+            self.rate = AIMDController(min_rate or max_rate / 100.0, float(max_rate), max_rate / 10.0)
+
+        # Without a latency target the number of threads is never adjusted, so start at the most
+        self.threads = AIMDController(1, self.max_threads, 1, initial=1 if target_latency else None)
+
+        self.decreases = 0
+
+        self._lock = threading.Lock()
+        self._tokens = float(max_rate or 0)
+        self._last = time.time()
+        self._allowance = 0
+        self._window = []
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        :param conf: ConfigParser object. Can be None
+        :return: Throttle using the [throttle] section of the config file
+        """
+        if conf is None or not conf.has_section(SECTION):
+            return cls()
+
+        def get(option, cast):
+            if conf.has_option(SECTION, option) and conf.get(SECTION, option):
+                return cast(conf.get(SECTION, option))
+
+        shared = None
+        cluster_rate = get("cluster-rate", float)
+        if cluster_rate:
+            shared = SharedTokenBucket(
+                os.path.join(conf.get("files", "processing-directory"), STATE_FILE), cluster_rate
+            )
+
+        return cls(
+            target_latency=get("target-latency", float),
+            max_rate=get("max-rate", float),
+            min_rate=get("min-rate", float),
+            max_threads=get("threads", int) or 1,
+            shared=shared
+        )
+
+    def __bool__(self):
+        return bool(self.target_latency or self.rate or self.shared or self.max_threads > 1)
+
+    __nonzero__ = __bool__
+
+    @property
+    def limited(self):
+        """
+        :return: True if operations have to wait for the rate limit
+        """
+        return bool(self.rate or self.shared)
+
+    @property
+    def concurrency(self):
+        """
+        :return: number of directories to list at once
+        """
+        return int(self.threads.value)
+
+    def _reserve(self, n):
+        """
+        :param n: Number of operations
+        :return: seconds to wait before making them
+        """
+        delay = 0.0
+
+        with self._lock:
+            if self.rate:
+                now = time.time()
+                rate = self.rate.value
+                self._tokens = min(rate, self._tokens + (now - self._last) * rate) - n
+                self._last = now
+                delay = max(0.0, -self._tokens / rate)
+
+            if self.shared:
+                self._allowance -= n
+                if self._allowance < 0:
+                    need = self.BATCH - self._allowance
+                    delay = max(delay, self.shared.acquire(need))
+                    self._allowance += need
+
+        return delay
+
+    def wait(self, n=1):
+        """
+        Wait until n operations can be made
+
+        :param n: Number of operations
+        :return: seconds waited
+        """
+        if not self.limited:
+            return 0.0
+
+        delay = self._reserve(n)
+        if delay:
+            time.sleep(delay)
+
+        return delay
+
+    def record(self, seconds, ops=1):
+        """
+        Record the time taken by a batch of operations, which have already been waited for
+
+        :param seconds: Time taken, not including waits
+        :param ops:     Number of operations
+        """
+        if not self.target_latency or not ops:
+            return
+
+        with self._lock:
+            self._window.append((seconds, ops))
+
+            if sum(count for elapsed, count in self._window) < self.WINDOW:
+                return
+
+            latency = sum(elapsed for elapsed, count in self._window) / sum(count for elapsed, count in self._window)
+            self._window = []
+
+            congested = latency > self.target_latency
+            if congested:
+                self.decreases += 1
+
+            if self.rate:
+                self.rate.update(congested)
+            self.threads.update(congested)
@@ -0,0 +1,260 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from utils.metrics import Metrics
+from utils.rollups import scan_directory, rollup, add_stats
+from utils.pruning import Pruner
+from utils.throttle import Throttle
+from utils.path_tools import path_fields
+
+
+class DirectoryWalker():
+    """
+    Walk a spot and generate the directory records and 00README content. Links which point to another
+    location in the archive are followed to build the complete directory tree.
+
+    Each directory is listed once. The file counts, sizes and latest modification times are collected
+    while listing and rolled up to the ancestors in a single post-order pass once the walk is complete.
+
+    Excluded directories are skipped. Directories with too many sub-directories are marked as summarised
+    and their sub-directories are not indexed.
+
+    Links which point into another spot are not walked, as that spot is walked by its own job. A link stub
+    is recorded instead so the target's records can be copied below the link when the index is built.
+    """
+
+    def __init__(self, spots, moles_mapping, metrics=None, pruner=None, throttle=None):
+        """
+        :param spots:           SpotMapping object
+        :param moles_mapping:   MOLES mapping
+        :param metrics:         Metrics object
+        :param pruner:          Pruner object
+        :param throttle:        Throttle object. Limits the rate of directory listings and file stats
+        """
+        self.spots = spots
+        self.moles_mapping = moles_mapping
+        self.metrics = metrics or Metrics("walker")
+        self.pruner = pruner or Pruner()
+        self.throttle = throttle or Throttle()
+        self.pruned = 0
+        self.link_stubs = []
+
+    def process_path(self, dir):
+        """
+        Process the path and return metadata. Also returns whether the directory is linked to another location in the archive.
+
+        :param dir: direcory path to process
+
+        :return:    dir_meta - dictionary of directory metadata
+                    link     - boolean describing if the directory links to a location inside the archive
+        """
+
+        archive_path = self.spots.get_archive_path(dir)
+
+        dir_meta = {
+            'depth': dir.count('/'),
+            'dir': os.path.basename(dir),
+            'path': dir,
+            'archive_path': archive_path,
+            'link': False,
+            'type': "dir"
+        }
+        dir_meta.update(path_fields(dir))
+
+        with self.metrics.timer("islink"):
+            if os.path.islink(dir) and dir != archive_path:
+                dir_meta['link'] = True
+
+        with self.metrics.timer("moles_lookup"):
+            record = self.get_moles_record_meta(archive_path)
+
+        if record and record["title"]:
+            dir_meta["title"] = record["title"]
+            dir_meta["url"] = record["url"]
+            dir_meta["record_type"] = record["record_type"]
+
+        return dir_meta, dir_meta['link']
+
+    def get_moles_record_meta(self, dir):
+        """
+        Use the archive path to check the mapping for a match.
+
+        :param dir: directory to test
+        :return: MOLES record info for the given dir
+        """
+
+        # recursively check for a match
+        while len(dir) > 1:
+            if dir in self.moles_mapping:
+                return self.moles_mapping[dir]
+            elif dir + "/" in self.moles_mapping:
+                return self.moles_mapping[dir + "/"]
+            else:
+                dir = os.path.dirname(dir)
+
+    def link_stub(self, path, spot):
+        """
+        :param path:    Symlinked directory
+        :param spot:    Spot being walked
+        :return: link stub if the link points into another spot, otherwise None
+        """
+        try:
+            target = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+        except OSError:
+            return None
+
+        target_spot = self.spots.get_spot(target)
+
+        if target_spot and target_spot != spot:
+            return {"path": path, "target": target, "spot": target_spot}
+
+    def read_readme(self, path):
+        with open(os.path.join(path, "00README")) as reader:
+            content = reader.read()
+        return content.decode('utf-8', 'ignore').encode("utf-8")
+
+    def scan(self, path):
+        """
+        List a directory, waiting for the throttle first. The listing and each file stat count as one operation.
+        The file stats are charged in batches as they are made, so the rate also applies within a large directory.
+        Run in the listing threads.
+
+        :param path: Directory to list
+        :return: result of scan_directory or None if the directory cannot be read
+        """
+        waits = []
+
+        def charge(n):
+            waited = self.throttle.wait(n)
+            if waited:
+                waits.append(waited)
+
+        charge(1)
+        listing_wait = sum(waits)
+
+        start = time.time()
+        try:
+            result = scan_directory(path, charge if self.throttle.limited else None, self.throttle.BATCH)
+        except OSError:
+            return None
+
+        # Time spent waiting for the throttle is not latency
+        elapsed = time.time() - start - (sum(waits) - listing_wait)
+
+        if waits:
+            self.metrics.incr("throttle_waits", len(waits))
+            self.metrics.incr("throttle_wait_seconds", sum(waits))
+
+        self.metrics.observe("scandir", elapsed)
+        self.throttle.record(elapsed, 1 + result[1]["file_count"])
+
+        return result
+
+    def walk(self, scan_dir):
+        """
+        Walk the tree below scan_dir.
+
+        :param scan_dir: Directory to scan
+        :return: (list of directory metadata, dictionary of path to 00README content)
+        """
+        output = []
+        stats = {}
+        readmes = {}
+        summarised = set()
+        links = set()
+        spot = self.spots.get_spot(scan_dir)
+
+        # Add the root
+        root_meta, islink = self.process_path(scan_dir)
+        output.append(root_meta)
+
+        # Directories are only descended into if they are real directories or links which point
+        # to another location in the archive. Everything below a followed link is descended into.
+        stack = [(scan_dir, False)]
+
+        # Directories are listed in batches of up to the throttle's concurrency
+        pool = ThreadPool(self.throttle.max_threads) if self.throttle.max_threads > 1 else None
+
+        while stack:
+            batch = [stack.pop() for i in range(min(len(stack), self.throttle.concurrency))]
+
+            if pool:
+                results = pool.map(self.scan, [root for root, following in batch])
+            else:
+                results = [self.scan(root) for root, following in batch]
+
+            for (root, following), result in zip(batch, results):
+
+                if result is None:
+                    self.metrics.incr("unreadable_dirs")
+                    continue
+
+                dirs, stats[root], has_readme = result
+
+                # Check for 00README
+                if has_readme:
+                    readmes[root] = self.read_readme(root)
+
+                # Count the sub-directories rather than enumerate them
+                if self.pruner.summarise(root, len(dirs)):
+                    summarised.add(root)
+                    self.pruned += len(dirs)
+                    self.metrics.incr("summarised_dirs")
+                    self.metrics.incr("pruned_dirs", len(dirs))
+                    continue
+
+                for entry in dirs:
+                    path = os.path.join(root, entry.name)
+
+                    if self.pruner.excluded(path):
+                        self.pruned += 1
+                        self.metrics.incr("pruned_dirs")
+                        continue
+
+                    metadata, islink = self.process_path(path)
+                    output.append(metadata)
+
+                    if not entry.is_symlink():
+                        stack.append((path, following))
+                        continue
+
+                    # The other spot's job walks the target
+                    stub = self.link_stub(path, spot)
+                    if stub:
+                        self.link_stubs.append(stub)
+                        self.metrics.incr("link_stubs")
+
+                    elif following:
+                        links.add(path)
+                        stack.append((path, following))
+
+                    # Map directories below link points. More selective than following all links
+                    elif islink:
+                        self.metrics.incr("links_followed")
+                        links.add(path)
+                        stack.append((path, True))
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        # Linked storage is counted where the target is
+        rollup(stats, links)
+
+        for dir_meta in output:
+            if dir_meta['path'] in stats:
+                add_stats(dir_meta, stats[dir_meta['path']])
+
+            if dir_meta['path'] in summarised:
+                dir_meta['summarised'] = True
+
+        return output, readmes
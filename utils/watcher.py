@@ -0,0 +1,344 @@
+"""
+
+"""
+__author__ = "Richard Smith"
+__date__ = "25 Jan 2019"
+__copyright__ = "Copyright 2018 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+__contact__ = "richard.d.smith@stfc.ac.uk"
+
+import os
+import errno
+import time
+from collections import deque
+from utils.metrics import Metrics
+from utils.inotify import Inotify, max_user_watches, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, \
+    IN_CLOSE_WRITE, IN_ISDIR, IN_Q_OVERFLOW, IN_IGNORED
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+CREATED = "created"
+REMOVED = "removed"
+CHANGED = "changed"
+README = "readme"
+
+
+class PendingChanges():
+    """
+    Debounce bursts of events into the net change for each path.
+    """
+
+    def __init__(self, debounce=5, max_delay=60):
+        """
+        :param debounce:    Seconds without events before the changes are released
+        :param max_delay:   Longest time a change is held during a continuous burst
+        """
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.changes = {}
+        self.first = None
+        self.last = None
+
+    def add(self, path, change):
+        now = time.time()
+        self.first = self.first or now
+        self.last = now
+
+        current = self.changes.get(path)
+
+        if change == README:
+            # Creating or regenerating the directory picks up the README
+            if current is None:
+                self.changes[path] = README
+
+        elif change == CREATED:
+            self.changes[path] = CHANGED if current in (REMOVED, CHANGED) else CREATED
+
+        elif change == REMOVED:
+            if current == CREATED:
+                # Created and removed within the window. Nothing to do
+                del self.changes[path]
+            else:
+                self.changes[path] = REMOVED
+
+        else:
+            self.changes[path] = CHANGED
+
+    def ready(self):
+        if not self.changes:
+            return False
+
+        now = time.time()
+        return now - self.last >= self.debounce or now - self.first >= self.max_delay
+
+    def pop(self):
+        """
+        :return: dictionary of path to net change
+        """
+        changes = self.changes
+        self.changes = {}
+        self.first = self.last = None
+        return changes
+
+
+class SpotWatcher():
+    """
+    Watch spot subtrees for directory creations, removals, symlink changes and 00README updates.
+
+    inotify watches are placed breadth first up to the watch budget. Subtrees which do not fit are
+    checked by periodically comparing directory mtimes instead.
+    """
+
+    def __init__(self, roots, max_watches=None, poll_interval=300, debounce=5, max_delay=60, metrics=None):
+        """
+        :param roots:           Spot directories to watch
+        :param max_watches:     Watch budget. Default: 90% of the kernel limit
+        :param poll_interval:   Seconds between checks of subtrees which are polled
+        :param debounce:        Seconds without events before changes are released
+        :param max_delay:       Longest time a change is held during a continuous burst
+        :param metrics:         Metrics object
+        """
+        self.roots = [root.rstrip('/') for root in roots]
+
+        if max_watches is None:
+            limit = max_user_watches() or 8192
+            max_watches = int(limit * 0.9)
+
+        self.max_watches = max_watches
+        self.poll_interval = poll_interval
+        self.metrics = metrics or Metrics("watcher")
+
+        self.inotify = Inotify()
+        self.watches = {}
+        self.watched = {}
+        self.links = set()
+
+        # Subtrees which did not fit in the watch budget and their last snapshot
+        self.polled = {}
+        self.last_poll = time.time()
+
+        self.pending = PendingChanges(debounce=debounce, max_delay=max_delay)
+
+    def start(self):
+        for root in self.roots:
+            self.watch_tree(root)
+
+        print("Watching {} directories. Polling {} subtrees".format(len(self.watches), len(self.polled)))
+
+    def watch_tree(self, root, created=False):
+        """
+        Place watches on root and every directory below it, breadth first. Anything that does not
+        fit in the budget is polled instead.
+
+        :param root:    Top of the subtree
+        :param created: Report every directory found as created
+        """
+        queue = deque([root])
+
+        while queue:
+            path = queue.popleft()
+
+            if created:
+                self.pending.add(path, CREATED)
+
+            # Polled subtrees are not descended into
+            if path in self.polled:
+                continue
+
+            # Directories which are already watched are listed again to find new sub-directories
+            if path not in self.watched:
+                if len(self.watches) >= self.max_watches:
+                    self._poll(path, created)
+                    continue
+
+                try:
+                    wd = self.inotify.add_watch(path)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        self._poll(path, created)
+                    continue
+
+                self.watches[wd] = path
+                self.watched[path] = wd
+                self.metrics.incr("watches")
+
+            for entry in self._list(path):
+                child = os.path.join(path, entry.name)
+
+                if entry.is_symlink():
+                    self.links.add(child)
+                    if created:
+                        self.pending.add(child, CREATED)
+                else:
+                    queue.append(child)
+
+    def _poll(self, path, created):
+        """
+        Poll a subtree which does not fit in the watch budget
+
+        :param path:    Top of the subtree
+        :param created: Report every directory found as created
+        """
+        self.polled[path] = self.snapshot(path)
+        self.metrics.incr("polled_subtrees")
+
+        if created:
+            for child in self.polled[path]:
+                self.pending.add(child, CREATED)
+
+    def _list(self, path):
+        try:
+            return [entry for entry in scandir(path) if entry.is_dir()]
+        except OSError:
+            return []
+
+    def snapshot(self, root, previous=None):
+        """
+        Record the state of every directory below root. Directories whose mtime has not changed
+        since the previous snapshot are not listed again.
+
+        :param root:        Top of the subtree
+        :param previous:    Previous snapshot of the subtree
+        :return: dictionary of path to (mtime, link target, 00README mtime, sub-directories)
+        """
+        previous = previous or {}
+        state = {}
+        stack = [root]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+
+            target = os.readlink(path) if os.path.islink(path) else None
+
+            try:
+                readme = os.stat(os.path.join(path, "00README")).st_mtime
+            except OSError:
+                readme = None
+
+            children = []
+            if target is None:
+                if path in previous and previous[path][0] == stat.st_mtime:
+                    children = previous[path][3]
+                else:
+                    children = [os.path.join(path, entry.name) for entry in self._list(path)]
+
+            state[path] = (stat.st_mtime, target, readme, children)
+            stack.extend(children)
+
+        return state
+
+    def rescan(self):
+        """
+        Events have been lost. Watches are placed on any directories which do not have one and each spot
+        is reported as changed so it is walked and indexed again.
+        """
+        for root in self.roots:
+            self.watch_tree(root)
+            self.pending.add(root, CHANGED)
+
+        self.metrics.incr("rescans")
+
+    def poll(self):
+        """
+        Compare each polled subtree with its last snapshot
+        """
+        for root, old in self.polled.items():
+            new = self.snapshot(root, previous=old)
+
+            for path in new:
+                if path not in old:
+                    self.pending.add(path, CREATED)
+                elif new[path][1] != old[path][1]:
+                    self.pending.add(path, CHANGED)
+                elif new[path][2] != old[path][2]:
+                    self.pending.add(path, README)
+
+            for path in old:
+                if path not in new:
+                    self.pending.add(path, REMOVED)
+
+            self.polled[root] = new
+
+        self.last_poll = time.time()
+        self.metrics.incr("polls")
+
+    def handle(self, event):
+        """
+        Turn an inotify event into a pending change
+
+        :param event: inotify Event
+        """
+        if event.mask & IN_Q_OVERFLOW:
+            print("inotify queue overflowed. Rescanning the spots")
+            self.metrics.incr("queue_overflows")
+            self.rescan()
+            return
+
+        parent = self.watches.get(event.wd)
+
+        if event.mask & IN_IGNORED:
+            if parent is not None:
+                del self.watches[event.wd]
+                self.watched.pop(parent, None)
+            return
+
+        if parent is None or not event.name:
+            return
+
+        path = os.path.join(parent, event.name)
+        self.metrics.incr("events")
+
+        if event.name == "00README":
+            if event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+                self.pending.add(parent, README)
+            return
+
+        if event.mask & (IN_CREATE | IN_MOVED_TO):
+            if event.mask & IN_ISDIR:
+                self.watch_tree(path, created=True)
+
+            elif os.path.islink(path) and os.path.isdir(path):
+                # New or re-pointed symlink
+                self.links.add(path)
+                self.pending.add(path, CREATED)
+
+        elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+            if event.mask & IN_ISDIR or path in self.links:
+                self.links.discard(path)
+                self.pending.add(path, REMOVED)
+
+                for watched in [p for p in self.watched if p == path or p.startswith(path + '/')]:
+                    wd = self.watched.pop(watched)
+                    self.watches.pop(wd, None)
+
+                    # The kernel keeps watching a directory which has been moved away
+                    if event.mask & IN_MOVED_FROM:
+                        self.inotify.rm_watch(wd)
+
+    def changes(self, timeout=1):
+        """
+        Run forever, yielding the net changes each time a burst of events has settled
+
+        :param timeout: Seconds to wait for events on each loop
+        :return: generator of dictionaries of path to change
+        """
+        while True:
+            for event in self.inotify.read_events(timeout):
+                self.handle(event)
+
+            if self.polled and time.time() - self.last_poll >= self.poll_interval:
+                self.poll()
+
+            if self.pending.ready():
+                yield self.pending.pop()
+
+    def close(self):
+        self.inotify.close()